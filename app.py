@@ -1,116 +1,184 @@
-import sqlite3
+import os
 import datetime
 import json
-import csv
-import os
-from flask import g, Flask, render_template, flash, redirect, request, session, jsonify
-from flask_session import Session
-from helpers import login_required
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+import click
+from flask import Flask, Response, g, make_response, render_template, flash, redirect, request, send_file, session, jsonify, stream_with_context
+from assets import STATIC_MAX_AGE, folder_version, static_version
+from helpers import login_required, operator_required
+from importer import ImportResult, read_rows, import_cards, insert_cards
+from database import get_backend, get_db, get_directory_db, get_pool, close_db
+from writer import WriterBusy, get_writer, write
+from passwords import AttemptLimiter, PasswordBusy, get_hasher
+import jobs
+from exporter import FORMATS, export_csv, export_jsonl
+from tags import TagQueryError
+from migrations import migrate
+import metrics
+import cache
+from cache import get_cache
+from sessions import delete_expired, session_interface
+from scheduler import LEVELS
+from retention import RetentionError
+from study import StudyCursorError, page, parse_cursor
+from stats import StatsQueryError, parse_range
+from sync import SyncError, parse_events
+from search import PAGE_SIZE, MAX_PAGE_SIZE, search_cards, search_lists
+from repositories import FolderRepository, KeywordRepository, ListRepository, ReviewRepository, UserRepository, UsernameTaken
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileRequired, FileAllowed
 from wtforms import SubmitField
 
 app = Flask(__name__)
 
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
+# "sqlite" keeps sessions in the sessions table, "cookie" in signed cookies
+app.config["SESSION_BACKEND"] = "sqlite"
 app.config["SECRET_KEY"] = '622351b6-0fca-439b-83c3-236ebadb3f4d3'
-app.config["UPLOAD_FOLDER"] = 'static/files'
-Session(app)
-
-DATABASE = "flashcards.db"
+app.config["MAX_CONTENT_LENGTH"] = 32 * 1024 * 1024
+app.config["IMPORT_MAX_ROWS"] = 100000
+app.config["IMPORT_BATCH_SIZE"] = 1000
+app.config["DASHBOARD_PAGE_SIZE"] = 50
+app.config["DATABASE"] = "flashcards.db"
+# "shared" keeps every user in DATABASE, "sharded" gives every user a database of their own
+# in STORAGE_FOLDER (instance/users when None), DATABASE only keeping the accounts and sessions
+app.config["STORAGE_BACKEND"] = "shared"
+app.config["STORAGE_FOLDER"] = None
+app.config["MIGRATE_ON_STARTUP"] = True
+# Requests slower than this are logged, /metrics and /db_stats ask for this bearer token
+# and answer 404 when it isn't set
+app.config["SLOW_REQUEST_SECONDS"] = 0.5
+app.config["METRICS_TOKEN"] = None
+# Writes waiting for the writer thread before requests are refused, most writes per commit,
+# and seconds a request waits for its write before giving up
+app.config["WRITER_QUEUE_SIZE"] = 1000
+app.config["WRITER_BATCH_SIZE"] = 100
+app.config["WRITER_RESULT_TIMEOUT"] = 30
+# PBKDF2 iterations of new hashes, calibrated to PASSWORD_TARGET_SECONDS when None,
+# and the processes hashing them (0 hashes in the request thread)
+app.config["PASSWORD_ITERATIONS"] = None
+app.config["PASSWORD_TARGET_SECONDS"] = 0.25
+app.config["PASSWORD_WORKERS"] = None
+app.config["PASSWORD_QUEUE_SIZE"] = 32
+# Password attempts allowed in a window, by account and by address
+app.config["LOGIN_WINDOW_SECONDS"] = 300
+app.config["LOGIN_MAX_ATTEMPTS"] = 10
+app.config["LOGIN_MAX_ATTEMPTS_PER_ADDRESS"] = 50
+# Background jobs (imports, exports): threads running them, unfinished jobs per user,
+# and the folder of their uploads and results (instance/jobs when None)
+app.config["JOBS_WORKERS"] = 2
+app.config["JOBS_PER_USER"] = 2
+app.config["JOBS_FOLDER"] = None
+# Recall probability cards are scheduled at once the user's forgetting curve is fitted
+app.config["RETENTION_TARGET"] = 0.9
+# Memory of the in-process cache of page data, 0 turns it off
+app.config["CACHE_MAX_BYTES"] = 32 * 1024 * 1024
+
+# Settings can be overridden with FLASK_ prefixed environment variables (e.g. FLASK_DATABASE)
+app.config.from_prefixed_env()
+app.session_interface = session_interface(app.config["SESSION_BACKEND"])
+
+# Give the request's connection back to the pool
+app.teardown_appcontext(close_db)
+
+# Latency, SQL and JSON metrics of every request, served on /metrics
+metrics.init_app(app)
+
+# Imports and exports run in background threads, their state is in the jobs table
+jobs.init_app(app)
+
+# Page data kept in memory, checked against the version counters of the database
+cache.init_app(app)
+
+# Floods of password attempts are refused before any hashing
+account_attempts = AttemptLimiter(app.config["LOGIN_MAX_ATTEMPTS"], app.config["LOGIN_WINDOW_SECONDS"])
+address_attempts = AttemptLimiter(app.config["LOGIN_MAX_ATTEMPTS_PER_ADDRESS"], app.config["LOGIN_WINDOW_SECONDS"])
+
+# Part of every page ETag, so that a new release isn't hidden by a 304: the pages embed
+# the templates and the fingerprinted URLs of the static files
+RELEASE_VERSION = folder_version(os.path.join(app.root_path, app.template_folder), app.static_folder)
 
 class UploadFileForm(FlaskForm):
-    file = FileField("File", validators=[FileRequired(), FileAllowed(['csv'], 'CSV only!')])
+    file = FileField("File", validators=[FileRequired(), FileAllowed(['csv', 'tsv', 'txt'], 'CSV, TSV or text files only!')])
     submit = SubmitField("Import list")
 
-def get_db():
-    """Connexion to the SQLite database"""
-
-    db = sqlite3.connect(DATABASE, timeout=30, check_same_thread=False)
-    db.row_factory = sqlite3.Row
-    return db
-
-
-def init_db():
-    """Create tables if they don't exist"""
-
-
-    # Database tables:
-    # users(id, username, hash)
-    # lists(id, title, description, cards, folders, keywords, path, user_id, creation_date)
-    # folders(id, name, path, keywords, user_id, creation_date)
-    # lessons(id, cards, list_id, user_id, lesson_date)
-
-    with get_db() as db:
-
-        db.execute("""CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-            username TEXT NOT NULL,
-            hash TEXT NOT NULL
-        )""")
-        db.execute("""CREATE TABLE IF NOT EXISTS lists (
-            id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-            title TEXT NOT NULL,
-            description TEXT NOT NULL,
-            cards TEXT,
-            folders TEXT,
-            keywords TEXT,
-            path TEXT NOT NULL,
-            user_id INTEGER NOT NULL,
-            creation_date DATE NOT NULL
-        )""")
-        db.execute("""CREATE TABLE IF NOT EXISTS folders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-            name TEXT NOT NULL,
-            path TEXT NOT NULL,
-            keywords TEXT NOT NULL,
-            user_id INTEGER NOT NULL,
-            creation_date DATE NOT NULL
-        )""")
-        db.execute("""CREATE TABLE IF NOT EXISTS lessons (
-            id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-            cards TEXT NOT NULL,
-            list_id TEXT NOT NULL,
-            user_id INTEGER NOT NULL,
-            lesson_date DATE NOT NULL
-        )""")
-
-
 @app.context_processor
 def inject_user():
     """Get username if logged in"""
-    print("session")
-    print(session)
     if "user_id" in session:
-        user = {}
-        with get_db() as db:
-            user = db.execute("SELECT username FROM users WHERE id = ?", (session["user_id"],)).fetchone()
-        return dict(username=user["username"])
+        user_id = session["user_id"]
+
+        def load():
+            with get_db() as db:
+                return UserRepository(db).username(user_id)
+
+        # Usernames never change, the entry is dropped with the account
+        return dict(username=get_cache().get((user_id, "username"), 0, load))
     return dict(username=None)
 
-@app.teardown_appcontext
-def close_db(error):
-    db = g.pop("db", None)
-    if db is not None:
-        db.close()
+@app.url_defaults
+def fingerprint_static(endpoint, values):
+    """Add the content hash of static files to their URL, e.g. /static/css/styles.css?v=1a2b3c4d5e6f"""
 
+    if endpoint == "static" and "filename" in values and "v" not in values:
+        version = static_version(app.static_folder, values["filename"])
+        if version:
+            values["v"] = version
 
-@app.before_request
-def before_request():
-    init_db()
 
 @app.after_request
 def after_request(response):
-    """Ensure responses aren't cached"""
+    """Set the cache policy of the response"""
+
+    if request.endpoint == "static":
+        # Fingerprinted URLs never change content, others are revalidated by Flask's ETag
+        if request.args.get("v"):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_MAX_AGE
+            response.cache_control.immutable = True
+        return response
+
+    if response.get_etag()[0]:
+        # Pages with an ETag are kept by the browser but checked on every visit
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
     response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     response.headers["Expires"] = 0
     response.headers["Pragma"] = "no-cache"
     return response
 
 
+def conditional_page(etag, render):
+    """
+    Answer 304 Not Modified when the browser already has this version of the page,
+    otherwise render it with its ETag.
+
+    Pages showing flashed messages are never cached, the messages would be shown again.
+    """
+
+    if "_flashes" in session:
+        return render()
+
+    etag = f"{RELEASE_VERSION}-{etag}"
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = make_response(render())
+
+    response.set_etag(etag)
+    return response
+
+
+@app.errorhandler(413)
+def file_too_large(error):
+    """Refuse uploads bigger than MAX_CONTENT_LENGTH"""
+
+    flash("This file is too large", "danger")
+    return redirect(request.path)
+
+
 @app.route("/", methods=["GET"])
 @login_required
 def index():
@@ -118,49 +186,41 @@ def index():
 
     user_id = session["user_id"]
 
-    folders = []
-    lists = []
-
-    with get_db() as db:
-        folders = db.execute("SELECT * FROM folders WHERE user_id = (?)", (user_id,)).fetchall()
-        lists = db.execute("SELECT * FROM lists WHERE user_id = (?)", (user_id,)).fetchall()
+    page_size = app.config["DASHBOARD_PAGE_SIZE"]
 
+    # Lists and folders are paginated by id: the cursor is the last id of the previous page
+    lists_after = request.args.get("lists_after", 0, type=int)
+    folders_after = request.args.get("folders_after", 0, type=int)
 
-    formatted_lists = []
-
-    for list in lists:
-
-        # Parse cards from JSON
-        cards = json.loads(list["cards"])
+    with get_db() as db:
+        version = UserRepository(db).version(user_id)
 
-        list_folders = []
+    def load():
+        with get_db() as db:
+            folders = [dict(row) for row in FolderRepository(db, user_id).page(folders_after, page_size + 1)]
+            lists = [dict(row) for row in ListRepository(db, user_id).page(lists_after, page_size + 1)]
 
-        keywords = []
+        return folders, lists
 
-        # If folders exist parse, them from JSON
-        if list["folders"]:
-            list_folders = [str(f) for f in json.loads(list["folders"])]
-        else:
-            list_folders = []
+    def render():
+        folders, lists = get_cache().get((user_id, "dashboard", lists_after, folders_after, page_size), version, load)
 
-        # If keywords exist parse, them from JSON
-        if list["keywords"]:
-            keywords = json.loads(list["keywords"])
+        # The extra row only tells if there is a next page
+        next_lists = lists[page_size - 1]["id"] if len(lists) > page_size else None
+        next_folders = folders[page_size - 1]["id"] if len(folders) > page_size else None
 
-        # Clean list object for better rendering
-        formatted_lists.append({
-            "id": list["id"],
-            "title": list["title"],
-            "description": list["description"],
-            "cards": cards,
-            "folders": list_folders,
-            "keywords": keywords,
-            "path": list["path"],
-            "creation_date": list["creation_date"]
-            }
-            )
+        return render_template(
+            "index.html",
+            folders=folders[:page_size],
+            lists=lists[:page_size],
+            lists_after=lists_after,
+            folders_after=folders_after,
+            next_lists=next_lists,
+            next_folders=next_folders,
+            tab=request.args.get("tab", "lists")
+        )
 
-    return render_template("index.html", folders=folders, lists=formatted_lists)
+    return conditional_page(f"index-{user_id}-{version}", render)
 
 
 
@@ -183,18 +243,42 @@ def login():
             flash("You must enter your password", "danger")
             return redirect("/login")
 
-        with get_db() as db:
-            rows = db.execute(
-                "SELECT * FROM users WHERE username = ?", (username,)
-            ).fetchall()
+        if not (address_attempts.allow(request.remote_addr) and account_attempts.allow("user:" + username)):
+            flash("Too many login attempts, try again in a few minutes", "danger")
+            return redirect("/login")
+
+        hasher = get_hasher()
+
+        with get_directory_db() as db:
+            user = UserRepository(db).by_username(username)
+
+        try:
+            valid = user is not None and hasher.check(user["hash"], password)
+        except PasswordBusy as error:
+            flash(str(error), "danger")
+            return redirect("/login")
 
-        if len(rows) != 1 or not check_password_hash(rows[0]["hash"], password):
+        if not valid:
             flash("Invalid username and/or password", "danger")
             return redirect("/login")
 
+        account_attempts.reset("user:" + username)
+
+        # Hashes made with a lower cost are replaced while the password is known,
+        # the next login tries again if the hashing pool is busy
+        if hasher.needs_upgrade(user["hash"]):
+            try:
+                new_hash = hasher.hash(password)
+            except PasswordBusy:
+                new_hash = None
+
+            if new_hash:
+                with get_directory_db() as db:
+                    UserRepository(db).set_hash(user["id"], new_hash, old_hash=user["hash"])
+
         # Forget any user id
         session.clear()
-        session["user_id"] = rows[0]["id"]
+        session["user_id"] = user["id"]
 
         flash("Hello " + username + " !", "primary")
 
@@ -239,24 +323,24 @@ def register():
             flash("Passwords don't match", "danger")
             return redirect("/register")
 
-        hash_password = generate_password_hash(password, method="pbkdf2:sha256")
+        if not address_attempts.allow(request.remote_addr):
+            flash("Too many attempts, try again in a few minutes", "danger")
+            return redirect("/register")
 
-        with get_db() as db:
+        try:
+            hash_password = get_hasher().hash(password)
+        except PasswordBusy as error:
+            flash(str(error), "danger")
+            return redirect("/register")
+
+        with get_directory_db() as db:
             try:
-                db.execute(
-                    "INSERT INTO users (username, hash) VALUES (?, ?)",
-                    (username, hash_password),
-                )
-            except sqlite3.IntegrityError:
-                flash("Username already exists", "danger")
+                user_id = UserRepository(db).create(username, hash_password)
+            except UsernameTaken as error:
+                flash(str(error), "danger")
                 return redirect("/register")
 
-
-            row = db.execute(
-                "SELECT * FROM users WHERE username = ?", (username,)
-            ).fetchone()
-
-            session["user_id"] = row["id"]
+            session["user_id"] = user_id
             flash("Registered successfully!", "success")
 
         return redirect("/")
@@ -270,12 +354,8 @@ def account():
 
     user_id = session["user_id"]
 
-    list_number = 0
-
     with get_db() as db:
-        row = db.execute("SELECT COUNT(*) FROM lists WHERE user_id = (?)", (user_id,)).fetchone()
-
-        list_number = row["COUNT(*)"]
+        list_number = ListRepository(db, user_id).count()
 
     return render_template("account.html", list_number=list_number)
 
@@ -304,23 +384,34 @@ def change_password():
         return redirect("/account")
 
 
-    with get_db() as db:
+    # Ensure new passwords match
+    if new_password != confirmation:
+        flash("New passwords don't match", "danger")
+        return redirect("/account")
 
-        user = db.execute("SELECT * FROM users WHERE id = (?)", (user_id,)).fetchone()
+    if not account_attempts.allow(f"id:{user_id}"):
+        flash("Too many attempts, try again in a few minutes", "danger")
+        return redirect("/account")
 
-        # Ensure user has entered the correct password
-        if not check_password_hash(user["hash"], current_password):
-            flash("Invalid current password","danger")
-            return redirect("/account")
+    hasher = get_hasher()
 
-        # Ensure new passwords match
-        if new_password != confirmation:
-            flash("New passwords don't match", "danger")
-            return redirect("/account")
+    with get_directory_db() as db:
+        users = UserRepository(db)
+
+        user = users.get(user_id)
+
+        try:
+            # Ensure user has entered the correct password
+            if not hasher.check(user["hash"], current_password):
+                flash("Invalid current password","danger")
+                return redirect("/account")
 
-        new_password_hash = generate_password_hash(new_password, method="pbkdf2:sha256")
+            new_password_hash = hasher.hash(new_password)
+        except PasswordBusy as error:
+            flash(str(error), "danger")
+            return redirect("/account")
 
-        db.xecute("UPDATE users SET hash = (?) WHERE id = (?)", (new_password_hash, user_id))
+        users.set_hash(user_id, new_password_hash)
         flash("Your password has been changed successfully !", "success")
         return redirect("/account")
 
@@ -331,9 +422,12 @@ def delete_account():
 
     user_id = session["user_id"]
 
-    with get_db() as db:
+    with get_directory_db() as db:
+        UserRepository(db).delete(user_id)
 
-        db.execute("DELETE FROM users WHERE id = (?)", (user_id,))
+    get_backend().delete_user(user_id)
+
+    get_cache().invalidate(user_id)
 
     session.clear()
 
@@ -387,36 +481,16 @@ def create_list():
             return redirect("/create_list")
 
 
-        cards_json = json.dumps(cards)
-
-        with get_db() as db:
-
-            lists_numbers = db.execute("SELECT id FROM lists").fetchall()
-
-            last_id = 0
-
-            for l in lists_numbers:
-                last_id = l["id"]
-
-
+        try:
             if list_id == "/":
-
-                path = str.lower(str(list_title)).replace(" ", "_") + "_" + str(last_id + 1)
-
-                db.execute(
-                    "INSERT INTO lists (title, description, cards, path, user_id, creation_date) VALUES (?, ?, ?, ?, ?, ?)",
-                    (list_title, list_description, cards_json, path, user_id, creation_date)
-                )
+                write(lambda db: ListRepository(db, user_id).create(list_title, list_description, cards, creation_date))
                 flash("List created successfully!", "success")
-            else:
-
-                path = str.lower(str(list_title)).replace(" ", "_") + "_" + list_id
-                
-                db.execute(
-                    "UPDATE lists SET title = (?), description = (?), path = (?), cards = (?) WHERE id = (?) AND user_id = (?)",
-                    (list_title, list_description, path, cards_json, list_id, user_id)
-                )
+            elif write(lambda db: ListRepository(db, user_id).update(list_id, list_title, list_description, cards, creation_date)):
                 flash("List edited successfully!", "success")
+            else:
+                flash("This list doesn't exist", "danger")
+        except WriterBusy as error:
+            flash(str(error), "danger")
 
         return redirect("/")
 
@@ -425,10 +499,11 @@ def create_list():
     if preloaded_list_id:
 
         with get_db() as db:
+            lists = ListRepository(db, user_id)
 
-            row = db.execute("SELECT * FROM lists WHERE id = (?) AND user_id = (?)", (preloaded_list_id, user_id)).fetchone()
+            row = lists.get(preloaded_list_id)
 
-            preloaded_list_cards = json.loads(row["cards"])
+            preloaded_list_cards = lists.cards(row["id"])
 
             page_title = "Edit " + str(row["title"])
             button_text = "Finish"
@@ -463,15 +538,10 @@ def create_folder():
         return redirect("/")
 
 
-    with get_db() as db:
-        folders = db.execute("SELECT COUNT(*) FROM folders WHERE user_id = (?)", (user_id,)).fetchone()
-
-        folders_last_id = int(folders["COUNT(*)"])
-
-        path = str(str.lower((name))).replace(" ", "_") + "_" + str(folders_last_id + 1)
-
-
-        db.execute("INSERT INTO folders (name, path, keywords, user_id, creation_date) VALUES (?, ?, ?, ?, ?)", (name, path, "[]", user_id, creation_date))
+    try:
+        write(lambda db: FolderRepository(db, user_id).create(name, creation_date))
+    except WriterBusy as error:
+        flash(str(error), "danger")
 
 
     return redirect("/")
@@ -490,9 +560,16 @@ def delete_list():
     if not listId:
         return redirect('user/lists/' + listPath)
     else:
-        with get_db() as db:
-            db.execute("DELETE FROM lists WHERE id = (?) AND user_id = (?)", (listId, user_id,))
-            flash("The list has been successfully delete", "success")
+        try:
+            write(lambda db: ListRepository(db, user_id).delete(listId))
+        except WriterBusy as error:
+            flash(str(error), "danger")
+            return redirect("/")
+
+        flash("The list has been successfully delete", "success")
+
+        # The entries of the deleted list would only take room
+        get_cache().invalidate(user_id)
 
         return redirect("/")
 
@@ -507,17 +584,23 @@ def edit_folder():
     folderPath = request.form.get("folder_path")
     folderName = request.form.get("folder_name")
 
-    newPath = str(folderName) + "_" + str(folderId)
-
 
     if not folderId:
-        return redirect('user/folders/' + folderPath)
+        return redirect('/user/folders/' + folderPath)
     else:
-        with get_db() as db:
-            db.execute("UPDATE folders SET name = (?), path = (?) WHERE id = (?) AND user_id = (?)", (folderName, newPath, folderId, user_id,))
-            flash("The folder has been successfully edited", "success")
+        try:
+            newPath = write(lambda db: FolderRepository(db, user_id).rename(folderId, folderName))
+        except WriterBusy as error:
+            flash(str(error), "danger")
+            return redirect('/user/folders/' + folderPath)
 
-    return redirect('user/folders/' + newPath)
+        if newPath is None:
+            flash("This folder doesn't exist", "danger")
+            return redirect("/")
+
+        flash("The folder has been successfully edited", "success")
+
+    return redirect('/user/folders/' + newPath)
 
 
 @app.route("/delete_folder", methods=["GET"])
@@ -533,9 +616,16 @@ def delete_folder():
     if not folderId:
         return redirect('user/folders/' + folderPath)
     else:
-        with get_db() as db:
-            db.execute("DELETE FROM folders WHERE id = (?) AND user_id = (?)", (folderId, user_id,))
-            flash("The folder has been successfully delete", "success")
+        try:
+            write(lambda db: FolderRepository(db, user_id).delete(folderId))
+        except WriterBusy as error:
+            flash(str(error), "danger")
+            return redirect("/")
+
+        flash("The folder has been successfully delete", "success")
+
+        # The entries of the deleted folder would only take room
+        get_cache().invalidate(user_id)
 
         return redirect("/")
 
@@ -546,77 +636,104 @@ def show_folder(folder_path):
     """Get selected folder page"""
 
     user_id = session["user_id"]
-    folder = []
-    lists = []
-    lists_in_folder = []
-    folder_id = ""
 
     with get_db() as db:
-        folder_data = db.execute("SELECT * FROM folders WHERE path = (?)", (folder_path,)).fetchone()
+        folder_data = FolderRepository(db, user_id).by_path(folder_path)
+
+        if not folder_data:
+            flash("This folder doesn't exist", "danger")
+            return redirect("/")
 
-        lists_data = db.execute("SELECT * FROM lists WHERE user_id = (?)", (user_id,)).fetchall()
+        version = UserRepository(db).version(user_id)
 
-        lists = [dict(list) for list in lists_data]
+    def load(tags):
+        """Keywords of the folder, its lists (those matching tags) with their keywords, and the other lists"""
 
+        with get_db() as db:
+            folders = FolderRepository(db, user_id)
+            keywords = KeywordRepository(db, user_id)
+
+            folder_keywords = keywords.of_folder(folder_data["id"])
+
+            lists_in_folder = [dict(list) for list in folders.lists(folder_data["id"], tags)]
 
-        folder = dict(folder_data)
+            lists_keywords = keywords.of_lists([list["id"] for list in lists_in_folder], folder_data["id"])
 
-        if folder:
-            folder_id = folder["id"]
+            other_lists = [dict(row) for row in folders.other_lists(folder_data["id"])]
 
-        if folder["keywords"]:
-            folder["keywords"] = json.loads(folder["keywords"])
+        for list in lists_in_folder:
+            list["keywords"] = lists_keywords[list["id"]]
 
-    for list in lists:
-        list["cards"] = json.loads(list["cards"])
+        return folder_keywords, lists_in_folder, other_lists
 
-        if list["folders"]:
-            list["folders"] = [str(f) for f in json.loads(list["folders"])]
+    def render():
+        # Members can be filtered with a tag query, e.g. "verbs AND NOT done"
+        tags = request.args.get("tags", "").strip()
 
-        if list["keywords"]:
-            list["keywords"] = json.loads(list["keywords"])
+        try:
+            folder_keywords, lists_in_folder, other_lists = get_cache().get(
+                (user_id, "folder", folder_data["id"], tags), version, lambda: load(tags)
+            )
+        except TagQueryError as error:
+            flash(str(error), "danger")
+            folder_keywords, lists_in_folder, other_lists = get_cache().get(
+                (user_id, "folder", folder_data["id"], ""), version, lambda: load("")
+            )
 
-    for list in lists:
+        folder = dict(folder_data, keywords=folder_keywords)
 
-        if list["folders"] and str(folder_id) in list["folders"] and not list in lists_in_folder:
-            lists_in_folder.append(list)
+        return render_template("folder.html", folder=folder, folder_lists=lists_in_folder, other_lists=other_lists, tags=tags)
 
-    return render_template("folder.html", folder=folder, folder_lists=lists_in_folder, all_lists=lists)
+    return conditional_page(f"folder-{folder_data['id']}-{version}", render)
 
 
-@app.route("/user/lists/<list_path>")
+@app.route("/user/folders/<folder_path>/study")
 @login_required
-def show_list(list_path):
-    """Get selected list / card deck page"""
+def study_folder(folder_path):
+    """Study the cards of every list of a folder (or of the lists matching its tags filter) in one session"""
 
     user_id = session["user_id"]
 
     with get_db() as db:
+        folder = FolderRepository(db, user_id).by_path(folder_path)
 
-        folders_list = db.execute("SELECT * FROM folders").fetchall()
-        list_data = db.execute("SELECT * FROM lists WHERE path = (?)", (list_path,)).fetchone()
+    if not folder:
+        flash("This folder doesn't exist", "danger")
+        return redirect("/")
 
-        list = dict(list_data)
+    return render_template("study.html", folder=folder, tags=request.args.get("tags", "").strip())
 
-        lessons = db.execute("SELECT * FROM lessons WHERE list_id = (?) AND user_id = (?) ORDER BY lesson_date DESC", (list["id"], user_id,)).fetchall()
 
-        previous_lessons = [dict(r) for r in lessons]
+@app.route("/user/lists/<list_path>")
+@login_required
+def show_list(list_path):
+    """Get selected list / card deck page"""
 
-        for lesson in previous_lessons:
-            lesson["cards"] = json.loads(lesson["cards"])
+    user_id = session["user_id"]
+
+    with get_db() as db:
+        list_data = ListRepository(db, user_id).by_path(list_path)
 
-        if list and list["folders"]:
-            list["folders"] = json.loads(list["folders"])
+    if not list_data:
+        flash("This list doesn't exist", "danger")
+        return redirect("/")
+
+    def load():
+        with get_db() as db:
+            folders = ListRepository(db, user_id).folder_ids(list_data["id"])
+            keywords = KeywordRepository(db, user_id).of_lists([list_data["id"]])[list_data["id"]]
 
-        if list and list["keywords"]:
-             list["keywords"] = json.loads(list["keywords"])
+        return folders, keywords
 
-        list["cards"] = json.loads(list["cards"])
+    def render():
+        folders, keywords = get_cache().get((user_id, "list", list_data["id"]), list_data["version"], load)
 
-        previous_lessons.reverse()
+        list = dict(list_data, folders=folders, keywords=keywords)
 
-        return render_template("list.html", list=list, list_path=list_path, folders_list=folders_list, lessons=previous_lessons)
+        # The cards are loaded by the page, in chunks, from the cards API
+        return render_template("list.html", list=list, list_path=list_path)
 
+    return conditional_page(f"list-{list_data['id']}-{list_data['version']}-{user_id}", render)
 
 
 @app.route("/add_to_folder", methods=["POST"])
@@ -634,25 +751,10 @@ def add_to_folder():
 
     path = "/user/folders/" + str(folder_path)
 
-    row = []
-
-    with get_db() as db:
-
-        row = db.execute("SELECT folders FROM lists WHERE id = (?) AND user_id = (?)", (list_id, user_id,)).fetchone()
-
-
-    folders = []
-    if row and row["folders"]:
-        folders = json.loads(row["folders"])
-
-    if folder_id not in folders:
-        folders.append(folder_id)
-
-    folders_json = json.dumps(folders)
-
-    with get_db() as db:
-        db.execute("UPDATE lists SET folders = (?) WHERE id = (?) AND user_id = (?)", (folders_json, list_id, user_id))
-
+    try:
+        write(lambda db: FolderRepository(db, user_id).add_list(folder_id, list_id))
+    except WriterBusy as error:
+        flash(str(error), "danger")
 
     return redirect(path)
 
@@ -670,27 +772,12 @@ def remove_from_folder():
 
     folder_path = request.form.get("folder_path")
 
-    row = []
-
     path = "/user/folders/" + str(folder_path)
 
-    with get_db() as db:
-
-        row = db.execute("SELECT folders FROM lists WHERE id = (?) AND user_id = (?)", (list_id, user_id,)).fetchone()
-
-
-    folders = []
-    if row and row["folders"]:
-        folders = json.loads(row["folders"])
-
-    if folder_id in folders:
-        folders.remove(folder_id)
-
-    folders_json = json.dumps(folders)
-
-    with get_db() as db:
-        db.execute("UPDATE lists SET folders = (?) WHERE id = (?) AND user_id = (?)", (folders_json, list_id, user_id))
-
+    try:
+        write(lambda db: FolderRepository(db, user_id).remove_list(folder_id, list_id))
+    except WriterBusy as error:
+        flash(str(error), "danger")
 
     return redirect(path)
 
@@ -702,50 +789,28 @@ def create_keyword():
 
     user_id = session["user_id"]
 
-    keywordName = request.form.get("keyword")
+    keywordName = request.form.get("keyword", "").strip()
 
-    folderId = int(request.form.get("folder_id"))
+    folderId = request.form.get("folder_id", type=int)
     folderPath = request.form.get("folder_path")
-    listId = int(request.form.get("list_id"))
+    listId = request.form.get("list_id", type=int)
 
     path = "/user/folders/" + str(folderPath)
 
     if not keywordName:
         flash("You must enter a keyword", "danger")
+        return redirect(path)
 
-    with get_db() as db:
-        listRow = db.execute("SELECT keywords FROM lists WHERE id = (?) AND user_id = (?)", (listId, user_id,)).fetchone()
-        folderRow = db.execute("SELECT keywords FROM folders WHERE id = (?) AND user_id = (?)", (folderId, user_id,)).fetchone()
-
-        folder_keywords = []
-        list_keywords = []
-
-
-        if folderRow["keywords"]:
-            folder_keywords = json.loads(folderRow["keywords"])
-        if listRow["keywords"]:
-            list_keywords = json.loads(listRow["keywords"])
-
-        folderKeyword = {
-            "id": (len(list_keywords) + 1),
-            "keyword": keywordName,
-        }
-
-        listKeyword = {
-            "id": (len(list_keywords) + 1),
-            "keyword": keywordName,
-            "active": True
-        }
-
-        folder_keywords.append(folderKeyword)
-        list_keywords.append(listKeyword)
-
-        json_folder_keywords = json.dumps(folder_keywords)
-        json_list_keywords = json.dumps(list_keywords)
-
-        db.execute("UPDATE folders SET keywords = (?) WHERE id = (?) AND user_id = (?)", (json_folder_keywords, folderId, user_id))
-        db.execute("UPDATE lists SET keywords = (?) WHERE id = (?) AND user_id = (?)", (json_list_keywords, listId, user_id))
+    try:
+        # The new keyword is given to the list it was created from
+        created = write(lambda db: KeywordRepository(db, user_id).create(folderId, keywordName, listId))
+    except WriterBusy as error:
+        flash(str(error), "danger")
+        return redirect(path)
 
+    if not created:
+        flash("This folder doesn't exist", "danger")
+        return redirect("/")
 
     return redirect(path)
 
@@ -761,24 +826,10 @@ def update_keyword_status():
     keyword_id = data.get("keyword_id")
     active = True if data.get("active") else False
 
-
-    with get_db() as db:
-        keywords = db.execute("SELECT keywords FROM lists WHERE id = (?) AND user_id = (?)", (list_id, user_id,)).fetchone()
-
-        print(keywords["keywords"])
-        keywords = json.loads(keywords["keywords"])
-
-        for keyword in keywords:
-            if int(keyword["id"]) == int(keyword_id):
-                keyword["active"] = active
-
-        jsonKeywords = json.dumps(keywords)
-
-        db.execute("""
-            UPDATE lists
-            SET keywords = (?)
-            WHERE id = (?) AND user_id = ?
-        """, (jsonKeywords, list_id, user_id))
+    try:
+        write(lambda db: KeywordRepository(db, user_id).set_active(list_id, keyword_id, active))
+    except WriterBusy as error:
+        return jsonify(error=str(error)), 503
 
     return jsonify(success=True)
 
@@ -803,19 +854,10 @@ def update_card():
     if card_term == "" and card_definition == "":
         return redirect(path)
 
-    with get_db() as db:
-        cards = db.execute("SELECT cards FROM lists WHERE id = (?) AND user_id = (?)", (list_id, user_id,)).fetchone()
-        cards = json.loads(cards["cards"])
-
-        for card in cards:
-            if card["id"] == int(card_id):
-                card["term"] = card_term
-                card["definition"] = card_definition
-
-
-        jsonCards = json.dumps(cards)
-
-        db.execute("UPDATE lists SET cards = (?) WHERE id = (?) AND user_id = (?)", (jsonCards, list_id, user_id))
+    try:
+        write(lambda db: ListRepository(db, user_id).update_card(list_id, card_id, card_term, card_definition))
+    except WriterBusy as error:
+        flash(str(error), "danger")
 
     return redirect(path)
 
@@ -826,48 +868,445 @@ def update_level():
     """Change the card status (mastered or still learning) in the database"""
 
     user_id = session["user_id"]
-    data = request.get_json()
-    list_id = data["list_id"]
-    list_cards = data["list_cards"]
+    data = request.get_json(silent=True)
 
-    list = []
+    try:
+        list_id = int(data["list_id"])
+        list_cards = [(int(list_card["id"]), list_card.get("level")) for list_card in data["list_cards"]]
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return jsonify(error="list_id and list_cards, with integer card ids, are required"), 400
 
     with get_db() as db:
-        cards = db.execute("SELECT cards FROM lists WHERE id = (?) AND user_id = (?)", (list_id, user_id,)).fetchone()
+        lists = ListRepository(db, user_id)
+
+        list = lists.get(list_id)
 
-        cards = json.loads(cards["cards"])
+        if not list:
+            return jsonify(success=False), 404
 
-        for list_card in list_cards:
-            for card in cards:
-                if int(card["id"]) == int(list_card["id"]):
-                    card["level"] = list_card["level"]
+        review_date = datetime.datetime.now()
 
+        events = [
+            {"key": None, "list_id": list["id"], "card_id": card_id, "level": level, "reviewed_at": review_date}
+            for card_id, level in list_cards if level in LEVELS
+        ]
 
-        jsonCards = json.dumps(cards)
+        # Schedule the answered cards, log one review per answer and update the statistics,
+        # committed by the writer thread with the other lessons finished at the same time
+        try:
+            write(lambda db: ReviewRepository(db, user_id).apply(events, review_date))
+        except WriterBusy as error:
+            return jsonify(error=str(error)), 503
 
-        db.execute("""
-            UPDATE lists
-            SET cards = (?)
-            WHERE id = (?) AND user_id = ?
-        """, (jsonCards, list_id, user_id))
+        jsonCards = json.dumps(lists.cards(list_id))
 
-        db.execute("""INSERT INTO lessons (cards, user_id, list_id, lesson_date) VALUES (?, ?, ?, ?)""", (jsonCards, user_id, list_id, datetime.datetime.now()))
+        folders = json.dumps(lists.folder_ids(list_id))
 
-        list = db.execute("SELECT * FROM lists WHERE id = (?) AND user_id = (?)", (list_id, user_id,)).fetchone()
+        keywords = json.dumps(KeywordRepository(db, user_id).of_lists([list["id"]])[list["id"]])
+
+        counts = lists.counts([list_id])[0]
 
     # Format and clean up list
     json_list = json.dumps({
         "id": list["id"],
         "title": list["title"],
         "description": list["description"],
-        "cards": list["cards"],
-        "folders": list["folders"],
-        "keywords": list["keywords"],
+        "cards": jsonCards,
+        "folders": folders,
+        "keywords": keywords,
         "path": list["path"],
         "user_id": list["user_id"],
     })
 
-    return {"list": json_list}
+    return {"list": json_list, "card_count": counts["card_count"], "mastered_count": counts["mastered_count"]}
+
+
+@app.route("/api/sync", methods=["POST"])
+@login_required
+def sync_reviews():
+    """
+    Apply a batch of review events made on any of the user's lists, possibly offline.
+
+    Every event has a key generated by the client: a batch sent again after a
+    lost response is only applied once. A bad event (malformed, too old, of a
+    deleted list) is rejected alone, the others are applied. Answers with the
+    keys of every outcome and the state of the cards and lists the batch touched.
+    """
+
+    user_id = session["user_id"]
+    data = request.get_json(silent=True)
+
+    if not isinstance(data, dict):
+        return jsonify(error="The body must be a JSON object"), 400
+
+    now = datetime.datetime.now()
+
+    try:
+        events, rejected = parse_events(data.get("reviews"), now)
+
+        applied, duplicates, missing, refused = write(lambda db: ReviewRepository(db, user_id).apply(events, now))
+        rejected += refused
+
+        with get_db() as db:
+            repository = ListRepository(db, user_id)
+
+            card_keys = {(event["list_id"], event["card_id"]) for event in events}
+            list_ids = {event["list_id"] for event in events}
+
+            cards = []
+
+            for list_id in list_ids:
+                card_ids = [card_id for card_list_id, card_id in card_keys if card_list_id == list_id]
+                cards += [dict(row) for row in repository.card_states(list_id, card_ids)]
+
+            lists = [dict(row) for row in repository.counts(list(list_ids))]
+    except SyncError as error:
+        return jsonify(error=str(error)), 400
+    except WriterBusy as error:
+        return jsonify(error=str(error)), 503
+
+    return jsonify(applied=applied, duplicates=duplicates, missing=missing, rejected=rejected, cards=cards, lists=lists)
+
+
+@app.route("/api/stats", methods=["GET"])
+@login_required
+def study_stats():
+    """Reviews of the user, or of one of their lists, grouped by day, week or month"""
+
+    user_id = session["user_id"]
+
+    list_id = request.args.get("list_id", type=int)
+    bucket = request.args.get("bucket", "day")
+    today = datetime.date.today()
+
+    try:
+        start, end = parse_range(request.args.get("from"), request.args.get("to"), today)
+
+        with get_db() as db:
+            reviews = ReviewRepository(db, user_id)
+            data = reviews.series(start, end, bucket, list_id)
+            streak = reviews.streak(today, list_id)
+    except StatsQueryError as error:
+        return jsonify(error=str(error)), 400
+
+    return jsonify(start=start.isoformat(), end=end.isoformat(), bucket=bucket, series=data, streak=streak)
+
+
+@jobs.handler("retention")
+def retention_job(job, payload):
+    """Fit the forgetting curve of the user on their whole review history"""
+
+    try:
+        with get_db() as db:
+            row = ReviewRepository(db, job.user_id).fit_retention(datetime.datetime.now(), app.config["RETENTION_TARGET"])
+    except RetentionError as error:
+        raise ValueError(str(error))
+
+    # The fit only reads, the model is stored by the writer thread
+    write(lambda db: ReviewRepository(db, job.user_id).store_retention(row))
+
+    return {key: value for key, value in row.items() if key != "fitted_at"} if row else {"reviews": 0}
+
+
+@app.route("/api/retention", methods=["GET", "POST"])
+@login_required
+def retention_model():
+    """Get the user's fitted forgetting curve, or fit it again in a background job"""
+
+    user_id = session["user_id"]
+
+    if request.method == "POST":
+        try:
+            job_id = jobs.get_runner().submit(user_id, "retention", {})
+        except jobs.JobError as error:
+            return jsonify(error=str(error)), 429
+
+        with get_db() as db:
+            row = jobs.get_job(db, job_id, user_id)
+
+        return jsonify(jobs.to_json(row)), 202
+
+    with get_db() as db:
+        row = ReviewRepository(db, user_id).retention_model()
+
+    if not row:
+        return jsonify(error="No model was fitted yet, the fixed intervals are used"), 404
+
+    return jsonify(dict(row))
+
+
+@app.route("/api/lists/query", methods=["GET"])
+@login_required
+def query_lists():
+    """Get the lists matching a tag query, in a folder or across the account"""
+
+    user_id = session["user_id"]
+
+    tags = request.args.get("tags", "")
+    folder_id = request.args.get("folder_id", type=int)
+    after = request.args.get("after", 0, type=int)
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 200)
+
+    try:
+        with get_db() as db:
+            rows = ListRepository(db, user_id).query(tags, folder_id, after, limit)
+    except TagQueryError as error:
+        return jsonify(error=str(error)), 400
+
+    lists = [dict(row) for row in rows]
+
+    return jsonify(lists=lists, next=lists[-1]["id"] if len(lists) == limit else None)
+
+
+@app.route("/search", methods=["GET"])
+@login_required
+def search():
+    """Search the user's lists and cards"""
+
+    user_id = session["user_id"]
+
+    query = request.args.get("q", "").strip()
+    page = max(request.args.get("page", 1, type=int), 1)
+
+    with get_db() as db:
+        lists = search_lists(db, user_id, query) if page == 1 else []
+        cards = search_cards(db, user_id, query, PAGE_SIZE, (page - 1) * PAGE_SIZE)
+
+    return render_template("search.html", query=query, lists=lists, cards=cards, page=page, has_more=len(cards) == PAGE_SIZE)
+
+
+@app.route("/api/search", methods=["GET"])
+@login_required
+def api_search():
+    """Search the user's lists and cards, as JSON"""
+
+    user_id = session["user_id"]
+
+    query = request.args.get("q", "")
+    limit = min(max(request.args.get("limit", PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+
+    with get_db() as db:
+        lists = search_lists(db, user_id, query, limit, offset)
+        cards = search_cards(db, user_id, query, limit, offset)
+
+    return jsonify(lists=lists, cards=cards, next=offset + limit if len(cards) == limit or len(lists) == limit else None)
+
+
+# Columns of the cards API, by field name
+CARD_FIELDS = {
+    "id": "card_id",
+    "term": "term",
+    "definition": "definition",
+    "level": "level",
+    "due_at": "due_at",
+}
+
+
+@app.route("/api/lists/<int:list_id>/cards", methods=["GET"])
+@login_required
+def list_cards(list_id):
+    """
+    Get the cards of a list in chunks, in their display order.
+
+    The cursor is the "position.card_id" of the last card of the previous
+    chunk, fields restricts the columns sent and due=1 only sends the cards
+    due for a review. The first chunk also tells how many cards there are.
+    """
+
+    user_id = session["user_id"]
+
+    cursor = request.args.get("cursor", "")
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 500)
+    due = request.args.get("due", 0, type=int) == 1
+
+    fields = request.args.get("fields", "").split(",") if request.args.get("fields") else list(CARD_FIELDS)
+
+    if any(field not in CARD_FIELDS for field in fields):
+        return jsonify(error="Fields must be among " + ", ".join(CARD_FIELDS)), 400
+
+    try:
+        position, card_id = (int(part) for part in cursor.split(".")) if cursor else (-1, -1)
+    except ValueError:
+        return jsonify(error="Invalid cursor"), 400
+
+    due_before = datetime.datetime.now() if due else None
+
+    with get_db() as db:
+        lists = ListRepository(db, user_id)
+
+        list_data = lists.get(list_id)
+
+        if not list_data:
+            return jsonify(error="This list doesn't exist"), 404
+
+        rows = lists.cards_page(list_id, {field: CARD_FIELDS[field] for field in fields}, (position, card_id), limit, due_before)
+
+        total = None
+
+        if not cursor:
+            total = list_data["card_count"] if not due else lists.due_count([list_id], due_before)
+
+    cards = [{field: row[field] for field in fields} for row in rows]
+    next_cursor = f"{rows[-1]['cursor_position']}.{rows[-1]['cursor_card_id']}" if len(rows) == limit else None
+
+    return jsonify(cards=cards, next=next_cursor, total=total)
+
+
+@app.route("/api/folders/<int:folder_id>/cards", methods=["GET"])
+@login_required
+def folder_cards(folder_id):
+    """
+    Get the cards of a folder's lists as one interleaved session, in chunks.
+
+    tags filters the lists with their active keywords, like on the folder
+    page, and due=1 only sends the cards due for a review. The cursor is the
+    "position.list_id.card_id" of the last card of the previous chunk. The
+    first chunk also gives the titles of the lists and the number of cards.
+    """
+
+    user_id = session["user_id"]
+
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 500)
+    due = request.args.get("due", 0, type=int) == 1
+    tags = request.args.get("tags", "").strip()
+
+    try:
+        after = parse_cursor(request.args.get("cursor"))
+    except StudyCursorError as error:
+        return jsonify(error=str(error)), 400
+
+    with get_db() as db:
+        folders = FolderRepository(db, user_id)
+
+        if not folders.get(folder_id):
+            return jsonify(error="This folder doesn't exist"), 404
+
+        try:
+            lists = folders.lists(folder_id, tags)
+        except TagQueryError as error:
+            return jsonify(error=str(error)), 400
+
+        list_ids = [row["id"] for row in lists]
+        due_before = datetime.datetime.now() if due else None
+
+        cards, next_cursor = page(db, list_ids, after, limit, due_before)
+
+        total, titles = None, None
+
+        if after is None:
+            titles = {row["id"]: row["title"] for row in lists}
+            total = sum(row["card_count"] for row in lists) if not due else ListRepository(db, user_id).due_count(list_ids, due_before)
+
+    return jsonify(cards=cards, next=next_cursor, total=total, lists=titles)
+
+
+@app.route("/due", methods=["GET"])
+@login_required
+def due():
+    """Get the next cards due for a review across all the user's lists"""
+
+    user_id = session["user_id"]
+
+    limit = min(max(request.args.get("limit", 20, type=int), 1), 100)
+
+    with get_db() as db:
+        rows = ListRepository(db, user_id).due_cards(datetime.datetime.now(), limit)
+
+    return jsonify(cards=[dict(row) for row in rows])
+
+
+def export_response(list_ids, filename, folders=()):
+    """Stream an export in the format asked in the query string"""
+
+    export_format = request.args.get("format", "csv")
+
+    if export_format not in FORMATS:
+        flash("Unknown export format", "danger")
+        return redirect("/")
+
+    # The rows are read as the response streams, after the route has returned
+    db = get_db()
+
+    if export_format == "csv":
+        rows = export_csv(db, list_ids)
+    else:
+        rows = export_jsonl(db, list_ids, folders)
+
+    return Response(
+        stream_with_context(rows),
+        mimetype=FORMATS[export_format],
+        headers={"Content-Disposition": f"attachment; filename={filename}.{export_format}"}
+    )
+
+
+@app.route("/export/list/<int:list_id>", methods=["GET"])
+@login_required
+def export_list(list_id):
+    """Download a list and its history"""
+
+    user_id = session["user_id"]
+
+    with get_db() as db:
+        row = ListRepository(db, user_id).get(list_id)
+
+    if not row:
+        flash("This list doesn't exist", "danger")
+        return redirect("/")
+
+    return export_response([list_id], row["path"])
+
+
+@app.route("/export/folder/<int:folder_id>", methods=["GET"])
+@login_required
+def export_folder(folder_id):
+    """Download the lists of a folder and their history"""
+
+    user_id = session["user_id"]
+
+    with get_db() as db:
+        folders = FolderRepository(db, user_id)
+
+        folder = folders.get(folder_id)
+
+        if not folder:
+            flash("This folder doesn't exist", "danger")
+            return redirect("/")
+
+        list_ids = folders.list_ids(folder_id)
+
+    return export_response(list_ids, folder["path"], folders=[folder])
+
+
+@app.route("/export/account", methods=["GET"])
+@login_required
+def export_account():
+    """Download all the user's folders, lists and history"""
+
+    user_id = session["user_id"]
+
+    with get_db() as db:
+        folders = FolderRepository(db, user_id).all()
+
+        list_ids = ListRepository(db, user_id).ids()
+
+    return export_response(list_ids, "reminidex", folders=folders)
+
+
+@app.route("/db_stats", methods=["GET"])
+@operator_required
+def db_stats():
+    """Get the connection pool, writer and cache counters"""
+
+    return jsonify(**get_pool().stats(), writer=get_writer().stats(), cache=get_cache().stats())
+
+
+@app.route("/metrics", methods=["GET"])
+@operator_required
+def show_metrics():
+    """Get the request, SQL, pool and cache metrics of this process, in the Prometheus text format"""
+
+    return Response(app.extensions["metrics"].render(get_pool().stats(), get_writer().stats(), get_cache().stats()), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/import_list", methods=["POST", "GET"])
@@ -878,62 +1317,238 @@ def import_list():
 
     user_id = session["user_id"]
 
-    cards = []
-
     if form.validate_on_submit():
         file = form.file.data
 
-        upload_dir = os.path.join(app.root_path, "static", "files")
-        os.makedirs(upload_dir, exist_ok=True)
+        runner = jobs.get_runner()
 
-        filename = file.filename
-       
-        file_path = os.path.join(upload_dir, filename)
+        # The upload is kept in the jobs folder until the job has read it
+        upload = runner.path(f"upload-{user_id}-{os.urandom(8).hex()}")
+        file.save(upload)
 
-        file.save(file_path)
+        try:
+            job_id = runner.submit(user_id, "import", {"upload": upload, "filename": file.filename})
+        except jobs.JobError as error:
+            os.remove(upload)
+            flash(str(error), "danger")
+            return redirect("/import_list")
 
-        with open(file_path, newline='') as f:
-            reader = csv.reader(f)
-            data = [tuple(row) for row in reader]
+        return redirect("/import_list?job=" + str(job_id))
 
-            for i, d in enumerate(data):
-                if i > 0:
-                    cards.append({
-                    "id": i,
-                    "term": d[0],
-                    "definition": d[1],
-                    "level": ""
-            })
+    return render_template("import_list.html", form=form, job_id=request.args.get("job", type=int))
 
-        cards = json.dumps(cards)
 
-        with get_db() as db:
+@jobs.handler("import")
+def import_job(job, payload):
+    """
+    Import an uploaded file as a new list.
 
-            lists_numbers = db.execute("SELECT id FROM lists WHERE user_id = ?", (user_id,)).fetchall()
+    The cards are written batch by batch by the writer thread, the progress
+    (bytes of the file read) being reported after every batch, so the import
+    doesn't hold the write lock for its whole length. A failed or cancelled
+    import deletes the list it started.
+    """
 
-            last_id = 0
+    db = get_db()
 
-            for l in lists_numbers:
-                last_id = l["id"]
+    title = payload["filename"].rsplit(".", 1)[0]
 
-            list_id = int(last_id) + 1
+    creation_date = datetime.datetime.now()
 
-            filename = filename.rsplit(".", 1)[0]
+    result = ImportResult()
 
-            path = str.lower(str(filename)).replace(" ", "_") + "_" + str(list_id)
+    list_id, path = write(lambda db: ListRepository(db, job.user_id).create_empty(title, creation_date))
+
+    try:
+        with open(payload["upload"], "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+
+            rows = read_rows(file, payload["filename"], result)
+
+            import_cards(db, list_id, job.user_id, rows, result, creation_date,
+                         max_rows=app.config["IMPORT_MAX_ROWS"], batch_size=app.config["IMPORT_BATCH_SIZE"],
+                         on_batch=lambda: job.progress(file.tell(), size),
+                         insert=lambda batch: write(insert_cards, batch))
+
+            job.progress(size, size)
+    except BaseException:
+        write(lambda db: ListRepository(db, job.user_id).delete_imported(list_id))
+        raise
+    finally:
+        os.remove(payload["upload"])
+
+    return {
+        "list_id": list_id,
+        "path": path,
+        "imported": result.imported,
+        "malformed": result.malformed,
+        "malformed_lines": result.malformed_lines,
+    }
+
+
+@jobs.handler("export")
+def export_job(job, payload):
+    """Write an export of all the user's lists to a file of the jobs folder, the progress being the lists done"""
+
+    db = get_db()
+
+    folders = FolderRepository(db, job.user_id).all()
+
+    list_ids = ListRepository(db, job.user_id).ids()
+
+    def counted(list_ids):
+        for index, list_id in enumerate(list_ids):
+            job.progress(index, len(list_ids))
+            yield list_id
+
+    export_format = payload["format"]
+    path = os.path.join(job.folder, f"export-{job.id}.{export_format}")
+
+    try:
+        with open(path, "w", encoding="utf-8", newline="") as file:
+            if export_format == "csv":
+                file.writelines(export_csv(db, counted(list_ids)))
+            else:
+                file.writelines(export_jsonl(db, counted(list_ids), folders))
+
+        job.progress(len(list_ids), len(list_ids))
+    except BaseException:
+        os.remove(path)
+        raise
+
+    return {"file": path, "format": export_format, "lists": len(list_ids)}
+
+
+@app.route("/api/jobs", methods=["GET"])
+@login_required
+def list_jobs():
+    """Get the user's recent jobs, newest first"""
+
+    with get_db() as db:
+        rows = jobs.recent_jobs(db, session["user_id"])
+
+    return jsonify(jobs=[jobs.to_json(row) for row in rows])
+
+
+@app.route("/api/jobs/<int:job_id>", methods=["GET"])
+@login_required
+def show_job(job_id):
+    """Get the status and progress of a job, polled by the pages that started it"""
+
+    with get_db() as db:
+        row = jobs.get_job(db, job_id, session["user_id"])
+
+    if not row:
+        return jsonify(error="This job doesn't exist"), 404
+
+    return jsonify(jobs.to_json(row))
+
+
+@app.route("/api/jobs/<int:job_id>/cancel", methods=["POST"])
+@login_required
+def cancel_job(job_id):
+    """Ask a queued or running job to stop"""
+
+    with get_db() as db:
+        if not jobs.cancel(db, job_id, session["user_id"]):
+            return jsonify(error="This job isn't running"), 409
+
+        row = jobs.get_job(db, job_id, session["user_id"])
+
+    return jsonify(jobs.to_json(row))
+
+
+@app.route("/api/exports", methods=["POST"])
+@login_required
+def start_export():
+    """Export all the user's data in the background, the file is downloaded from the job once it's done"""
+
+    data = request.get_json(silent=True) or {}
+    export_format = data.get("format", "jsonl")
+
+    if export_format not in FORMATS:
+        return jsonify(error="Unknown export format"), 400
+
+    try:
+        job_id = jobs.get_runner().submit(session["user_id"], "export", {"format": export_format})
+    except jobs.JobError as error:
+        return jsonify(error=str(error)), 429
+
+    with get_db() as db:
+        row = jobs.get_job(db, job_id, session["user_id"])
+
+    return jsonify(jobs.to_json(row)), 202
+
+
+@app.route("/api/jobs/<int:job_id>/download", methods=["GET"])
+@login_required
+def download_job(job_id):
+    """Download the file made by a finished export"""
+
+    with get_db() as db:
+        row = jobs.get_job(db, job_id, session["user_id"])
+
+    result = json.loads(row["result"]) if row and row["status"] == "done" and row["result"] else {}
+
+    if not result.get("file") or not os.path.exists(result["file"]):
+        return jsonify(error="This export isn't available"), 404
+
+    return send_file(result["file"], mimetype=FORMATS[result["format"]], as_attachment=True,
+                     download_name=f"reminidex.{result['format']}")
+
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Bring the database schema up to date"""
+
+    with get_directory_db() as db:
+        applied = migrate(db)
+
+    click.echo("Applied: " + ", ".join(applied) if applied else "The database is up to date")
+
+
+@app.cli.command("fit-retention")
+@click.option("--user", "user_id", type=int, help="Only fit the model of this user")
+def fit_retention_command(user_id):
+    """Fit the forgetting curve of every user (or one) on their review history"""
+
+    user_ids = [user_id] if user_id else UserRepository(get_directory_db()).ids()
+    fitted = 0
+
+    # The fits only read, every model is stored by the writer thread once its user is fitted
+    for user_id in user_ids:
+        # A context of its own per user, for the database of the user when every user has their own
+        with app.app_context():
+            g.user_id = user_id
+
+            try:
+                with get_db() as db:
+                    row = ReviewRepository(db, user_id).fit_retention(datetime.datetime.now(), app.config["RETENTION_TARGET"])
+            except RetentionError as error:
+                raise click.ClickException(str(error))
+
+            write(lambda db: ReviewRepository(db, user_id).store_retention(row))
+
+        if row:
+            fitted += 1
+            click.echo(f"User {user_id}: stability {row['initial_stability']:.2f} days x {row['growth']:.2f}, "
+                       f"{row['reviews']} reviews, log loss {row['log_loss']:.3f}")
+
+    click.echo(f"Fitted {fitted} models out of {len(user_ids)} users")
 
-            db.execute(
-                    "INSERT INTO lists (title, description, cards, path, user_id, creation_date) VALUES (?, ?, ?, ?, ?, ?)",
-                    (filename, "", cards, path, user_id, datetime.datetime.now())
-            )
 
-            url_id = db.execute(
-                    "SELECT id FROM lists WHERE path = ? and user_id = ?",
-                    (path, user_id,)
-            ).fetchone()
+@app.cli.command("sweep-sessions")
+def sweep_sessions_command():
+    """Delete the expired sessions"""
 
+    with get_directory_db() as db:
+        deleted = delete_expired(db, datetime.datetime.now())
 
-            return redirect("/create_list?list=" + str(url_id["id"]))
+    click.echo(f"Deleted {deleted} expired sessions")
 
-    return render_template("import_list.html", form=form)
 
+# The schema is brought up to date once, when the application starts,
+# so that requests never have to do any schema work
+if app.config["MIGRATE_ON_STARTUP"]:
+    with app.app_context():
+        migrate(get_directory_db())
@@ -0,0 +1,58 @@
+import hashlib
+import os
+
+# Static files are cached by browsers for a year, their URL changes with their content
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+# Content hash of the static files, by path, with the modification time it was computed for
+fingerprints = {}
+
+
+def file_hash(path):
+    """Short hash of the content of a file"""
+
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(65536), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()[:12]
+
+
+def static_version(static_folder, filename):
+    """Hash of a static file, only computed again when the file changes. None if there is no such file"""
+
+    path = os.path.join(static_folder, filename)
+
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+    cached = fingerprints.get(path)
+
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    version = file_hash(path)
+    fingerprints[path] = (mtime, version)
+
+    return version
+
+
+def folder_version(*folders):
+    """Hash of all the files of some folders, e.g. the templates and static files of a release"""
+
+    digest = hashlib.sha256()
+
+    for folder in folders:
+        digest.update(os.path.basename(folder).encode())
+
+        for root, dirs, files in sorted(os.walk(folder)):
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                digest.update(os.path.relpath(path, folder).encode())
+                digest.update(file_hash(path).encode())
+
+    return digest.hexdigest()[:12]
@@ -0,0 +1,126 @@
+"""
+Build a synthetic flashcards database for the benchmarks.
+
+    python benchmarks/generate.py bench.db --users 10 --lists 20 --cards 100 --lessons 5
+
+Every user gets the same password, PASSWORD. The data only depends on the
+scale and the seed, so two databases built with the same options are the same
+(apart from the dates, which are relative to the time of the build).
+"""
+
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from werkzeug.security import generate_password_hash
+
+from migrations import migrate
+from sync import apply_reviews
+
+PASSWORD = "benchmark"
+
+WORDS = [
+    "apple", "river", "mountain", "library", "garden", "window", "thunder", "candle", "mirror", "forest",
+    "language", "history", "planet", "engine", "harbor", "island", "market", "pencil", "silver", "winter",
+    "verb", "noun", "adjective", "capital", "equation", "molecule", "theorem", "poem", "painting", "symphony",
+]
+
+FOLDER_KEYWORDS = ["verbs", "nouns", "done", "exam", "revise"]
+
+
+def phrase(rng, length):
+    return " ".join(rng.choice(WORDS) for _ in range(length))
+
+
+def generate(path, users=10, lists=20, cards=100, lessons=5, folders=3, seed=1):
+    """Create the database at path, the schema being the one of the current migrations"""
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    rng = random.Random(seed)
+    now = datetime.datetime.now()
+    password_hash = generate_password_hash(PASSWORD, method="pbkdf2:sha256")
+
+    db = sqlite3.connect(path, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode = WAL")
+
+    migrate(db)
+
+    db.execute("BEGIN")
+
+    for user in range(1, users + 1):
+        user_id = db.execute("INSERT INTO users (username, hash) VALUES (?, ?)", (f"user{user}", password_hash)).lastrowid
+
+        folder_ids = []
+
+        for folder in range(folders):
+            folder_id = db.execute(
+                "INSERT INTO folders (name, path, keywords, user_id, creation_date) VALUES (?, '', '[]', ?, ?)",
+                (f"Folder {folder}", user_id, now)
+            ).lastrowid
+            db.execute("UPDATE folders SET path = (?) WHERE id = (?)", (f"folder_{folder}_{folder_id}", folder_id))
+            db.executemany(
+                "INSERT INTO keywords (folder_id, user_id, keyword) VALUES (?, ?, ?)",
+                [(folder_id, user_id, keyword) for keyword in FOLDER_KEYWORDS]
+            )
+            folder_ids.append(folder_id)
+
+        for list_number in range(lists):
+            created = now - datetime.timedelta(days=lessons + 1)
+
+            list_id = db.execute(
+                "INSERT INTO lists (title, description, path, user_id, creation_date) VALUES (?, ?, '', ?, ?)",
+                (phrase(rng, 2).title(), phrase(rng, 8), user_id, created)
+            ).lastrowid
+            db.execute("UPDATE lists SET path = (?) WHERE id = (?)", (f"list_{list_number}_{list_id}", list_id))
+
+            db.executemany(
+                "INSERT INTO cards (list_id, card_id, term, definition, level, position, user_id, due_at) VALUES (?, ?, ?, ?, '', ?, ?, ?)",
+                [(list_id, card, phrase(rng, 2), phrase(rng, 6), card - 1, user_id, created) for card in range(1, cards + 1)]
+            )
+
+            # Lists go in one folder out of two, with some of its keywords
+            if folder_ids and list_number % 2 == 0:
+                folder_id = rng.choice(folder_ids)
+                db.execute("INSERT INTO list_folders (list_id, folder_id) VALUES (?, ?)", (list_id, folder_id))
+                db.execute("""
+                    INSERT INTO list_keywords (list_id, keyword_id, active)
+                    SELECT ?, id, 1 FROM keywords WHERE folder_id = (?) AND keyword IN (?, ?)
+                """, (list_id, folder_id, rng.choice(FOLDER_KEYWORDS), rng.choice(FOLDER_KEYWORDS)))
+
+            # One lesson a day, every card answered
+            for lesson in range(lessons):
+                reviewed_at = now - datetime.timedelta(days=lessons - lesson)
+                apply_reviews(db, user_id, [
+                    {"key": None, "list_id": list_id, "card_id": card, "level": rng.choice(["Mastered", "Still learning"]), "reviewed_at": reviewed_at}
+                    for card in range(1, cards + 1)
+                ], now)
+
+    db.execute("COMMIT")
+    db.execute("ANALYZE")
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a synthetic flashcards database")
+    parser.add_argument("path")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--lists", type=int, default=20, help="lists per user")
+    parser.add_argument("--cards", type=int, default=100, help="cards per list")
+    parser.add_argument("--lessons", type=int, default=5, help="lessons per list, one review of every card each")
+    parser.add_argument("--folders", type=int, default=3, help="folders per user")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    generate(args.path, args.users, args.lists, args.cards, args.lessons, args.folders, args.seed)
+
+
+if __name__ == "__main__":
+    main()
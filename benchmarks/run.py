@@ -0,0 +1,256 @@
+"""
+Time the routes of the application on a synthetic database.
+
+    python benchmarks/run.py                                # default scale, compared to baseline.json
+    python benchmarks/run.py --cards 1000 --repeat 20
+    python benchmarks/run.py --save benchmarks/baseline.json
+
+Every scenario is requested --repeat times through the Flask test client, as
+the first generated user. The report gives the latency percentiles and the
+number of SQL statements the application sends per request (an executemany
+counts as one, the statements run by triggers aren't counted).
+Statement counts don't depend on the machine, latencies do: a latency is only
+reported as a regression when it is more than --tolerance slower than the
+baseline.
+"""
+
+import argparse
+import io
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import database
+from generate import PASSWORD, generate
+
+# Latency differences under this many milliseconds are noise
+MIN_DELTA = 2.0
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# SQL statements run by the current request
+statements = [0]
+
+
+def count_statement(sql, seconds):
+    statements[0] += 1
+
+
+def scenarios(app, client):
+    """(name, request) pairs, each request being a function of the iteration number"""
+
+    with app.app_context():
+        db = database.get_db()
+        list_row = db.execute("SELECT id, path FROM lists WHERE user_id = 1 ORDER BY id LIMIT 1").fetchone()
+        folder = db.execute("SELECT id, path FROM folders WHERE user_id = 1 ORDER BY id LIMIT 1").fetchone()
+        card_count = db.execute("SELECT card_count FROM lists WHERE id = (?)", (list_row["id"],)).fetchone()[0]
+
+    list_id, list_path = list_row["id"], list_row["path"]
+
+    def answers(iteration):
+        return [{"id": card, "level": "Mastered" if (card + iteration) % 3 else "Still learning"} for card in range(1, min(card_count, 20) + 1)]
+
+    def sync(iteration):
+        return {"reviews": [
+            {"key": f"bench-{iteration}-{card}", "list_id": list_id, "card_id": card, "level": "Mastered"}
+            for card in range(1, min(card_count, 20) + 1)
+        ]}
+
+    def new_list(iteration):
+        data = {"id": "/", "title": f"Bench {iteration}", "description": "", "cards-number": "10"}
+        for card in range(1, 11):
+            data[f"term_card_{card}"] = f"term {card}"
+            data[f"definition_card_{card}"] = f"definition {card}"
+        return data
+
+    def edit_list(iteration):
+        data = new_list(iteration)
+        data.update({"id": str(list_id), "title": "Edited", "cards-number": str(min(card_count, 50))})
+        for card in range(11, min(card_count, 50) + 1):
+            data[f"term_card_{card}"] = f"term {card}"
+            data[f"definition_card_{card}"] = f"definition {card} {iteration}"
+        return data
+
+    import_file = "".join(f"term {card}\tdefinition {card}\n" for card in range(200)).encode()
+
+    # Polled outside of the application, so that waiting doesn't add statements
+    jobs_db = sqlite3.connect(app.config["DATABASE"], check_same_thread=False)
+
+    def import_list(iteration):
+        # The import runs in a job, it is timed until the job is finished
+        response = client.post("/import_list", data={"file": (io.BytesIO(import_file), f"bench_{iteration}.txt")}, content_type="multipart/form-data")
+        job_id = int(response.location.rsplit("=", 1)[1])
+
+        while True:
+            status, message = jobs_db.execute("SELECT status, message FROM jobs WHERE id = (?)", (job_id,)).fetchone()
+            if status == "failed":
+                raise SystemExit("import_list failed: " + message)
+            if status not in ("queued", "running"):
+                return response
+            time.sleep(0.0005)
+
+    return [
+        ("index", lambda i: client.get("/")),
+        ("index_not_modified", lambda i: client.get("/", headers={"If-None-Match": client.get("/").headers["ETag"]})),
+        ("show_list", lambda i: client.get(f"/user/lists/{list_path}")),
+        ("show_folder", lambda i: client.get(f"/user/folders/{folder['path']}")),
+        ("show_folder_tags", lambda i: client.get(f"/user/folders/{folder['path']}?tags=verbs OR (exam AND NOT done)")),
+        ("list_cards", lambda i: client.get(f"/api/lists/{list_id}/cards?limit=50")),
+        ("list_cards_due", lambda i: client.get(f"/api/lists/{list_id}/cards?limit=50&due=1")),
+        ("folder_cards", lambda i: client.get(f"/api/folders/{folder['id']}/cards?limit=50")),
+        ("query_lists", lambda i: client.get("/api/lists/query?tags=verbs")),
+        ("search", lambda i: client.get("/api/search?q=moun")),
+        ("due", lambda i: client.get("/due")),
+        ("stats", lambda i: client.get("/api/stats?bucket=week")),
+        ("update_level", lambda i: client.post("/update_level", json={"list_id": list_id, "list_cards": answers(i)})),
+        ("sync", lambda i: client.post("/api/sync", json=sync(i))),
+        ("update_card", lambda i: client.post("/update_card", data={"list_path": list_path, "list_id": list_id, "card_id": 1, "new_term": f"term {i}", "new_definition": "definition"})),
+        ("create_list", lambda i: client.post("/create_list", data=new_list(i))),
+        ("edit_list", lambda i: client.post("/create_list", data=edit_list(i))),
+        ("import_list", import_list),
+        ("export_list", lambda i: client.get(f"/export/list/{list_id}?format=csv")),
+        ("account", lambda i: client.get("/account")),
+    ]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run(repeat, only=None):
+    """Time every scenario, returns {name: {p50, p95, p99, statements}} with latencies in ms"""
+
+    from app import app
+
+    client = app.test_client()
+    response = client.post("/login", data={"username": "user1", "password": PASSWORD})
+
+    if response.status_code != 302:
+        raise SystemExit("Can't log in as user1")
+
+    results = {}
+
+    for name, request in scenarios(app, client):
+        if only and name not in only:
+            continue
+
+        latencies, counts = [], []
+
+        for iteration in range(repeat):
+            # Flashed messages would stop pages from being cached, they are read first
+            with client.session_transaction() as session:
+                session.pop("_flashes", None)
+
+            statements[0] = 0
+            start = time.perf_counter()
+            response = request(iteration)
+            # Streamed responses are only produced when they are read
+            response.get_data()
+            response.close()
+            latencies.append((time.perf_counter() - start) * 1000)
+            counts.append(statements[0])
+
+            if response.status_code >= 400:
+                raise SystemExit(f"{name} answered {response.status_code}")
+
+        results[name] = {
+            "p50": round(percentile(latencies, 0.50), 3),
+            "p95": round(percentile(latencies, 0.95), 3),
+            "p99": round(percentile(latencies, 0.99), 3),
+            "statements": round(statistics.median(counts), 1),
+        }
+
+    return results
+
+
+def compare(results, baseline, tolerance, min_delta=MIN_DELTA):
+    """Names of the scenarios slower, or running more statements, than the baseline"""
+
+    regressions = []
+
+    for name, result in results.items():
+        reference = baseline.get(name)
+
+        if not reference:
+            continue
+
+        if result["statements"] > reference["statements"]:
+            regressions.append(f"{name}: {result['statements']} statements instead of {reference['statements']}")
+
+        # The median is compared, the tail of 30 requests is too noisy
+        if result["p50"] > reference["p50"] * (1 + tolerance) and result["p50"] - reference["p50"] > min_delta:
+            regressions.append(f"{name}: p50 {result['p50']} ms instead of {reference['p50']} ms")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the routes of the application")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--lists", type=int, default=20, help="lists per user")
+    parser.add_argument("--cards", type=int, default=100, help="cards per list")
+    parser.add_argument("--lessons", type=int, default=5, help="lessons per list")
+    parser.add_argument("--folders", type=int, default=3, help="folders per user")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=30, help="requests per scenario")
+    parser.add_argument("--only", nargs="*", help="scenarios to run")
+    parser.add_argument("--baseline", default=BASELINE, help="results to compare with")
+    parser.add_argument("--save", help="write the results to this file, e.g. to update the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="latency increase allowed, 0.5 = 50%%")
+    args = parser.parse_args()
+
+    # Paths given on the command line are relative to where the script was started
+    save = os.path.abspath(args.save) if args.save else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    workdir = tempfile.mkdtemp(prefix="reminidex-bench-")
+    path = os.path.join(workdir, "flashcards.db")
+
+    generate(path, args.users, args.lists, args.cards, args.lessons, args.folders, args.seed)
+
+    # The application reads its settings from the environment when it's imported
+    os.environ["FLASK_DATABASE"] = path
+    os.environ["FLASK_WTF_CSRF_ENABLED"] = "false"
+    os.environ["FLASK_JOBS_FOLDER"] = os.path.join(workdir, "jobs")
+    os.chdir(workdir)
+
+    database.statement_hooks.append(count_statement)
+
+    results = run(args.repeat, args.only)
+
+    print(f"{'scenario':<22}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>10}")
+    for name, result in results.items():
+        print(f"{name:<22}{result['p50']:>10}{result['p95']:>10}{result['p99']:>10}{result['statements']:>10}")
+
+    if save:
+        with open(save, "w") as file:
+            scale = {name: getattr(args, name) for name in ("users", "lists", "cards", "lessons", "folders", "seed", "repeat")}
+            json.dump({"scale": scale, "results": results}, file, indent=2)
+
+    if baseline_path and os.path.exists(baseline_path) and save != baseline_path:
+        with open(baseline_path) as file:
+            baseline = json.load(file)
+
+        if baseline["scale"]["cards"] != args.cards or baseline["scale"]["lists"] != args.lists:
+            print("\nThe baseline was recorded at another scale, latencies can't be compared")
+
+        regressions = compare(results, baseline["results"], args.tolerance)
+
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+
+        print("\nNo regression against " + baseline_path)
+
+
+if __name__ == "__main__":
+    main()
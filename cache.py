@@ -0,0 +1,121 @@
+"""
+In-process cache of the data behind the pages: dashboards, folders, lists and usernames.
+
+Every entry is kept with the version counter it was read at (users.version,
+lists.version), which the triggers bump on every write. A page reads the
+version anyway for its ETag, so a stale entry, written by another process
+or another worker, is a miss and is loaded again.
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+
+# Memory the entries may take, in bytes (estimated)
+MAX_BYTES = 32 * 1024 * 1024
+
+
+def sizeof(value):
+    """Estimated memory taken by a value made of dicts, lists, tuples and scalars"""
+
+    size = sys.getsizeof(value)
+
+    if isinstance(value, dict):
+        size += sum(sizeof(key) + sizeof(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(sizeof(item) for item in value)
+
+    return size
+
+
+class VersionedCache:
+    """
+    Least recently used entries, evicted once they take more than max_bytes.
+
+    Keys are tuples starting with the user id, so that all the entries of a
+    user can be dropped at once. Cached values are shared between requests
+    and must not be modified.
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, version, load):
+        """The value of key at version, from load() if it isn't cached at that version"""
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+
+        value = load()
+        self.put(key, version, value)
+        return value
+
+    def put(self, key, version, value):
+        size = sizeof(value)
+
+        # An entry that doesn't fit would only evict all the others
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+
+            self.entries[key] = (version, value, size)
+            self.bytes += size
+
+            while self.bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, *prefix):
+        """Drop the entries whose key starts with prefix, e.g. (user_id,) for all the entries of a user"""
+
+        with self.lock:
+            for key in [key for key in self.entries if key[:len(prefix)] == prefix]:
+                self.bytes -= self.entries.pop(key)[2]
+                self.invalidations += 1
+
+    def stats(self):
+        """Counters of the cache"""
+
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+def init_app(app):
+    """Create the cache of the application"""
+
+    cache = VersionedCache(app.config.get("CACHE_MAX_BYTES", MAX_BYTES))
+    app.extensions["cache"] = cache
+    return cache
+
+
+def get_cache():
+    return current_app.extensions["cache"]
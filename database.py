@@ -0,0 +1,316 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from flask import current_app, g, session
+
+from migrations import migrate
+
+# Applied once, when a connection is opened
+PRAGMAS = [
+    # Readers don't block the writer and the writer doesn't block readers
+    "PRAGMA journal_mode = WAL",
+    # Safe with WAL, only the last commits can be lost on power failure
+    "PRAGMA synchronous = NORMAL",
+    # Page cache of about 8 MB per connection
+    "PRAGMA cache_size = -8000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+]
+
+POOL_SIZE = 8
+
+# Connections kept open to each user's database, when every user has their own
+SHARD_POOL_SIZE = 2
+
+# Functions called with (sql, seconds) after every statement, see metrics.py
+statement_hooks = []
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection reporting the duration of its statements to the statement hooks"""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            report_statement(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            report_statement(sql, time.perf_counter() - start)
+
+
+def report_statement(sql, seconds):
+    for hook in statement_hooks:
+        hook(sql, seconds)
+
+
+class ConnectionPool:
+    """Keep SQLite connections open and lend them to requests and threads"""
+
+    def __init__(self, database, size=POOL_SIZE):
+        self.database = database
+        self.idle = queue.LifoQueue(maxsize=size)
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.closed = 0
+        self.in_use = 0
+
+    def connect(self):
+        """Open a new connection and tune it"""
+
+        db = sqlite3.connect(self.database, timeout=30, check_same_thread=False, factory=TimedConnection)
+        db.row_factory = sqlite3.Row
+
+        for pragma in PRAGMAS:
+            db.execute(pragma)
+
+        return db
+
+    def acquire(self):
+        """Get an idle connection, or open one if there is none"""
+
+        try:
+            db = self.idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            db = self.connect()
+            reused = False
+
+        with self.lock:
+            self.in_use += 1
+            if reused:
+                self.reused += 1
+            else:
+                self.created += 1
+
+        return db
+
+    def release(self, db):
+        """Give a connection back to the pool, or close it if the pool is full"""
+
+        # Never hand over a connection in the middle of a transaction
+        if db.in_transaction:
+            db.rollback()
+
+        try:
+            self.idle.put_nowait(db)
+            closed = False
+        except queue.Full:
+            db.close()
+            closed = True
+
+        with self.lock:
+            self.in_use -= 1
+            if closed:
+                self.closed += 1
+
+    def stats(self):
+        """Usage counters of the pool"""
+
+        with self.lock:
+            return {
+                "database": self.database,
+                "size": self.idle.maxsize,
+                "idle": self.idle.qsize(),
+                "in_use": self.in_use,
+                "created": self.created,
+                "reused": self.reused,
+                "closed": self.closed,
+            }
+
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(database=None, size=POOL_SIZE):
+    """Get the pool of a database, the configured one by default"""
+
+    if database is None:
+        database = current_app.config["DATABASE"]
+
+    with pools_lock:
+        if database not in pools:
+            pools[database] = ConnectionPool(database, size)
+        return pools[database]
+
+
+class SharedBackend:
+    """Every user's data in the one database of the DATABASE setting"""
+
+    sharded = False
+
+    def __init__(self, database):
+        self.database = database
+
+    def database_for(self, user_id):
+        return self.database
+
+    def delete_user(self, user_id):
+        pass
+
+
+class ShardedBackend:
+    """
+    The data of every user in a SQLite file of their own, so that users never wait on each other's writes.
+
+    The database of the DATABASE setting is the directory: it keeps the
+    accounts and the sessions, looked up before the user is known. A user's
+    file is created and migrated the first time it's used, with a copy of
+    their users row that the version counters of their pages are kept on.
+    """
+
+    sharded = True
+
+    def __init__(self, database, folder):
+        self.database = database
+        self.folder = folder
+        self.ready = set()
+        self.lock = threading.Lock()
+
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, user_id):
+        return os.path.join(self.folder, f"user-{int(user_id)}.db")
+
+    def database_for(self, user_id):
+        path = self.path(user_id)
+
+        if path not in self.ready:
+            with self.lock:
+                if path not in self.ready:
+                    self.prepare(path, user_id)
+                    self.ready.add(path)
+
+        return path
+
+    def prepare(self, path, user_id):
+        """Bring the schema of a user's database up to date and copy their users row into it"""
+
+        directory_pool = get_pool(self.database)
+        directory = directory_pool.acquire()
+        try:
+            user = directory.execute("SELECT id, username FROM users WHERE id = (?)", (user_id,)).fetchone()
+        finally:
+            directory_pool.release(directory)
+
+        pool = get_pool(path, SHARD_POOL_SIZE)
+        db = pool.acquire()
+        try:
+            migrate(db)
+
+            if user:
+                with db:
+                    db.execute("INSERT OR IGNORE INTO users (id, username, hash) VALUES (?, ?, '')", (user["id"], user["username"]))
+        finally:
+            pool.release(db)
+
+    def delete_user(self, user_id):
+        """Delete the database of a user whose account was deleted"""
+
+        path = self.path(user_id)
+
+        with self.lock:
+            self.ready.discard(path)
+
+            with pools_lock:
+                pool = pools.pop(path, None)
+
+            while pool is not None and not pool.idle.empty():
+                pool.idle.get_nowait().close()
+
+            for file in (path, path + "-wal", path + "-shm"):
+                if os.path.exists(file):
+                    os.remove(file)
+
+
+def storage_backend(app):
+    """Storage backend of a STORAGE_BACKEND setting: "shared" (one database) or "sharded" (one database per user)"""
+
+    backend = app.config.get("STORAGE_BACKEND", "shared")
+
+    if backend == "shared":
+        return SharedBackend(app.config["DATABASE"])
+    if backend == "sharded":
+        return ShardedBackend(app.config["DATABASE"], app.config.get("STORAGE_FOLDER") or os.path.join(app.instance_path, "users"))
+
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+backends_lock = threading.Lock()
+
+
+def get_backend():
+    """Storage backend of the application, made on first use"""
+
+    app = current_app._get_current_object()
+
+    with backends_lock:
+        if "storage" not in app.extensions:
+            app.extensions["storage"] = storage_backend(app)
+        return app.extensions["storage"]
+
+
+def get_db():
+    """
+    Connexion to the database of the current user's data.
+
+    The same connection is used for the whole application context (a request,
+    or a background thread that pushed its own context) and goes back to the
+    pool when the context ends. With the sharded backend, the user is the one
+    of g.user_id (set by jobs and commands) or of the session.
+    """
+
+    if "db" not in g:
+        backend = get_backend()
+
+        if backend.sharded:
+            user_id = g.get("user_id") or session.get("user_id")
+
+            if user_id is None:
+                raise RuntimeError("No user to open the database of")
+
+            g.db_pool = get_pool(backend.database_for(user_id), SHARD_POOL_SIZE)
+        else:
+            g.db_pool = get_pool(backend.database)
+
+        g.db = g.db_pool.acquire()
+    return g.db
+
+
+def get_directory_db():
+    """
+    Connexion to the database of the accounts and sessions.
+
+    It's the connection of get_db() when all the users share one database.
+    """
+
+    backend = get_backend()
+
+    if not backend.sharded:
+        return get_db()
+
+    if "directory_db" not in g:
+        g.directory_db = get_pool(backend.database).acquire()
+    return g.directory_db
+
+
+def close_db(error=None):
+    """Give the connections of the request back to their pools"""
+
+    db = g.pop("db", None)
+    if db is not None:
+        g.pop("db_pool").release(db)
+
+    directory_db = g.pop("directory_db", None)
+    if directory_db is not None:
+        get_pool(get_backend().database).release(directory_db)
@@ -0,0 +1,81 @@
+import csv
+import io
+import json
+
+# Rows fetched from the database (and written to the response) at a time
+CHUNK_SIZE = 500
+
+FORMATS = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+}
+
+
+def export_csv(db, list_ids):
+    """
+    Yield the cards of the lists as CSV, in the import_list format.
+
+    The first two columns are the term and the definition, so an export can
+    be imported again as a single list.
+    """
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(["term", "definition", "level", "list"])
+
+    for list_id in list_ids:
+        title = db.execute("SELECT title FROM lists WHERE id = (?)", (list_id,)).fetchone()["title"]
+
+        for rows in _chunks(db.execute(
+            "SELECT term, definition, level FROM cards WHERE list_id = (?) ORDER BY position", (list_id,)
+        )):
+            writer.writerows((row["term"], row["definition"], row["level"], title) for row in rows)
+            yield _drain(buffer)
+
+    yield _drain(buffer)
+
+
+def export_jsonl(db, list_ids, folders=()):
+    """Yield the folders, lists, cards and review history as JSON lines, one record per line"""
+
+    for folder in folders:
+        yield _line("folder", folder)
+
+    for list_id in list_ids:
+        row = db.execute(
+            "SELECT id, title, description, path, creation_date FROM lists WHERE id = (?)", (list_id,)
+        ).fetchone()
+
+        yield _line("list", row)
+
+        for rows in _chunks(db.execute(
+            "SELECT list_id, card_id, term, definition, level, position, due_at FROM cards WHERE list_id = (?) ORDER BY position",
+            (list_id,)
+        )):
+            yield "".join(_line("card", row) for row in rows)
+
+        for rows in _chunks(db.execute(
+            "SELECT list_id, card_id, outcome, review_date FROM reviews WHERE list_id = (?) ORDER BY id",
+            (list_id,)
+        )):
+            yield "".join(_line("review", row) for row in rows)
+
+
+def _chunks(cursor):
+    while True:
+        rows = cursor.fetchmany(CHUNK_SIZE)
+        if not rows:
+            return
+        yield rows
+
+
+def _drain(buffer):
+    data = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return data
+
+
+def _line(record_type, row):
+    return json.dumps({"type": record_type, **dict(row)}, default=str) + "\n"
@@ -1,5 +1,6 @@
+import hmac
 
-from flask import redirect, session
+from flask import Response, abort, current_app, redirect, request, session
 from functools import wraps
 
 def login_required(f):
@@ -18,5 +19,23 @@ def login_required(f):
     return decorated_function
 
 
+def operator_required(f):
+    """
+    Decorate routes only operators can see, with the METRICS_TOKEN setting as a bearer token.
+
+    Without a token set, the routes answer 404.
+    """
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = current_app.config.get("METRICS_TOKEN")
+
+        if not token:
+            abort(404)
 
+        if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+            return Response("Unauthorized\n", status=401, mimetype="text/plain")
 
+        return f(*args, **kwargs)
+
+    return decorated_function
@@ -0,0 +1,144 @@
+import csv
+import html
+import io
+import re
+
+# Defaults, overridden by the IMPORT_MAX_ROWS and IMPORT_BATCH_SIZE settings
+MAX_ROWS = 100000
+BATCH_SIZE = 1000
+
+# Number of malformed line numbers kept for the report
+MAX_REPORTED_ROWS = 10
+
+TAG = re.compile(r"<[^>]+>")
+
+# Separators written by Anki in its "#separator:" header
+ANKI_SEPARATORS = {"tab": "\t", "comma": ",", "semicolon": ";", "pipe": "|", "space": " ", "colon": ":"}
+
+
+class ImportFileError(ValueError):
+    """The uploaded file can't be imported"""
+
+
+class ImportResult:
+    """Summary of an import"""
+
+    def __init__(self):
+        self.imported = 0
+        self.malformed = 0
+        self.malformed_lines = []
+
+    def skip(self, line):
+        self.malformed += 1
+        if len(self.malformed_lines) < MAX_REPORTED_ROWS:
+            self.malformed_lines.append(line)
+
+
+def read_rows(stream, filename, result):
+    """
+    Yield (line, term, definition) tuples from an uploaded file, one line at a time.
+
+    - .csv files are comma separated and start with a header row (the format
+      of the original importer), unless their first line contains tabs only
+    - .tsv and .txt files are tab separated without header, like the Quizlet
+      and Anki exports. Anki "#key:value" header lines are understood.
+    """
+
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", errors="replace", newline="")
+
+    extension = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+
+    first_line = text.readline()
+    skipped_lines = 0
+
+    delimiter = "\t" if extension != "csv" or ("\t" in first_line and "," not in first_line) else ","
+    has_header = extension == "csv" and delimiter == ","
+    strip_html = False
+
+    # Anki exports start with "#separator:tab", "#html:true", ... lines
+    while first_line.startswith("#") and ":" in first_line:
+        key, value = first_line[1:].strip().split(":", 1)
+        if key == "separator":
+            delimiter = ANKI_SEPARATORS.get(value.lower(), value[:1] or delimiter)
+        elif key == "html":
+            strip_html = value == "true"
+        first_line = text.readline()
+        skipped_lines += 1
+
+    if has_header:
+        skipped_lines += 1
+    else:
+        text = _prepend(first_line, text)
+
+    reader = csv.reader(text, delimiter=delimiter)
+
+    for row in reader:
+        line = skipped_lines + reader.line_num
+
+        if not any(field.strip() for field in row):
+            continue
+
+        if len(row) < 2 or not (row[0].strip() or row[1].strip()):
+            result.skip(line)
+            continue
+
+        term, definition = row[0].strip(), row[1].strip()
+
+        if strip_html:
+            term = html.unescape(TAG.sub("", term))
+            definition = html.unescape(TAG.sub("", definition))
+
+        yield line, term, definition
+
+
+def _prepend(first_line, lines):
+    yield first_line
+    yield from lines
+
+
+def import_cards(db, list_id, user_id, rows, result, now, max_rows=MAX_ROWS, batch_size=BATCH_SIZE, on_batch=None, insert=None):
+    """
+    Insert the cards of an import in batches.
+
+    Runs inside the caller's transaction, unless insert(batch) is given to
+    store the batches instead (the import jobs hand them to the writer
+    thread). on_batch, if given, is called after every batch (e.g. to report
+    progress). When the batches are committed as they go, an error leaves
+    the ones committed so far and the caller has to delete the partial list.
+    """
+
+    if insert is None:
+        insert = lambda batch: insert_cards(db, batch)
+
+    batch = []
+
+    for line, term, definition in rows:
+
+        if result.imported >= max_rows:
+            raise ImportFileError(f"This file has more than {max_rows} cards")
+
+        result.imported += 1
+
+        batch.append((list_id, result.imported, term, definition, "", result.imported - 1, user_id, now))
+
+        if len(batch) >= batch_size:
+            insert(batch)
+            batch = []
+
+            if on_batch:
+                on_batch()
+
+    if batch:
+        insert(batch)
+
+    if result.imported == 0:
+        raise ImportFileError("No card found in this file")
+
+    return result
+
+
+def insert_cards(db, batch):
+    db.executemany(
+        "INSERT INTO cards (list_id, card_id, term, definition, level, position, user_id, due_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        batch
+    )
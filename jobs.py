@@ -0,0 +1,241 @@
+import datetime
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, g
+
+from database import get_db
+
+# Jobs running at once in a process, and unfinished jobs a user can have
+WORKERS = 2
+PER_USER = 2
+
+# Unfinished jobs not heard of for this long were lost with their process (a restart, a crash)
+STALE_AFTER = datetime.timedelta(minutes=10)
+
+# Finished jobs, and the files they made, are deleted after this long
+KEEP_FINISHED = datetime.timedelta(days=1)
+
+logger = logging.getLogger("reminidex.jobs")
+
+# Functions run by the jobs, by kind, see handler()
+handlers = {}
+
+
+class JobError(ValueError):
+    """A job can't be started"""
+
+
+class JobCancelled(Exception):
+    """The user cancelled the job"""
+
+
+def handler(kind):
+    """Register the function running the jobs of a kind, called with (job, payload) and returning the result"""
+
+    def register(function):
+        handlers[kind] = function
+        return function
+
+    return register
+
+
+class Job:
+    """What a running job's handler sees of it"""
+
+    def __init__(self, db, id, user_id, folder):
+        self.db = db
+        self.id = id
+        self.user_id = user_id
+        self.folder = folder
+
+    def progress(self, done, total=None):
+        """
+        Report the progress of the job and commit the work done so far.
+
+        Raises JobCancelled when the user has cancelled the job, the handler
+        should clean up and let it propagate.
+        """
+
+        with self.db:
+            self.db.execute(
+                "UPDATE jobs SET progress = (?), total = COALESCE((?), total), updated_at = (?) WHERE id = (?)",
+                (done, total, datetime.datetime.now(), self.id)
+            )
+
+        row = self.db.execute("SELECT cancel_requested FROM jobs WHERE id = (?)", (self.id,)).fetchone()
+
+        if row["cancel_requested"]:
+            raise JobCancelled()
+
+
+class JobRunner:
+    """
+    Run the jobs of the application in a pool of threads.
+
+    The state of every job is in the jobs table, so any process can answer
+    the status requests. A job only runs in the process it was submitted to:
+    the ones lost in a restart are marked failed once they are stale.
+    """
+
+    def __init__(self, app, workers=WORKERS, per_user=PER_USER, folder=None):
+        self.app = app
+        self.per_user = per_user
+        self.folder = folder or os.path.join(app.instance_path, "jobs")
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="job")
+
+        os.makedirs(self.folder, exist_ok=True)
+
+    def path(self, name):
+        """Path of a file in the jobs folder, for uploads and results"""
+
+        return os.path.join(self.folder, name)
+
+    def submit(self, user_id, kind, payload):
+        """Queue a job of the user, returns its id or raises JobError if they already have too many"""
+
+        if kind not in handlers:
+            raise JobError(f"Unknown job: {kind}")
+
+        now = datetime.datetime.now()
+
+        with get_db() as db:
+            recover(db, now)
+
+            # Checked and inserted in one statement, so that two requests can't both pass the check
+            cursor = db.execute("""
+                INSERT INTO jobs (user_id, kind, payload, created_at, updated_at)
+                SELECT ?, ?, ?, ?, ?
+                WHERE (SELECT COUNT(*) FROM jobs WHERE user_id = (?) AND status IN ('queued', 'running')) < (?)
+            """, (user_id, kind, json.dumps(payload), now, now, user_id, self.per_user))
+
+        if not cursor.rowcount:
+            raise JobError(f"You can't have more than {self.per_user} jobs running at once, wait for one to finish")
+
+        self.executor.submit(self.run, cursor.lastrowid, user_id)
+
+        return cursor.lastrowid
+
+    def run(self, job_id, user_id):
+        with self.app.app_context():
+            # The database of the user, when every user has their own
+            g.user_id = user_id
+
+            db = get_db()
+            now = datetime.datetime.now()
+
+            with db:
+                # A job cancelled while it was queued doesn't start
+                started = db.execute(
+                    "UPDATE jobs SET status = 'running', updated_at = (?) WHERE id = (?) AND status = 'queued'", (now, job_id)
+                ).rowcount
+
+            if not started:
+                return
+
+            row = db.execute("SELECT * FROM jobs WHERE id = (?)", (job_id,)).fetchone()
+            status, message, result = "done", None, None
+
+            try:
+                result = handlers[row["kind"]](Job(db, job_id, row["user_id"], self.folder), json.loads(row["payload"]))
+            except JobCancelled:
+                status, message = "cancelled", "Cancelled"
+            except ValueError as error:
+                # Errors of the input (a malformed file...) are shown to the user
+                status, message = "failed", str(error)
+            except Exception:
+                logger.exception("Job %s failed", job_id)
+                status, message = "failed", "Unexpected error, the job was stopped"
+            finally:
+                if db.in_transaction:
+                    db.rollback()
+
+            now = datetime.datetime.now()
+
+            with db:
+                db.execute(
+                    "UPDATE jobs SET status = (?), message = (?), result = (?), updated_at = (?), finished_at = (?) WHERE id = (?)",
+                    (status, message, json.dumps(result) if result is not None else None, now, now, job_id)
+                )
+
+
+def init_app(app):
+    """Start the job runner of the application"""
+
+    runner = JobRunner(
+        app,
+        workers=app.config.get("JOBS_WORKERS", WORKERS),
+        per_user=app.config.get("JOBS_PER_USER", PER_USER),
+        folder=app.config.get("JOBS_FOLDER"),
+    )
+    app.extensions["jobs"] = runner
+    return runner
+
+
+def get_runner():
+    return current_app.extensions["jobs"]
+
+
+def recover(db, now):
+    """Mark the stale jobs failed and delete the old finished ones with their files, in the caller's transaction"""
+
+    db.execute("""
+        UPDATE jobs SET status = 'failed', message = 'The job was interrupted', finished_at = (?)
+        WHERE status IN ('queued', 'running') AND updated_at < (?)
+    """, (now, now - STALE_AFTER))
+
+    old = db.execute(
+        "SELECT id, payload, result FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND finished_at < (?)", (now - KEEP_FINISHED,)
+    ).fetchall()
+
+    for row in old:
+        # The upload of a job that never ran, the file an export made
+        for file in (json.loads(row["payload"]).get("upload"), json.loads(row["result"] or "{}").get("file")):
+            if file and os.path.exists(file):
+                os.remove(file)
+
+    db.executemany("DELETE FROM jobs WHERE id = (?)", [(row["id"],) for row in old])
+
+
+def to_json(row):
+    """Job row as given to the pages polling it, without its payload and file paths"""
+
+    result = json.loads(row["result"]) if row["result"] else None
+
+    if result:
+        result.pop("file", None)
+
+    return {
+        "id": row["id"],
+        "kind": row["kind"],
+        "status": row["status"],
+        "progress": row["progress"],
+        "total": row["total"],
+        "message": row["message"],
+        "result": result,
+        "created_at": row["created_at"],
+        "finished_at": row["finished_at"],
+    }
+
+
+def recent_jobs(db, user_id, limit=20):
+    """Latest jobs of a user, newest first"""
+
+    return db.execute("SELECT * FROM jobs WHERE user_id = (?) ORDER BY id DESC LIMIT (?)", (user_id, limit)).fetchall()
+
+
+def get_job(db, job_id, user_id):
+    return db.execute("SELECT * FROM jobs WHERE id = (?) AND user_id = (?)", (job_id, user_id)).fetchone()
+
+
+def cancel(db, job_id, user_id):
+    """Ask a job to stop, a queued job is cancelled at once. Returns False if it was already finished"""
+
+    return db.execute("""
+        UPDATE jobs SET cancel_requested = 1,
+            status = CASE status WHEN 'queued' THEN 'cancelled' ELSE status END,
+            finished_at = CASE status WHEN 'queued' THEN (?) ELSE finished_at END
+        WHERE id = (?) AND user_id = (?) AND status IN ('queued', 'running')
+    """, (datetime.datetime.now(), job_id, user_id)).rowcount > 0
@@ -0,0 +1,194 @@
+import json
+import logging
+import threading
+import time
+
+from flask import g, has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+
+import database
+
+# Upper bounds of the histogram buckets
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+SQL_BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1]
+SIZE_BUCKETS = [1024, 4096, 16384, 65536, 262144, 1048576, 4194304]
+
+# Requests slower than this many seconds are logged, unless SLOW_REQUEST_SECONDS says otherwise
+SLOW_REQUEST_SECONDS = 0.5
+
+logger = logging.getLogger("reminidex.requests")
+
+
+class Histogram:
+    """Counts of observed values by bucket, with their sum, by label values"""
+
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        counts, total = self.series.get(label_values, ([0] * (len(self.buckets) + 1), 0))
+
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        else:
+            counts[-1] += 1
+
+        self.series[label_values] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+
+        for label_values, (counts, total) in sorted(self.series.items()):
+            labels = _labels(self.labels, label_values)
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + ["+Inf"], counts):
+                cumulative += count
+                le = _labels(["le"], [bound])
+                lines.append(f"{self.name}_bucket{_join(labels, le)} {cumulative}")
+
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+
+        return lines
+
+
+class Counter:
+    """Totals by label values"""
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}
+
+    def inc(self, *label_values, value=1):
+        self.series[label_values] = self.series.get(label_values, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels(self.labels, label_values)} {value}" for label_values, value in sorted(self.series.items())]
+        return lines
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _join(labels, more):
+    return "{" + ",".join(part.strip("{}") for part in (labels, more) if part) + "}"
+
+
+class Metrics:
+    """
+    Request, SQL and JSON metrics of one process.
+
+    Every gunicorn worker keeps its own, a scrape sees the worker that answered it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = Counter("http_requests_total", "Requests by route, method and status", ["endpoint", "method", "status"])
+        self.latency = Histogram("http_request_duration_seconds", "Time spent answering requests", ["endpoint"], LATENCY_BUCKETS)
+        self.size = Histogram("http_response_size_bytes", "Size of the responses with a known length", ["endpoint"], SIZE_BUCKETS)
+        self.statements = Counter("sql_statements_total", "SQL statements run through get_db, by route", ["endpoint"])
+        self.sql_time = Histogram("sql_statement_duration_seconds", "Time spent executing SQL statements, by route", ["endpoint"], SQL_BUCKETS)
+        self.json_time = Histogram("json_decode_duration_seconds", "Time spent decoding JSON request bodies", ["endpoint"], SQL_BUCKETS)
+
+    def render(self, pool_stats=None, writer_stats=None, cache_stats=None):
+        """Metrics in the Prometheus text format"""
+
+        with self.lock:
+            lines = []
+            for metric in (self.requests, self.latency, self.size, self.statements, self.sql_time, self.json_time):
+                lines += metric.render()
+
+        for prefix, stats in (("db_pool", pool_stats), ("db_writer", writer_stats), ("cache", cache_stats)):
+            for name, value in (stats or {}).items():
+                if isinstance(value, (int, float)):
+                    lines += [f"# TYPE {prefix}_{name} gauge", f"{prefix}_{name} {value}"]
+
+        return "\n".join(lines) + "\n"
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Time the decoding of JSON request bodies"""
+
+    def loads(self, s, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().loads(s, **kwargs)
+        finally:
+            if has_request_context():
+                g.json_seconds = g.get("json_seconds", 0) + time.perf_counter() - start
+
+
+def init_app(app, metrics=None):
+    """Record the metrics of every request of the application"""
+
+    metrics = metrics or Metrics()
+    app.extensions["metrics"] = metrics
+    app.json = TimedJSONProvider(app)
+
+    def record_statement(sql, seconds):
+        if has_request_context() and "request_start" in g:
+            g.sql_count += 1
+            g.sql_seconds += seconds
+            with metrics.lock:
+                metrics.sql_time.observe(seconds, request.endpoint or "unknown")
+
+    database.statement_hooks.append(record_statement)
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        g.sql_count = 0
+        g.sql_seconds = 0
+
+    @app.after_request
+    def record_request(response):
+        if "request_start" not in g:
+            return response
+
+        seconds = time.perf_counter() - g.request_start
+        endpoint = request.endpoint or "unknown"
+        size = response.content_length if not response.is_streamed else None
+
+        with metrics.lock:
+            metrics.requests.inc(endpoint, request.method, response.status_code)
+            metrics.latency.observe(seconds, endpoint)
+            metrics.statements.inc(endpoint, value=g.sql_count)
+            if size is not None:
+                metrics.size.observe(size, endpoint)
+            if "json_seconds" in g:
+                metrics.json_time.observe(g.json_seconds, endpoint)
+
+        if seconds >= app.config.get("SLOW_REQUEST_SECONDS", SLOW_REQUEST_SECONDS):
+            logger.warning(json.dumps({
+                "event": "slow_request",
+                "endpoint": endpoint,
+                "method": request.method,
+                "path": request.path,
+                "status": response.status_code,
+                "duration_ms": round(seconds * 1000, 1),
+                "sql_count": g.sql_count,
+                "sql_ms": round(g.sql_seconds * 1000, 1),
+                "json_ms": round(g.get("json_seconds", 0) * 1000, 1),
+                "size": size,
+            }))
+
+        return response
+
+    return metrics
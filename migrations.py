@@ -0,0 +1,530 @@
+import datetime
+import itertools
+import json
+
+from scheduler import LEVELS, replay
+
+# Database tables:
+# users(id, username, hash, version)
+# lists(id, title, description, cards, folders, keywords, path, user_id, creation_date, card_count, mastered_count, version)
+# cards(id, list_id, card_id, term, definition, level, position, user_id, ease, interval, repetitions, due_at)
+# folders(id, name, path, keywords, user_id, creation_date)
+# reviews(id, card_id, list_id, user_id, outcome, review_date, client_key)
+# list_folders(list_id, folder_id)
+# keywords(id, folder_id, user_id, keyword)
+# list_keywords(list_id, keyword_id, active)
+# cards_fts(term, definition), lists_fts(title, description): FTS5 indexes of cards and lists
+# sessions(id, data, expires_at)
+# daily_stats(list_id, day, user_id, reviewed, mastered, still_learning, streak)
+# jobs(id, user_id, kind, status, payload, progress, total, message, result, cancel_requested, created_at, updated_at, finished_at)
+# retention_models(user_id, initial_stability, growth, target_retention, reviews, log_loss, fitted_at)
+#
+# users.version and lists.version are bumped by triggers whenever something
+# shown on the dashboard / folder pages or on the list page changes.
+#
+# The version of the schema is stored in PRAGMA user_version, every step of
+# MIGRATIONS brings the database one version further. Steps only ever get
+# appended to the list, never edited.
+
+
+def create_tables(db):
+    """Initial schema of the application"""
+
+    db.execute("""CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        username TEXT NOT NULL,
+        hash TEXT NOT NULL
+    )""")
+    db.execute("""CREATE TABLE IF NOT EXISTS lists (
+        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        title TEXT NOT NULL,
+        description TEXT NOT NULL,
+        cards TEXT,
+        folders TEXT,
+        keywords TEXT,
+        path TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        creation_date DATE NOT NULL
+    )""")
+    db.execute("""CREATE TABLE IF NOT EXISTS folders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        name TEXT NOT NULL,
+        path TEXT NOT NULL,
+        keywords TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        creation_date DATE NOT NULL
+    )""")
+    db.execute("""CREATE TABLE IF NOT EXISTS lessons (
+        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        cards TEXT NOT NULL,
+        list_id TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        lesson_date DATE NOT NULL
+    )""")
+
+
+def migrate_cards(db):
+    """Move the cards stored in the lists.cards JSON column to the cards table"""
+
+    db.execute("""CREATE TABLE IF NOT EXISTS cards (
+        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        list_id INTEGER NOT NULL,
+        card_id INTEGER NOT NULL,
+        term TEXT NOT NULL,
+        definition TEXT NOT NULL,
+        level TEXT NOT NULL DEFAULT '',
+        position INTEGER NOT NULL
+    )""")
+    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS cards_list_id_card_id ON cards (list_id, card_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS cards_list_id_position ON cards (list_id, position)")
+
+    rows = db.execute("SELECT id, cards FROM lists WHERE cards IS NOT NULL").fetchall()
+
+    for row in rows:
+        cards = json.loads(row["cards"])
+
+        db.executemany(
+            "INSERT OR IGNORE INTO cards (list_id, card_id, term, definition, level, position) VALUES (?, ?, ?, ?, ?, ?)",
+            [(row["id"], int(card["id"]), card["term"] or "", card["definition"] or "", card.get("level") or "", position)
+             for position, card in enumerate(cards)]
+        )
+
+        # The JSON blob is emptied once its cards have been copied
+        db.execute("UPDATE lists SET cards = NULL WHERE id = (?)", (row["id"],))
+
+
+def migrate_lessons(db):
+    """Turn the deck snapshots of the lessons table into one review per answered card"""
+
+    db.execute("""CREATE TABLE IF NOT EXISTS reviews (
+        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        card_id INTEGER NOT NULL,
+        list_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        outcome INTEGER NOT NULL,
+        review_date DATE NOT NULL
+    )""")
+    db.execute("CREATE INDEX IF NOT EXISTS reviews_list_id_user_id ON reviews (list_id, user_id, outcome)")
+
+    table = db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'lessons'").fetchone()
+
+    if not table:
+        return
+
+    lessons = db.execute("SELECT * FROM lessons ORDER BY lesson_date").fetchall()
+
+    for lesson in lessons:
+        cards = json.loads(lesson["cards"])
+
+        db.executemany(
+            "INSERT INTO reviews (card_id, list_id, user_id, outcome, review_date) VALUES (?, ?, ?, ?, ?)",
+            [(int(card["id"]), int(lesson["list_id"]), lesson["user_id"], LEVELS[card["level"]], lesson["lesson_date"])
+             for card in cards if card.get("level") in LEVELS]
+        )
+
+    db.execute("DROP TABLE lessons")
+
+
+def migrate_schedule(db):
+    """Add the scheduling state to the cards table and seed it from the past reviews"""
+
+    columns = [row["name"] for row in db.execute("PRAGMA table_info(cards)").fetchall()]
+
+    if "due_at" not in columns:
+        db.execute("ALTER TABLE cards ADD COLUMN user_id INTEGER")
+        db.execute("ALTER TABLE cards ADD COLUMN ease REAL NOT NULL DEFAULT 2.5")
+        db.execute("ALTER TABLE cards ADD COLUMN interval REAL NOT NULL DEFAULT 0")
+        db.execute("ALTER TABLE cards ADD COLUMN repetitions INTEGER NOT NULL DEFAULT 0")
+        db.execute("ALTER TABLE cards ADD COLUMN due_at DATE")
+
+    db.execute("CREATE INDEX IF NOT EXISTS cards_user_id_due_at ON cards (user_id, due_at)")
+
+    now = datetime.datetime.now()
+
+    db.execute("""
+        UPDATE cards SET user_id = (SELECT user_id FROM lists WHERE lists.id = cards.list_id)
+        WHERE due_at IS NULL
+    """)
+
+    # Last answer of each day for every card that has never been scheduled
+    reviews = db.execute("""
+        SELECT reviews.list_id, reviews.card_id, reviews.outcome, DATE(reviews.review_date) AS review_day, MAX(reviews.id)
+        FROM reviews JOIN cards ON cards.list_id = reviews.list_id AND cards.card_id = reviews.card_id
+        WHERE cards.due_at IS NULL
+        GROUP BY reviews.list_id, reviews.card_id, review_day
+        ORDER BY reviews.list_id, reviews.card_id, review_day
+    """).fetchall()
+
+    states = []
+
+    for (list_id, card_id), card_reviews in itertools.groupby(reviews, key=lambda r: (r["list_id"], r["card_id"])):
+        history = [(r["outcome"] == 1, datetime.datetime.fromisoformat(r["review_day"])) for r in card_reviews]
+        states.append(replay(history, now) + (list_id, card_id))
+
+    db.executemany(
+        "UPDATE cards SET ease = (?), interval = (?), repetitions = (?), due_at = (?) WHERE list_id = (?) AND card_id = (?)",
+        states
+    )
+
+    # Cards never studied are due right away
+    db.execute("UPDATE cards SET due_at = (?) WHERE due_at IS NULL", (now,))
+
+
+def create_indexes(db):
+    """Index the lookups made by the routes"""
+
+    db.execute("CREATE INDEX IF NOT EXISTS users_username ON users (username)")
+    db.execute("CREATE INDEX IF NOT EXISTS lists_user_id ON lists (user_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS lists_path ON lists (path)")
+    db.execute("CREATE INDEX IF NOT EXISTS folders_user_id ON folders (user_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS folders_path ON folders (path)")
+
+
+def add_card_counts(db):
+    """Keep the number of cards and of mastered cards of every list up to date"""
+
+    db.execute("ALTER TABLE lists ADD COLUMN card_count INTEGER NOT NULL DEFAULT 0")
+    db.execute("ALTER TABLE lists ADD COLUMN mastered_count INTEGER NOT NULL DEFAULT 0")
+
+    db.execute("""
+        UPDATE lists SET
+            card_count = (SELECT COUNT(*) FROM cards WHERE cards.list_id = lists.id),
+            mastered_count = (SELECT COUNT(*) FROM cards WHERE cards.list_id = lists.id AND cards.level = 'Mastered')
+    """)
+
+    # The counters are maintained by triggers, in the transaction that writes the cards
+    db.execute("""CREATE TRIGGER cards_count_insert AFTER INSERT ON cards BEGIN
+        UPDATE lists SET card_count = card_count + 1, mastered_count = mastered_count + (NEW.level = 'Mastered')
+        WHERE id = NEW.list_id;
+    END""")
+    db.execute("""CREATE TRIGGER cards_count_delete AFTER DELETE ON cards BEGIN
+        UPDATE lists SET card_count = card_count - 1, mastered_count = mastered_count - (OLD.level = 'Mastered')
+        WHERE id = OLD.list_id;
+    END""")
+    db.execute("""CREATE TRIGGER cards_count_level AFTER UPDATE OF level ON cards
+        WHEN (OLD.level = 'Mastered') != (NEW.level = 'Mastered') BEGIN
+        UPDATE lists SET mastered_count = mastered_count + (NEW.level = 'Mastered') - (OLD.level = 'Mastered')
+        WHERE id = NEW.list_id;
+    END""")
+
+
+def migrate_list_folders(db):
+    """Move the folders of each list from the lists.folders JSON column to the list_folders table"""
+
+    db.execute("""CREATE TABLE list_folders (
+        list_id INTEGER NOT NULL,
+        folder_id INTEGER NOT NULL,
+        PRIMARY KEY (list_id, folder_id)
+    ) WITHOUT ROWID""")
+    db.execute("CREATE INDEX list_folders_folder_id ON list_folders (folder_id, list_id)")
+
+    rows = db.execute("SELECT id, folders FROM lists WHERE folders IS NOT NULL").fetchall()
+
+    for row in rows:
+        db.executemany(
+            "INSERT OR IGNORE INTO list_folders (list_id, folder_id) SELECT (?), id FROM folders WHERE id = (?)",
+            [(row["id"], int(folder_id)) for folder_id in json.loads(row["folders"])]
+        )
+
+    db.execute("UPDATE lists SET folders = NULL")
+
+
+def migrate_keywords(db):
+    """Move the keywords of folders and lists from their JSON columns to the keywords tables"""
+
+    db.execute("""CREATE TABLE keywords (
+        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        folder_id INTEGER,
+        user_id INTEGER NOT NULL,
+        keyword TEXT NOT NULL
+    )""")
+    db.execute("CREATE UNIQUE INDEX keywords_folder_id_keyword ON keywords (folder_id, keyword)")
+    db.execute("CREATE INDEX keywords_user_id_keyword ON keywords (user_id, keyword)")
+    db.execute("""CREATE TABLE list_keywords (
+        list_id INTEGER NOT NULL,
+        keyword_id INTEGER NOT NULL,
+        active INTEGER NOT NULL DEFAULT 1,
+        PRIMARY KEY (list_id, keyword_id)
+    ) WITHOUT ROWID""")
+    db.execute("CREATE INDEX list_keywords_keyword_id ON list_keywords (keyword_id, active, list_id)")
+
+    for folder in db.execute("SELECT id, user_id, keywords FROM folders WHERE keywords != '[]'").fetchall():
+        db.executemany(
+            "INSERT OR IGNORE INTO keywords (folder_id, user_id, keyword) VALUES (?, ?, ?)",
+            [(folder["id"], folder["user_id"], keyword["keyword"]) for keyword in json.loads(folder["keywords"])]
+        )
+
+    # A list keyword belongs to the folder of the list that has a keyword with the same name
+    for list in db.execute("SELECT id, user_id, keywords FROM lists WHERE keywords IS NOT NULL").fetchall():
+        for keyword in json.loads(list["keywords"]):
+            row = db.execute("""
+                SELECT keywords.id FROM keywords JOIN list_folders ON list_folders.folder_id = keywords.folder_id
+                WHERE list_folders.list_id = (?) AND keywords.keyword = (?)
+                ORDER BY keywords.id LIMIT 1
+            """, (list["id"], keyword["keyword"])).fetchone()
+
+            if row:
+                keyword_id = row["id"]
+            else:
+                keyword_id = db.execute(
+                    "INSERT INTO keywords (folder_id, user_id, keyword) VALUES (NULL, ?, ?)",
+                    (list["user_id"], keyword["keyword"])
+                ).lastrowid
+
+            db.execute(
+                "INSERT OR REPLACE INTO list_keywords (list_id, keyword_id, active) VALUES (?, ?, ?)",
+                (list["id"], keyword_id, 1 if keyword.get("active") else 0)
+            )
+
+    db.execute("UPDATE folders SET keywords = '[]'")
+    db.execute("UPDATE lists SET keywords = NULL")
+
+
+def create_search_index(db):
+    """Index the terms and definitions of cards and the titles and descriptions of lists for full-text search"""
+
+    # External content tables: the text stays in cards and lists, the index only
+    # stores the tokens. Prefixes of 2 and 3 characters are indexed for "ver*" queries.
+    db.execute("""CREATE VIRTUAL TABLE cards_fts USING fts5(
+        term, definition, content='cards', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""")
+    db.execute("""CREATE VIRTUAL TABLE lists_fts USING fts5(
+        title, description, content='lists', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""")
+
+    db.execute("INSERT INTO cards_fts (cards_fts) VALUES ('rebuild')")
+    db.execute("INSERT INTO lists_fts (lists_fts) VALUES ('rebuild')")
+
+    # The indexes are kept up to date by triggers, in the transaction that writes the rows
+    db.execute("""CREATE TRIGGER cards_fts_insert AFTER INSERT ON cards BEGIN
+        INSERT INTO cards_fts (rowid, term, definition) VALUES (NEW.id, NEW.term, NEW.definition);
+    END""")
+    db.execute("""CREATE TRIGGER cards_fts_delete AFTER DELETE ON cards BEGIN
+        INSERT INTO cards_fts (cards_fts, rowid, term, definition) VALUES ('delete', OLD.id, OLD.term, OLD.definition);
+    END""")
+    db.execute("""CREATE TRIGGER cards_fts_update AFTER UPDATE OF term, definition ON cards BEGIN
+        INSERT INTO cards_fts (cards_fts, rowid, term, definition) VALUES ('delete', OLD.id, OLD.term, OLD.definition);
+        INSERT INTO cards_fts (rowid, term, definition) VALUES (NEW.id, NEW.term, NEW.definition);
+    END""")
+    db.execute("""CREATE TRIGGER lists_fts_insert AFTER INSERT ON lists BEGIN
+        INSERT INTO lists_fts (rowid, title, description) VALUES (NEW.id, NEW.title, NEW.description);
+    END""")
+    db.execute("""CREATE TRIGGER lists_fts_delete AFTER DELETE ON lists BEGIN
+        INSERT INTO lists_fts (lists_fts, rowid, title, description) VALUES ('delete', OLD.id, OLD.title, OLD.description);
+    END""")
+    db.execute("""CREATE TRIGGER lists_fts_update AFTER UPDATE OF title, description ON lists BEGIN
+        INSERT INTO lists_fts (lists_fts, rowid, title, description) VALUES ('delete', OLD.id, OLD.title, OLD.description);
+        INSERT INTO lists_fts (rowid, title, description) VALUES (NEW.id, NEW.title, NEW.description);
+    END""")
+
+
+def create_sessions(db):
+    """Store the sessions in the database instead of the flask_session directory"""
+
+    db.execute("""CREATE TABLE sessions (
+        id TEXT PRIMARY KEY NOT NULL,
+        data TEXT NOT NULL,
+        expires_at DATETIME NOT NULL
+    ) WITHOUT ROWID""")
+    db.execute("CREATE INDEX sessions_expires_at ON sessions (expires_at)")
+
+
+def add_versions(db):
+    """Count the changes of every user and list, the counters are used as ETags of the pages"""
+
+    db.execute("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    db.execute("ALTER TABLE lists ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+    # List page: the list, its cards, folders and keywords
+    for event, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+        db.execute(f"""CREATE TRIGGER cards_version_{event.lower()} AFTER {event} ON cards BEGIN
+            UPDATE lists SET version = version + 1 WHERE id = {row}.list_id;
+        END""")
+        db.execute(f"""CREATE TRIGGER list_keywords_version_{event.lower()} AFTER {event} ON list_keywords BEGIN
+            UPDATE lists SET version = version + 1 WHERE id = {row}.list_id;
+            UPDATE users SET version = version + 1 WHERE id = (SELECT user_id FROM lists WHERE id = {row}.list_id);
+        END""")
+        db.execute(f"""CREATE TRIGGER folders_version_{event.lower()} AFTER {event} ON folders BEGIN
+            UPDATE users SET version = version + 1 WHERE id = {row}.user_id;
+        END""")
+        db.execute(f"""CREATE TRIGGER keywords_version_{event.lower()} AFTER {event} ON keywords BEGIN
+            UPDATE users SET version = version + 1 WHERE id = {row}.user_id;
+        END""")
+
+    for event, row in (("INSERT", "NEW"), ("DELETE", "OLD")):
+        db.execute(f"""CREATE TRIGGER list_folders_version_{event.lower()} AFTER {event} ON list_folders BEGIN
+            UPDATE lists SET version = version + 1 WHERE id = {row}.list_id;
+            UPDATE users SET version = version + 1 WHERE id = (SELECT user_id FROM lists WHERE id = {row}.list_id);
+        END""")
+        db.execute(f"""CREATE TRIGGER lists_version_{event.lower()} AFTER {event} ON lists BEGIN
+            UPDATE users SET version = version + 1 WHERE id = {row}.user_id;
+        END""")
+
+    # Dashboard and folder pages: titles, paths and counters of the lists.
+    # Only the columns listed here fire the trigger, so bumping lists.version doesn't.
+    db.execute("""CREATE TRIGGER lists_version_update
+        AFTER UPDATE OF title, description, path, card_count, mastered_count ON lists BEGIN
+        UPDATE lists SET version = version + 1 WHERE id = NEW.id;
+        UPDATE users SET version = version + 1 WHERE id = NEW.user_id;
+    END""")
+    db.execute("""CREATE TRIGGER users_version_update AFTER UPDATE OF username ON users BEGIN
+        UPDATE users SET version = version + 1 WHERE id = NEW.id;
+    END""")
+
+
+def create_daily_stats(db):
+    """Sum up the reviews of every list by day, for the progress charts"""
+
+    db.execute("""CREATE TABLE daily_stats (
+        list_id INTEGER NOT NULL,
+        day DATE NOT NULL,
+        user_id INTEGER NOT NULL,
+        reviewed INTEGER NOT NULL DEFAULT 0,
+        mastered INTEGER NOT NULL DEFAULT 0,
+        still_learning INTEGER NOT NULL DEFAULT 0,
+        streak INTEGER NOT NULL DEFAULT 1,
+        PRIMARY KEY (list_id, day)
+    ) WITHOUT ROWID""")
+    db.execute("CREATE INDEX daily_stats_user_id_day ON daily_stats (user_id, day)")
+
+    rows = db.execute("""
+        SELECT list_id, date(review_date) AS day, user_id,
+            COUNT(*) AS reviewed, SUM(outcome = 1) AS mastered, SUM(outcome != 1) AS still_learning
+        FROM reviews
+        GROUP BY list_id, date(review_date)
+        ORDER BY list_id, day
+    """).fetchall()
+
+    # Rows come ordered by list and day, the streak goes on while the days follow each other
+    for list_id, days in itertools.groupby(rows, key=lambda row: row["list_id"]):
+        streak, previous = 0, None
+
+        for row in days:
+            day = datetime.date.fromisoformat(row["day"])
+            streak = streak + 1 if previous and day - previous == datetime.timedelta(days=1) else 1
+            previous = day
+
+            db.execute(
+                "INSERT INTO daily_stats (list_id, day, user_id, reviewed, mastered, still_learning, streak) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (list_id, row["day"], row["user_id"], row["reviewed"], row["mastered"], row["still_learning"], streak)
+            )
+
+
+def index_due_cards(db):
+    """Count and list the due cards of a list without reading the others"""
+
+    db.execute("CREATE INDEX cards_list_id_due_at ON cards (list_id, due_at)")
+
+
+def add_review_keys(db):
+    """Remember the key a client gave to each review, so that a batch sent twice is only applied once"""
+
+    db.execute("ALTER TABLE reviews ADD COLUMN client_key TEXT")
+    db.execute("CREATE UNIQUE INDEX reviews_user_id_client_key ON reviews (user_id, client_key) WHERE client_key IS NOT NULL")
+
+
+def create_jobs(db):
+    """Keep the state of the background jobs (imports, exports), so that pages can poll their progress"""
+
+    db.execute("""CREATE TABLE jobs (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        payload TEXT NOT NULL DEFAULT '{}',
+        progress INTEGER NOT NULL DEFAULT 0,
+        total INTEGER,
+        message TEXT,
+        result TEXT,
+        cancel_requested INTEGER NOT NULL DEFAULT 0,
+        created_at DATETIME NOT NULL,
+        updated_at DATETIME NOT NULL,
+        finished_at DATETIME
+    )""")
+    db.execute("CREATE INDEX jobs_user_id_status ON jobs (user_id, status)")
+    db.execute("CREATE INDEX jobs_status_updated_at ON jobs (status, updated_at)")
+
+
+def create_retention_models(db):
+    """Keep the forgetting curve fitted on the reviews of every user, see retention.py"""
+
+    db.execute("""CREATE TABLE retention_models (
+        user_id INTEGER PRIMARY KEY,
+        initial_stability REAL NOT NULL,
+        growth REAL NOT NULL,
+        target_retention REAL NOT NULL,
+        reviews INTEGER NOT NULL,
+        log_loss REAL,
+        fitted_at DATETIME NOT NULL
+    )""")
+
+
+def index_paths(db):
+    """Look up the pages of a user's lists and folders by (user_id, path), instead of by path and filtering the user"""
+
+    db.execute("CREATE INDEX lists_user_id_path ON lists (user_id, path)")
+    db.execute("CREATE INDEX folders_user_id_path ON folders (user_id, path)")
+
+    # The (user_id) indexes stay: they keep the dashboard pages in id order
+    db.execute("DROP INDEX IF EXISTS lists_path")
+    db.execute("DROP INDEX IF EXISTS folders_path")
+
+
+MIGRATIONS = [
+    create_tables,
+    migrate_cards,
+    migrate_lessons,
+    migrate_schedule,
+    create_indexes,
+    add_card_counts,
+    migrate_list_folders,
+    migrate_keywords,
+    create_search_index,
+    create_sessions,
+    add_versions,
+    create_daily_stats,
+    index_due_cards,
+    add_review_keys,
+    create_jobs,
+    create_retention_models,
+    index_paths,
+]
+
+
+def get_version(db):
+    """Version of the schema of the database"""
+
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db):
+    """
+    Apply the migrations the database hasn't gone through yet.
+
+    Each step runs in its own transaction together with the version bump, and
+    the version is checked again once the write lock is held so that several
+    workers starting at the same time apply every step only once.
+    """
+
+    applied = []
+
+    for version, step in enumerate(MIGRATIONS, start=1):
+
+        if get_version(db) >= version:
+            continue
+
+        db.execute("BEGIN IMMEDIATE")
+
+        try:
+            if get_version(db) < version:
+                step(db)
+                db.execute(f"PRAGMA user_version = {version}")
+                applied.append(step.__name__)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+    return applied
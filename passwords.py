@@ -0,0 +1,171 @@
+import collections
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Fewest PBKDF2-SHA256 iterations ever used, whatever the calibration finds (OWASP, 2023)
+MIN_ITERATIONS = 600000
+
+# Iterations timed to calibrate the cost
+CALIBRATION_ITERATIONS = 20000
+
+# Hashes waiting for a worker before logins are refused
+QUEUE_SIZE = 32
+
+
+class PasswordBusy(RuntimeError):
+    """Too many passwords are being hashed, the attempt should be made again later"""
+
+
+def _hash(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def _check(pwhash, password):
+    return check_password_hash(pwhash, password)
+
+
+def calibrate(target_seconds, minimum=MIN_ITERATIONS):
+    """PBKDF2 iterations taking about target_seconds on this machine, never fewer than minimum"""
+
+    start = time.perf_counter()
+    generate_password_hash("calibration", method=f"pbkdf2:sha256:{CALIBRATION_ITERATIONS}")
+    elapsed = time.perf_counter() - start
+
+    iterations = int(CALIBRATION_ITERATIONS * target_seconds / elapsed) // 1000 * 1000
+    return max(iterations, minimum)
+
+
+def hash_iterations(pwhash):
+    """Iterations of a PBKDF2-SHA256 hash, None for any other method"""
+
+    method = pwhash.split("$", 1)[0].split(":")
+
+    if method[:2] != ["pbkdf2", "sha256"] or len(method) != 3 or not method[2].isdigit():
+        return None
+
+    return int(method[2])
+
+
+class Hasher:
+    """
+    Hash and check passwords in a pool of processes.
+
+    Hashing is slow on purpose: done in the request threads, a burst of logins
+    would hold every worker. At most workers + queue_size passwords are hashed
+    or waiting at once, the next ones raise PasswordBusy straight away. With
+    no workers, passwords are hashed in the calling thread, with the same bound.
+    """
+
+    def __init__(self, iterations, workers, queue_size=QUEUE_SIZE):
+        self.iterations = iterations
+        self.method = f"pbkdf2:sha256:{iterations}"
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(workers + queue_size if workers else queue_size)
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def run(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            raise PasswordBusy("Too many login attempts at the moment, try again in a few seconds")
+
+        try:
+            if not self.workers:
+                return function(*args)
+
+            with self.lock:
+                if self.pool is None:
+                    # Forking a process with the writer and request threads running isn't safe
+                    self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+            return self.pool.submit(function, *args).result()
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        return self.run(_hash, password, self.method)
+
+    def check(self, pwhash, password):
+        return self.run(_check, pwhash, password)
+
+    def needs_upgrade(self, pwhash):
+        """Whether a hash is weaker than the ones made now, and should be replaced at the next login"""
+
+        iterations = hash_iterations(pwhash)
+        return iterations is None or iterations < self.iterations
+
+
+hashers_lock = threading.Lock()
+
+
+def get_hasher():
+    """Hasher of the application, its cost calibrated on first use unless PASSWORD_ITERATIONS is set"""
+
+    app = current_app._get_current_object()
+
+    with hashers_lock:
+        if "passwords" not in app.extensions:
+            config = app.config
+            iterations = config.get("PASSWORD_ITERATIONS") or calibrate(config.get("PASSWORD_TARGET_SECONDS", 0.25))
+            workers = config.get("PASSWORD_WORKERS")
+
+            app.extensions["passwords"] = Hasher(
+                int(iterations),
+                min(4, os.cpu_count() or 1) if workers is None else int(workers),
+                int(config.get("PASSWORD_QUEUE_SIZE", QUEUE_SIZE)),
+            )
+
+        return app.extensions["passwords"]
+
+
+class AttemptLimiter:
+    """
+    Count the attempts made by a key (a username, an address) in a sliding window.
+
+    Kept in memory, per process: it stops floods before they cost any hashing,
+    it isn't an account lockout.
+    """
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.attempts = collections.defaultdict(collections.deque)
+        self.lock = threading.Lock()
+        self.swept_at = 0
+
+    def allow(self, key, now=None):
+        """Record an attempt of key, False if it has made too many in the window"""
+
+        now = time.monotonic() if now is None else now
+
+        with self.lock:
+            if now - self.swept_at > self.window:
+                self.sweep(now)
+
+            attempts = self.attempts[key]
+
+            while attempts and attempts[0] <= now - self.window:
+                attempts.popleft()
+
+            if len(attempts) >= self.limit:
+                return False
+
+            attempts.append(now)
+            return True
+
+    def reset(self, key):
+        with self.lock:
+            self.attempts.pop(key, None)
+
+    def sweep(self, now):
+        """Forget the keys without attempts in the window, so that memory stays bounded"""
+
+        for key in [key for key, attempts in self.attempts.items() if not attempts or attempts[-1] <= now - self.window]:
+            del self.attempts[key]
+
+        self.swept_at = now
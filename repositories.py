@@ -0,0 +1,505 @@
+"""
+Data access of the routes.
+
+Every repository works on one connection for one user: the connection of
+get_db(), which is the user's own database with the sharded backend, or the
+connection of get_directory_db() for the accounts. The routes don't write SQL.
+"""
+
+import sqlite3
+
+from retention import fit_user, store_model
+from stats import current_streak, series
+from sync import apply_reviews
+from tags import build_filter
+
+
+class UsernameTaken(ValueError):
+    """Another account has this username"""
+
+
+def _placeholders(values):
+    return ", ".join("?" * len(values))
+
+
+class UserRepository:
+    """Accounts, on the directory database"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, user_id):
+        return self.db.execute("SELECT * FROM users WHERE id = (?)", (user_id,)).fetchone()
+
+    def by_username(self, username):
+        """The user of a username, None if there isn't exactly one"""
+
+        rows = self.db.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchall()
+
+        return rows[0] if len(rows) == 1 else None
+
+    def create(self, username, pwhash):
+        """Create an account and return its id, raises UsernameTaken"""
+
+        try:
+            cursor = self.db.execute("INSERT INTO users (username, hash) VALUES (?, ?)", (username, pwhash))
+        except sqlite3.IntegrityError:
+            raise UsernameTaken("Username already exists")
+
+        return cursor.lastrowid
+
+    def set_hash(self, user_id, pwhash, old_hash=None):
+        """Replace the password hash, only if it's still old_hash when given. Returns False if it wasn't replaced"""
+
+        if old_hash is None:
+            cursor = self.db.execute("UPDATE users SET hash = (?) WHERE id = (?)", (pwhash, user_id))
+        else:
+            cursor = self.db.execute("UPDATE users SET hash = (?) WHERE id = (?) AND hash = (?)", (pwhash, user_id, old_hash))
+
+        return cursor.rowcount > 0
+
+    def delete(self, user_id):
+        self.db.execute("DELETE FROM users WHERE id = (?)", (user_id,))
+
+    def username(self, user_id):
+        row = self.db.execute("SELECT username FROM users WHERE id = ?", (user_id,)).fetchone()
+
+        return row["username"] if row else None
+
+    def ids(self):
+        return [row["id"] for row in self.db.execute("SELECT id FROM users ORDER BY id")]
+
+    def version(self, user_id):
+        """Version counter of everything shown on the user's dashboard and folder pages"""
+
+        return self.db.execute("SELECT version FROM users WHERE id = (?)", (user_id,)).fetchone()["version"]
+
+
+class ListRepository:
+    """Lists of a user and their cards"""
+
+    def __init__(self, db, user_id):
+        self.db = db
+        self.user_id = user_id
+
+    def get(self, list_id):
+        return self.db.execute("SELECT * FROM lists WHERE id = (?) AND user_id = (?)", (list_id, self.user_id)).fetchone()
+
+    def by_path(self, path):
+        return self.db.execute("SELECT * FROM lists WHERE user_id = (?) AND path = (?)", (self.user_id, path)).fetchone()
+
+    def page(self, after, limit):
+        """Lists after the id after, by id"""
+
+        return self.db.execute(
+            "SELECT id, title, path, card_count, mastered_count FROM lists WHERE user_id = (?) AND id > (?) ORDER BY id LIMIT (?)",
+            (self.user_id, after, limit)
+        ).fetchall()
+
+    def count(self):
+        return self.db.execute("SELECT COUNT(*) FROM lists WHERE user_id = (?)", (self.user_id,)).fetchone()[0]
+
+    def ids(self):
+        return [row["id"] for row in self.db.execute("SELECT id FROM lists WHERE user_id = (?) ORDER BY id", (self.user_id,))]
+
+    def create(self, title, description, cards, now):
+        """Create a list with its cards, returns its id"""
+
+        last_id = self.db.execute("SELECT COALESCE(MAX(id), 0) FROM lists").fetchone()[0]
+
+        path = str.lower(str(title)).replace(" ", "_") + "_" + str(last_id + 1)
+
+        cursor = self.db.execute(
+            "INSERT INTO lists (title, description, path, user_id, creation_date) VALUES (?, ?, ?, ?, ?)",
+            (title, description, path, self.user_id, now)
+        )
+
+        self.db.executemany(
+            "INSERT INTO cards (list_id, card_id, term, definition, level, position, user_id, due_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(cursor.lastrowid, card["id"], card["term"] or "", card["definition"] or "", "", position, self.user_id, now)
+             for position, card in enumerate(cards)]
+        )
+
+        return cursor.lastrowid
+
+    def create_empty(self, title, now):
+        """Create a list without cards, for an import, returns its (id, path)"""
+
+        cursor = self.db.execute(
+            "INSERT INTO lists (title, description, path, user_id, creation_date) VALUES (?, ?, ?, ?, ?)",
+            (title, "", "", self.user_id, now)
+        )
+
+        list_id = cursor.lastrowid
+
+        path = str.lower(str(title)).replace(" ", "_") + "_" + str(list_id)
+
+        self.db.execute("UPDATE lists SET path = (?) WHERE id = (?)", (path, list_id))
+
+        return list_id, path
+
+    def update(self, list_id, title, description, cards, now):
+        """Edit a list and its cards, returns False if the user has no such list"""
+
+        path = str.lower(str(title)).replace(" ", "_") + "_" + str(list_id)
+
+        cursor = self.db.execute(
+            "UPDATE lists SET title = (?), description = (?), path = (?) WHERE id = (?) AND user_id = (?)",
+            (title, description, path, list_id, self.user_id)
+        )
+
+        if not cursor.rowcount:
+            return False
+
+        # Only the cards whose content or position changed are rewritten,
+        # and a card keeps its level as long as its content is the same
+        self.db.executemany("""
+            INSERT INTO cards (list_id, card_id, term, definition, level, position, user_id, due_at) VALUES (?, ?, ?, ?, '', ?, ?, ?)
+            ON CONFLICT (list_id, card_id) DO UPDATE SET
+                level = CASE WHEN cards.term = excluded.term AND cards.definition = excluded.definition
+                             THEN cards.level ELSE '' END,
+                term = excluded.term,
+                definition = excluded.definition,
+                position = excluded.position
+            WHERE cards.term IS NOT excluded.term
+               OR cards.definition IS NOT excluded.definition
+               OR cards.position IS NOT excluded.position
+        """, [(list_id, card["id"], card["term"] or "", card["definition"] or "", position, self.user_id, now)
+              for position, card in enumerate(cards)])
+
+        # Cards removed from the form are deleted
+        self.db.execute("DELETE FROM cards WHERE list_id = (?) AND card_id > (?)", (list_id, len(cards)))
+
+        return True
+
+    def delete(self, list_id):
+        """Delete a list with its cards and memberships"""
+
+        cursor = self.db.execute("DELETE FROM lists WHERE id = (?) AND user_id = (?)", (list_id, self.user_id))
+
+        if cursor.rowcount:
+            self.db.execute("DELETE FROM cards WHERE list_id = (?)", (list_id,))
+            self.db.execute("DELETE FROM list_folders WHERE list_id = (?)", (list_id,))
+            self.db.execute("DELETE FROM list_keywords WHERE list_id = (?)", (list_id,))
+
+    def folder_ids(self, list_id):
+        return [row["folder_id"] for row in self.db.execute("SELECT folder_id FROM list_folders WHERE list_id = (?)", (list_id,))]
+
+    def counts(self, list_ids):
+        """Card and mastered counts of lists"""
+
+        if not list_ids:
+            return []
+
+        return self.db.execute(
+            f"SELECT id, card_count, mastered_count FROM lists WHERE user_id = (?) AND id IN ({_placeholders(list_ids)})",
+            (self.user_id, *list_ids)
+        ).fetchall()
+
+    def query(self, tags, folder_id, after, limit):
+        """Lists matching a tag query, in a folder or across the account, raises TagQueryError"""
+
+        condition, params = build_filter(tags, folder_id)
+
+        folder_condition, folder_params = "", []
+
+        if folder_id is not None:
+            folder_condition = "AND EXISTS (SELECT 1 FROM list_folders WHERE list_folders.list_id = lists.id AND list_folders.folder_id = ?)"
+            folder_params = [folder_id]
+
+        return self.db.execute(f"""
+            SELECT lists.id, lists.title, lists.path, lists.card_count, lists.mastered_count
+            FROM lists
+            WHERE lists.user_id = ? AND lists.id > ? {folder_condition} AND {condition}
+            ORDER BY lists.id
+            LIMIT ?
+        """, (self.user_id, after, *folder_params, *params, limit)).fetchall()
+
+    def cards(self, list_id):
+        """Get the cards of a list, in their display order"""
+
+        rows = self.db.execute(
+            "SELECT card_id, term, definition, level, due_at FROM cards WHERE list_id = (?) ORDER BY position",
+            (list_id,)
+        ).fetchall()
+
+        return [{
+            "id": row["card_id"],
+            "term": row["term"],
+            "definition": row["definition"],
+            "level": row["level"],
+            "due_at": row["due_at"]
+        } for row in rows]
+
+    def cards_page(self, list_id, columns, after, limit, due_before=None):
+        """
+        Cards of a list after the (position, card_id) cursor, with the cursor
+        of every row as cursor_position and cursor_card_id.
+
+        Keyset pagination over the (list_id, position) index.
+        """
+
+        due_condition, due_params = "", []
+
+        if due_before is not None:
+            due_condition = " AND due_at <= (?)"
+            due_params = [due_before]
+
+        return self.db.execute(f"""
+            SELECT position AS cursor_position, card_id AS cursor_card_id, {", ".join(f"{column} AS {name}" for name, column in columns.items())} FROM cards
+            WHERE list_id = (?) AND (position, card_id) > (?, ?){due_condition}
+            ORDER BY position, card_id
+            LIMIT (?)
+        """, (list_id, *after, *due_params, limit)).fetchall()
+
+    def card_states(self, list_id, card_ids):
+        """Level and due date of some cards of a list"""
+
+        return self.db.execute(
+            f"SELECT list_id, card_id AS id, level, due_at FROM cards WHERE list_id = (?) AND user_id = (?) AND card_id IN ({_placeholders(card_ids)})",
+            (list_id, self.user_id, *card_ids)
+        ).fetchall()
+
+    def due_count(self, list_ids, due_before):
+        """Number of cards of lists due before a date"""
+
+        if not list_ids:
+            return 0
+
+        return self.db.execute(
+            f"SELECT COUNT(*) FROM cards WHERE list_id IN ({_placeholders(list_ids)}) AND due_at <= (?)", (*list_ids, due_before)
+        ).fetchone()[0]
+
+    def due_cards(self, due_before, limit):
+        """Next cards due for a review across all the lists"""
+
+        return self.db.execute("""
+            SELECT cards.list_id, cards.card_id, cards.term, cards.definition, cards.level, cards.due_at, lists.title, lists.path
+            FROM cards JOIN lists ON lists.id = cards.list_id
+            WHERE cards.user_id = (?) AND cards.due_at <= (?)
+            ORDER BY cards.due_at
+            LIMIT (?)
+        """, (self.user_id, due_before, limit)).fetchall()
+
+    def update_card(self, list_id, card_id, term, definition):
+        self.db.execute("""
+            UPDATE cards
+            SET term = (?), definition = (?)
+            WHERE list_id = (?) AND card_id = (?)
+            AND list_id IN (SELECT id FROM lists WHERE id = (?) AND user_id = (?))
+        """, (term or "", definition or "", list_id, card_id, list_id, self.user_id))
+
+    def delete_imported(self, list_id):
+        """Delete a list an import didn't finish, with the cards it committed"""
+
+        self.db.execute("DELETE FROM cards WHERE list_id = (?)", (list_id,))
+        self.db.execute("DELETE FROM lists WHERE id = (?) AND user_id = (?)", (list_id, self.user_id))
+
+
+class FolderRepository:
+    """Folders of a user and the lists in them"""
+
+    def __init__(self, db, user_id):
+        self.db = db
+        self.user_id = user_id
+
+    def get(self, folder_id):
+        return self.db.execute("SELECT * FROM folders WHERE id = (?) AND user_id = (?)", (folder_id, self.user_id)).fetchone()
+
+    def by_path(self, path):
+        return self.db.execute("SELECT * FROM folders WHERE path = (?) AND user_id = (?)", (path, self.user_id)).fetchone()
+
+    def page(self, after, limit):
+        """Folders after the id after, by id"""
+
+        return self.db.execute(
+            "SELECT id, name, path FROM folders WHERE user_id = (?) AND id > (?) ORDER BY id LIMIT (?)",
+            (self.user_id, after, limit)
+        ).fetchall()
+
+    def all(self):
+        return self.db.execute("SELECT * FROM folders WHERE user_id = (?) ORDER BY id", (self.user_id,)).fetchall()
+
+    def create(self, name, now):
+        count = self.db.execute("SELECT COUNT(*) FROM folders WHERE user_id = (?)", (self.user_id,)).fetchone()[0]
+
+        path = str(str.lower((name))).replace(" ", "_") + "_" + str(count + 1)
+
+        self.db.execute(
+            "INSERT INTO folders (name, path, keywords, user_id, creation_date) VALUES (?, ?, ?, ?, ?)",
+            (name, path, "[]", self.user_id, now)
+        )
+
+    def rename(self, folder_id, name):
+        """Rename a folder, returns its new path, or None if the user has no such folder"""
+
+        path = str(name) + "_" + str(folder_id)
+
+        cursor = self.db.execute("UPDATE folders SET name = (?), path = (?) WHERE id = (?) AND user_id = (?)", (name, path, folder_id, self.user_id))
+
+        if not cursor.rowcount:
+            return None
+
+        return path
+
+    def delete(self, folder_id):
+        """Delete a folder with its memberships and keywords, the lists stay"""
+
+        cursor = self.db.execute("DELETE FROM folders WHERE id = (?) AND user_id = (?)", (folder_id, self.user_id))
+
+        if cursor.rowcount:
+            self.db.execute("DELETE FROM list_folders WHERE folder_id = (?)", (folder_id,))
+            self.db.execute("DELETE FROM list_keywords WHERE keyword_id IN (SELECT id FROM keywords WHERE folder_id = (?))", (folder_id,))
+            self.db.execute("DELETE FROM keywords WHERE folder_id = (?)", (folder_id,))
+
+    def lists(self, folder_id, tags=""):
+        """
+        Lists of a folder, those matching the tag query if there is one
+        (e.g. "verbs AND NOT done"). Raises TagQueryError.
+
+        Only the members of the folder are read, through the list_folders index.
+        """
+
+        tags_condition, tags_params = "", []
+
+        if tags:
+            tags_condition, tags_params = build_filter(tags, folder_id)
+            tags_condition = " AND " + tags_condition
+
+        return self.db.execute(f"""
+            SELECT lists.id, lists.title, lists.path, lists.card_count
+            FROM list_folders JOIN lists ON lists.id = list_folders.list_id
+            WHERE list_folders.folder_id = (?){tags_condition}
+            ORDER BY lists.id
+        """, (folder_id, *tags_params)).fetchall()
+
+    def list_ids(self, folder_id):
+        return [row["list_id"] for row in self.db.execute(
+            "SELECT list_id FROM list_folders WHERE folder_id = (?) ORDER BY list_id", (folder_id,)
+        )]
+
+    def other_lists(self, folder_id):
+        """Lists that can still be added to the folder"""
+
+        return self.db.execute("""
+            SELECT id, title FROM lists
+            WHERE user_id = (?) AND id NOT IN (SELECT list_id FROM list_folders WHERE folder_id = (?))
+            ORDER BY id
+        """, (self.user_id, folder_id)).fetchall()
+
+    def add_list(self, folder_id, list_id):
+        self.db.execute("""
+            INSERT OR IGNORE INTO list_folders (list_id, folder_id)
+            SELECT lists.id, folders.id FROM lists, folders
+            WHERE lists.id = (?) AND lists.user_id = (?) AND folders.id = (?) AND folders.user_id = (?)
+        """, (list_id, self.user_id, folder_id, self.user_id))
+
+    def remove_list(self, folder_id, list_id):
+        self.db.execute("""
+            DELETE FROM list_folders
+            WHERE list_id = (?) AND folder_id = (?) AND folder_id IN (SELECT id FROM folders WHERE user_id = (?))
+        """, (list_id, folder_id, self.user_id))
+
+
+class KeywordRepository:
+    """Keywords of a user's folders and the lists they're given to"""
+
+    def __init__(self, db, user_id):
+        self.db = db
+        self.user_id = user_id
+
+    def of_folder(self, folder_id):
+        return [dict(row) for row in self.db.execute(
+            "SELECT id, keyword FROM keywords WHERE folder_id = (?) ORDER BY id", (folder_id,)
+        )]
+
+    def of_lists(self, list_ids, folder_id=None):
+        """Get the keywords of several lists, by list id"""
+
+        keywords = {list_id: [] for list_id in list_ids}
+
+        if not list_ids:
+            return keywords
+
+        folder_condition = "" if folder_id is None else " AND keywords.folder_id = (?)"
+
+        rows = self.db.execute(f"""
+            SELECT list_keywords.list_id, keywords.id, keywords.keyword, list_keywords.active
+            FROM list_keywords JOIN keywords ON keywords.id = list_keywords.keyword_id
+            WHERE list_keywords.list_id IN ({_placeholders(list_ids)}){folder_condition}
+            ORDER BY keywords.id
+        """, (*list_ids, *([] if folder_id is None else [folder_id]))).fetchall()
+
+        for row in rows:
+            keywords[row["list_id"]].append({"id": row["id"], "keyword": row["keyword"], "active": bool(row["active"])})
+
+        return keywords
+
+    def create(self, folder_id, keyword, list_id=None):
+        """
+        Add a keyword to a folder, unless it already has it, and give it to
+        the list it was created from. Returns False if the user has no such folder.
+        """
+
+        folder = self.db.execute("SELECT id FROM folders WHERE id = (?) AND user_id = (?)", (folder_id, self.user_id)).fetchone()
+
+        if not folder:
+            return False
+
+        # Keywords are unique in a folder
+        self.db.execute(
+            "INSERT OR IGNORE INTO keywords (folder_id, user_id, keyword) VALUES (?, ?, ?)",
+            (folder_id, self.user_id, keyword)
+        )
+
+        row = self.db.execute(
+            "SELECT id FROM keywords WHERE folder_id = (?) AND keyword = (?)", (folder_id, keyword)
+        ).fetchone()
+
+        if list_id:
+            self.db.execute("""
+                INSERT OR REPLACE INTO list_keywords (list_id, keyword_id, active)
+                SELECT id, (?), 1 FROM lists WHERE id = (?) AND user_id = (?)
+            """, (row["id"], list_id, self.user_id))
+
+        return True
+
+    def set_active(self, list_id, keyword_id, active):
+        self.db.execute("""
+            INSERT INTO list_keywords (list_id, keyword_id, active)
+            SELECT lists.id, keywords.id, (?) FROM lists, keywords
+            WHERE lists.id = (?) AND lists.user_id = (?) AND keywords.id = (?) AND keywords.user_id = (?)
+            ON CONFLICT (list_id, keyword_id) DO UPDATE SET active = excluded.active
+        """, (active, list_id, self.user_id, keyword_id, self.user_id))
+
+
+class ReviewRepository:
+    """Lessons of a user: their reviews, the statistics and the forgetting curve fitted on them"""
+
+    def __init__(self, db, user_id):
+        self.db = db
+        self.user_id = user_id
+
+    def apply(self, events, now):
+        """Schedule the answered cards and log the reviews, returns (applied, duplicates, missing, rejected)"""
+
+        return apply_reviews(self.db, self.user_id, events, now)
+
+    def series(self, start, end, bucket="day", list_id=None):
+        return series(self.db, self.user_id, start, end, bucket, list_id)
+
+    def streak(self, today, list_id=None):
+        return current_streak(self.db, self.user_id, today, list_id)
+
+    def retention_model(self):
+        return self.db.execute("SELECT * FROM retention_models WHERE user_id = (?)", (self.user_id,)).fetchone()
+
+    def fit_retention(self, now, target_retention):
+        """Fit the user's forgetting curve, returns the model to store (or None), raises RetentionError"""
+
+        return fit_user(self.db, self.user_id, now, target_retention)
+
+    def store_retention(self, row):
+        """Store a model made by fit_retention, None dropping the user's model"""
+
+        store_model(self.db, self.user_id, row)
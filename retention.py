@@ -0,0 +1,199 @@
+"""
+Personal forgetting curves fitted on the review history.
+
+The probability of recalling a card t days after its last review is
+exp(-t / S), S being the stability of the card. Every successful answer in a
+row multiplies it: S = initial_stability * growth ** streak, the streak being
+the number of answers right since the last wrong one. The two parameters are
+fitted for each user by maximum likelihood on all their reviews, with NumPy.
+"""
+
+import importlib.util
+import math
+
+# Parameters of users without enough reviews, and prior of the fits. Close to
+# the fixed intervals of the scheduler at 90% retention (1 day, then 3, then x3)
+INITIAL_STABILITY = 3.2
+GROWTH = 3.0
+
+# Recall probability a card is scheduled at
+TARGET_RETENTION = 0.9
+
+# Reviews following another review of the same card needed to fit a model
+MIN_REVIEWS = 100
+
+# Weight of the prior, in reviews: a user with few reviews stays close to it
+PRIOR_WEIGHT = 20
+
+ITERATIONS = 50
+
+
+class RetentionError(RuntimeError):
+    """The model can't be fitted"""
+
+
+class Model:
+    """Fitted forgetting curve of a user"""
+
+    def __init__(self, initial_stability, growth, target_retention=TARGET_RETENTION):
+        self.initial_stability = initial_stability
+        self.growth = growth
+        self.target_retention = target_retention
+
+    def stability(self, streak):
+        return self.initial_stability * self.growth ** streak
+
+    def retention(self, elapsed_days, streak):
+        """Probability of recalling a card elapsed_days after its last review"""
+
+        return math.exp(-elapsed_days / self.stability(streak))
+
+    def interval(self, streak):
+        """Days until the recall probability of a card falls to the target retention"""
+
+        return self.stability(streak) * -math.log(self.target_retention)
+
+
+def features(list_ids, card_ids, days, outcomes):
+    """
+    Turn reviews into (elapsed, streak, recalled) arrays, one entry per review that follows another of the same card.
+
+    days are Julian days. The reviews are sorted by card and date here, the
+    first review of every card is dropped: nothing was remembered before it.
+    """
+
+    import numpy as np
+
+    order = np.lexsort((days, card_ids, list_ids))
+    list_ids, card_ids, days, outcomes = list_ids[order], card_ids[order], days[order], outcomes[order]
+
+    index = np.arange(len(days))
+    first = np.ones(len(days), dtype=bool)
+    first[1:] = (list_ids[1:] != list_ids[:-1]) | (card_ids[1:] != card_ids[:-1])
+
+    # The streak starts again on the first review of a card and after a wrong answer
+    reset = first.copy()
+    reset[1:] |= outcomes[:-1] == 0
+    streak = index - np.maximum.accumulate(np.where(reset, index, 0))
+
+    elapsed = np.diff(days, prepend=days[:1])
+
+    keep = ~first
+    return elapsed[keep], streak[keep], outcomes[keep] == 1
+
+
+def fit(elapsed, streak, recalled, prior=(INITIAL_STABILITY, GROWTH), prior_weight=PRIOR_WEIGHT, iterations=ITERATIONS):
+    """
+    Fit (initial_stability, growth, log loss) on review arrays, by Fisher scoring.
+
+    The parameters are fitted as logarithms, log S = a + b * streak, pulled
+    towards the prior by prior_weight pseudo-reviews.
+    """
+
+    import numpy as np
+
+    # Reviews a few seconds apart would make the likelihood degenerate
+    elapsed = np.maximum(np.asarray(elapsed, dtype=float), 1e-4)
+    streak = np.asarray(streak, dtype=float)
+    recalled = np.asarray(recalled, dtype=float)
+
+    theta = prior_theta = np.log(np.array(prior, dtype=float))
+    design = np.column_stack([np.ones(len(elapsed)), streak])
+    penalty = prior_weight * np.eye(2)
+
+    for _ in range(iterations):
+        x = np.clip(elapsed * np.exp(-(design @ theta)), 1e-9, 50)
+        p = np.exp(-x)
+        q = -np.expm1(-x)
+
+        # Derivatives of the log likelihood by log S, and their expected square
+        gradient = x * (recalled - p) / q
+        weight = x * x * p / q
+
+        score = design.T @ gradient - prior_weight * (theta - prior_theta)
+        information = design.T @ (design * weight[:, None]) + penalty
+
+        step = np.linalg.solve(information, score)
+        theta = theta + np.clip(step, -1, 1)
+
+        if np.abs(step).max() < 1e-6:
+            break
+
+    x = np.clip(elapsed * np.exp(-(design @ theta)), 1e-9, 50)
+    log_loss = -np.mean(np.where(recalled == 1, -x, np.log(-np.expm1(-x)))) if len(x) else 0.0
+
+    initial_stability, growth = np.exp(theta)
+    return float(initial_stability), float(growth), float(log_loss)
+
+
+def load_reviews(db, user_id):
+    """Review arrays (list_ids, card_ids, days, outcomes) of a user, read without building a row object per review"""
+
+    import numpy as np
+
+    cursor = db.cursor()
+    cursor.row_factory = None
+    cursor.execute("""
+        SELECT list_id, card_id, julianday(review_date), outcome FROM reviews
+        WHERE list_id IN (SELECT id FROM lists WHERE user_id = (?)) AND user_id = (?)
+    """, (user_id, user_id))
+
+    rows = np.fromiter(cursor, dtype=[("list_id", "i8"), ("card_id", "i8"), ("day", "f8"), ("outcome", "i1")])
+    return rows["list_id"], rows["card_id"], rows["day"], rows["outcome"]
+
+
+def fit_user(db, user_id, now, target_retention=TARGET_RETENTION, min_reviews=MIN_REVIEWS):
+    """
+    Fit the model of a user on their whole history, without writing anything.
+
+    Users with fewer than min_reviews usable reviews keep the fixed scheduler.
+    Returns the row to store with store_model() as a dict, or None.
+    """
+
+    if importlib.util.find_spec("numpy") is None:
+        raise RetentionError("Fitting retention models needs NumPy, install it with pip install numpy")
+
+    elapsed, streak, recalled = features(*load_reviews(db, user_id))
+
+    if len(elapsed) < min_reviews:
+        return None
+
+    initial_stability, growth, log_loss = fit(elapsed, streak, recalled)
+
+    # Intervals never shrink as a card is answered right
+    growth = max(growth, 1.0)
+
+    row = {
+        "user_id": user_id,
+        "initial_stability": initial_stability,
+        "growth": growth,
+        "target_retention": target_retention,
+        "reviews": len(elapsed),
+        "log_loss": log_loss,
+        "fitted_at": now,
+    }
+
+    return row
+
+
+def store_model(db, user_id, row):
+    """Store a model made by fit_user(), or drop the user's model when it's None, in the caller's transaction"""
+
+    if row is None:
+        db.execute("DELETE FROM retention_models WHERE user_id = (?)", (user_id,))
+        return
+
+    db.execute("""
+        INSERT OR REPLACE INTO retention_models (user_id, initial_stability, growth, target_retention, reviews, log_loss, fitted_at)
+        VALUES (:user_id, :initial_stability, :growth, :target_retention, :reviews, :log_loss, :fitted_at)
+    """, row)
+
+
+def get_model(db, user_id):
+    """Fitted model of a user, None if they don't have one"""
+
+    row = db.execute(
+        "SELECT initial_stability, growth, target_retention FROM retention_models WHERE user_id = (?)", (user_id,)
+    ).fetchone()
+
+    return Model(row["initial_stability"], row["growth"], row["target_retention"]) if row else None
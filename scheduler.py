@@ -0,0 +1,68 @@
+import datetime
+
+# Answers stored in the reviews table, by card level
+LEVELS = {"Still learning": 0, "Mastered": 1}
+
+# Spaced repetition (SM-2 like) settings
+DEFAULT_EASE = 2.5
+MIN_EASE = 1.3
+EASE_BONUS = 0.1
+EASE_PENALTY = 0.2
+
+# Intervals in days for the first successful answers, then the interval is multiplied by the ease
+FIRST_INTERVALS = [1, 3]
+
+# Longest interval in days, the interval grows exponentially with the answers
+MAX_INTERVAL = 36500
+
+# A card answered wrong comes back during the same day
+RELEARN_DELAY = datetime.timedelta(minutes=10)
+
+
+def schedule(ease, interval, repetitions, mastered, now, model=None):
+    """
+    Compute the next state of a card after an answer.
+
+    With the fitted retention model of the user (see retention.py), a card
+    answered right comes back when its recall probability falls to the
+    user's target retention, instead of after the fixed intervals.
+
+    Returns (ease, interval, repetitions, due_at), the interval being in days.
+    """
+
+    ease = ease or DEFAULT_EASE
+    interval = interval or 0
+    repetitions = repetitions or 0
+
+    if not mastered:
+        ease = max(MIN_EASE, ease - EASE_PENALTY)
+        return ease, 0, 0, now + RELEARN_DELAY
+
+    repetitions += 1
+
+    if model is not None:
+        interval = min(round(model.interval(repetitions), 2), MAX_INTERVAL)
+    elif repetitions <= len(FIRST_INTERVALS):
+        interval = FIRST_INTERVALS[repetitions - 1]
+    else:
+        interval = min(round(interval * ease, 2), MAX_INTERVAL)
+
+    ease += EASE_BONUS
+
+    return ease, interval, repetitions, now + datetime.timedelta(days=interval)
+
+
+def replay(reviews, now):
+    """
+    Rebuild the state of a card from its past answers, oldest first.
+
+    Each review is a (mastered, review_date) tuple. Only used to seed cards
+    that were studied before the scheduler existed.
+    """
+
+    ease, interval, repetitions, due_at = DEFAULT_EASE, 0, 0, now
+
+    for mastered, review_date in reviews:
+        ease, interval, repetitions, due_at = schedule(ease, interval, repetitions, mastered, review_date)
+
+    return ease, interval, repetitions, due_at
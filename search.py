@@ -0,0 +1,72 @@
+import re
+
+# Results per page, and the most a client can ask for
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Words of the query, any punctuation is dropped so the user can't write FTS5 syntax by mistake
+WORD = re.compile(r"\w+")
+
+MAX_WORDS = 10
+
+
+def build_match(text):
+    """
+    Turn what the user typed into an FTS5 MATCH expression.
+
+    Every word must be found, the last one as a prefix so results show up
+    while the user is still typing. Returns None when there is nothing to search.
+    """
+
+    words = WORD.findall(text)[:MAX_WORDS]
+
+    if not words:
+        return None
+
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+
+    return " ".join(terms)
+
+
+def search_cards(db, user_id, text, limit=PAGE_SIZE, offset=0):
+    """Cards of the user matching the query, best matches first"""
+
+    match = build_match(text)
+
+    if not match:
+        return []
+
+    # bm25() weights a match in the term twice as much as in the definition
+    rows = db.execute("""
+        SELECT cards.list_id, cards.card_id, cards.term, cards.definition, cards.level,
+            lists.title, lists.path
+        FROM cards_fts
+        JOIN cards ON cards.id = cards_fts.rowid
+        JOIN lists ON lists.id = cards.list_id
+        WHERE cards_fts MATCH (?) AND cards.user_id = (?)
+        ORDER BY bm25(cards_fts, 2.0, 1.0)
+        LIMIT (?) OFFSET (?)
+    """, (match, user_id, limit, offset)).fetchall()
+
+    return [dict(row) for row in rows]
+
+
+def search_lists(db, user_id, text, limit=PAGE_SIZE, offset=0):
+    """Lists of the user whose title or description match the query, best matches first"""
+
+    match = build_match(text)
+
+    if not match:
+        return []
+
+    rows = db.execute("""
+        SELECT lists.id, lists.title, lists.path, lists.card_count, lists.mastered_count
+        FROM lists_fts
+        JOIN lists ON lists.id = lists_fts.rowid
+        WHERE lists_fts MATCH (?) AND lists.user_id = (?)
+        ORDER BY bm25(lists_fts, 2.0, 1.0)
+        LIMIT (?) OFFSET (?)
+    """, (match, user_id, limit, offset)).fetchall()
+
+    return [dict(row) for row in rows]
@@ -0,0 +1,139 @@
+import datetime
+import secrets
+import time
+
+from flask.sessions import SecureCookieSessionInterface, SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from database import get_directory_db
+
+# Seconds between two sweeps of the expired sessions
+SWEEP_INTERVAL = 3600
+
+
+class SqliteSession(CallbackDict, SessionMixin):
+    """Session stored in the sessions table, the cookie only holds its id"""
+
+    def __init__(self, initial=None, sid=None, expires_at=None):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.new = sid is None
+        self.modified = False
+        self.regenerate = False
+
+    def clear(self):
+        # A cleared session (login, logout) gets a new id, so an id known
+        # before logging in can't be used afterwards
+        super().clear()
+        self.regenerate = True
+
+
+class SqliteSessionInterface(SessionInterface):
+    """
+    Keep sessions in an indexed SQLite table.
+
+    A row is only written when the session changed or when half of its
+    lifetime has gone by, so most requests only read their session.
+    """
+
+    serializer = SecureCookieSessionInterface.serializer
+
+    def __init__(self, sweep_interval=SWEEP_INTERVAL):
+        self.sweep_interval = sweep_interval
+        self.last_sweep = time.monotonic()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+
+        if not sid:
+            return SqliteSession()
+
+        row = get_directory_db().execute(
+            "SELECT data, expires_at FROM sessions WHERE id = (?) AND expires_at > (?)",
+            (sid, datetime.datetime.now())
+        ).fetchone()
+
+        if row is None:
+            return SqliteSession()
+
+        return SqliteSession(self.serializer.loads(row["data"]), sid, row["expires_at"])
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        now = datetime.datetime.now()
+        lifetime = app.permanent_session_lifetime
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        if not session:
+            # Nothing to keep: an anonymous request doesn't touch the database
+            if session.sid:
+                with get_directory_db() as db:
+                    db.execute("DELETE FROM sessions WHERE id = (?)", (session.sid,))
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        refresh = session.expires_at is None or datetime.datetime.fromisoformat(str(session.expires_at)) - now < lifetime / 2
+
+        if not (session.modified or session.regenerate or refresh):
+            return
+
+        with get_directory_db() as db:
+            if session.regenerate and session.sid:
+                db.execute("DELETE FROM sessions WHERE id = (?)", (session.sid,))
+
+            if session.new or session.regenerate:
+                session.sid = secrets.token_urlsafe(32)
+
+            db.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)",
+                (session.sid, self.serializer.dumps(dict(session)), now + lifetime)
+            )
+
+            self.sweep(db, now)
+
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+    def sweep(self, db, now):
+        """Delete the expired sessions, at most once per sweep interval"""
+
+        if time.monotonic() - self.last_sweep < self.sweep_interval:
+            return 0
+
+        self.last_sweep = time.monotonic()
+
+        return delete_expired(db, now)
+
+
+def delete_expired(db, now):
+    """Delete the sessions that expired before now, through the expires_at index"""
+
+    return db.execute("DELETE FROM sessions WHERE expires_at <= (?)", (now,)).rowcount
+
+
+def session_interface(backend):
+    """Session interface of a SESSION_BACKEND setting: "sqlite" or "cookie" (signed cookies)"""
+
+    if backend == "sqlite":
+        return SqliteSessionInterface()
+    if backend == "cookie":
+        return SecureCookieSessionInterface()
+
+    raise ValueError(f"Unknown session backend: {backend}")
@@ -0,0 +1,89 @@
+/**
+ * Offline reviews queue, shared by the list and folder study pages.
+ *
+ * Every answer is queued in the browser with a unique key, then sent to
+ * /api/sync in batches. Answers given offline, or whose request was lost,
+ * are sent again later and only applied once.
+ */
+
+const REVIEWS_QUEUE_KEY = "pendingReviews"
+const SYNC_BATCH_SIZE = 500
+
+let reviewsQueue = JSON.parse(window.localStorage.getItem(REVIEWS_QUEUE_KEY) || "[]")
+
+const saveReviewsQueue = () => window.localStorage.setItem(REVIEWS_QUEUE_KEY, JSON.stringify(reviewsQueue))
+
+// crypto.randomUUID only exists on HTTPS pages (and localhost)
+const reviewKey = () => {
+  if (window.crypto && crypto.randomUUID) {
+    return crypto.randomUUID()
+  }
+
+  if (window.crypto && crypto.getRandomValues) {
+    return Array.from(crypto.getRandomValues(new Uint8Array(16)), byte => byte.toString(16).padStart(2, "0")).join("")
+  }
+
+  return Date.now().toString(36) + "-" + Math.random().toString(36).slice(2) + Math.random().toString(36).slice(2)
+}
+
+const queueReview = (listId, cardId, level) => {
+  reviewsQueue.push({
+    key: reviewKey(),
+    list_id: listId,
+    card_id: cardId,
+    level: level,
+    reviewed_at: new Date().toISOString()
+  })
+  saveReviewsQueue()
+}
+
+const dropReviews = (keys) => {
+  reviewsQueue = reviewsQueue.filter(review => !keys.has(review.key))
+  saveReviewsQueue()
+}
+
+// Send the queued reviews, returns the counters of the lists they changed, by list id
+const flushReviews = async () => {
+  const lists = {}
+
+  while (reviewsQueue.length > 0) {
+    const batch = reviewsQueue.slice(0, SYNC_BATCH_SIZE)
+
+    const res = await fetch("/api/sync", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ reviews: batch })
+    })
+
+    // A batch the server can't read at all would be refused again
+    if (res.status == 400) {
+      dropReviews(new Set(batch.map(review => review.key)))
+      continue
+    }
+
+    if (!res.ok) {
+      throw new Error(`Sync failed with status ${res.status}`)
+    }
+
+    // Only the reviews the server answered for leave the queue: applied, already applied,
+    // of a deleted card, or rejected alone (too old, of a deleted list...)
+    const result = await res.json()
+
+    result.rejected.forEach(review => console.warn("Review rejected:", review.error))
+
+    const before = reviewsQueue.length
+    dropReviews(new Set([...result.applied, ...result.duplicates, ...result.missing, ...result.rejected.map(review => review.key)]))
+
+    result.lists.forEach(list => lists[list.id] = list)
+
+    if (reviewsQueue.length == before) {
+      throw new Error("Sync made no progress")
+    }
+  }
+
+  return lists
+}
+
+window.addEventListener("online", () => flushReviews().catch(err => console.error("Error syncing reviews:", err)))
+
+flushReviews().catch(err => console.error("Error syncing reviews:", err))
@@ -0,0 +1,135 @@
+import datetime
+
+# strftime formats of the periods the series can be grouped by
+BUCKETS = {
+    "day": "%Y-%m-%d",
+    "week": "%Y-W%W",
+    "month": "%Y-%m",
+}
+
+# Longest date range a series can cover
+MAX_DAYS = 3 * 366
+
+
+class StatsQueryError(ValueError):
+    """The range or the bucket of a series is invalid"""
+
+
+def record(db, list_id, user_id, outcomes, now):
+    """
+    Add the answers of a lesson to the list's row of the day.
+
+    Runs in the caller's transaction, next to the reviews it summarizes. The
+    streak of a day is the number of days in a row the list has been studied.
+    Offline reviews can be synced for a day before others, whose streaks are
+    then counted again.
+    """
+
+    reviewed = len(outcomes)
+
+    if not reviewed:
+        return
+
+    mastered = sum(1 for outcome in outcomes if outcome)
+    day = now.date()
+
+    db.execute("""
+        INSERT INTO daily_stats (list_id, day, user_id, reviewed, mastered, still_learning, streak)
+        VALUES (?, ?, ?, ?, ?, ?, 1 + COALESCE((SELECT streak FROM daily_stats WHERE list_id = ? AND day = ?), 0))
+        ON CONFLICT (list_id, day) DO UPDATE SET
+            reviewed = reviewed + excluded.reviewed,
+            mastered = mastered + excluded.mastered,
+            still_learning = still_learning + excluded.still_learning
+    """, (list_id, day.isoformat(), user_id, reviewed, mastered, reviewed - mastered,
+          list_id, (day - datetime.timedelta(days=1)).isoformat()))
+
+    # The days in a row after this one carry on its streak, until one already does
+    rows = db.execute(
+        "SELECT day, streak FROM daily_stats WHERE list_id = (?) AND day >= (?) ORDER BY day",
+        (list_id, day.isoformat())
+    ).fetchall()
+
+    streak = rows[0]["streak"]
+    updates = []
+
+    for row in rows[1:]:
+        day += datetime.timedelta(days=1)
+
+        if row["day"] != day.isoformat() or row["streak"] == streak + 1:
+            break
+
+        streak += 1
+        updates.append((streak, list_id, row["day"]))
+
+    if updates:
+        db.executemany("UPDATE daily_stats SET streak = (?) WHERE list_id = (?) AND day = (?)", updates)
+
+
+def parse_range(start, end, today):
+    """Dates of a series from the query string, the last 30 days by default"""
+
+    try:
+        end = datetime.date.fromisoformat(end) if end else today
+        start = datetime.date.fromisoformat(start) if start else end - datetime.timedelta(days=29)
+    except ValueError:
+        raise StatsQueryError("Dates must be written YYYY-MM-DD")
+
+    if start > end:
+        raise StatsQueryError("The start of the range is after its end")
+
+    if (end - start).days > MAX_DAYS:
+        raise StatsQueryError(f"A range can't be longer than {MAX_DAYS} days")
+
+    return start, end
+
+
+def series(db, user_id, start, end, bucket="day", list_id=None):
+    """Reviews of the user (or of one of their lists) between two dates, grouped by day, week or month"""
+
+    if bucket not in BUCKETS:
+        raise StatsQueryError("The bucket must be one of " + ", ".join(BUCKETS))
+
+    list_condition = "" if list_id is None else " AND list_id = (?)"
+
+    rows = db.execute(f"""
+        SELECT strftime('{BUCKETS[bucket]}', day) AS period,
+            SUM(reviewed) AS reviewed, SUM(mastered) AS mastered, SUM(still_learning) AS still_learning
+        FROM daily_stats
+        WHERE user_id = (?) AND day BETWEEN (?) AND (?){list_condition}
+        GROUP BY period
+        ORDER BY period
+    """, (user_id, start.isoformat(), end.isoformat(), *([] if list_id is None else [list_id]))).fetchall()
+
+    return [dict(row) for row in rows]
+
+
+def current_streak(db, user_id, today, list_id=None):
+    """Days in a row up to today (or yesterday, if not studied yet today) with at least one review"""
+
+    if list_id is not None:
+        row = db.execute(
+            "SELECT day, streak FROM daily_stats WHERE list_id = (?) AND user_id = (?) ORDER BY day DESC LIMIT 1",
+            (list_id, user_id)
+        ).fetchone()
+
+        if row and datetime.date.fromisoformat(row["day"]) >= today - datetime.timedelta(days=1):
+            return row["streak"]
+        return 0
+
+    # Across lists, walk back the distinct days until one is missing
+    streak = 0
+    expected = today
+
+    for row in db.execute("SELECT DISTINCT day FROM daily_stats WHERE user_id = (?) ORDER BY day DESC", (user_id,)):
+        day = datetime.date.fromisoformat(row["day"])
+
+        if streak == 0 and day == today - datetime.timedelta(days=1):
+            expected = day
+
+        if day != expected:
+            break
+
+        streak += 1
+        expected = day - datetime.timedelta(days=1)
+
+    return streak
@@ -0,0 +1,93 @@
+import heapq
+import itertools
+
+# Most cards read from a list's cursor at a time
+FETCH_SIZE = 50
+
+
+class StudyCursorError(ValueError):
+    """The cursor of a folder session is malformed"""
+
+
+def parse_cursor(cursor):
+    """(position, list_id, card_id) of the last card sent, from its "position.list_id.card_id" form"""
+
+    if not cursor:
+        return None
+
+    try:
+        position, list_id, card_id = (int(part) for part in cursor.split("."))
+    except ValueError:
+        raise StudyCursorError("Invalid cursor")
+
+    return position, list_id, card_id
+
+
+def format_cursor(card):
+    return f"{card['position']}.{card['list_id']}.{card['card_id']}"
+
+
+def _list_cards(db, list_id, after, due_before):
+    """Cards of one list coming after the cursor in the session order, read lazily in (position, card_id) order"""
+
+    condition, params = "", []
+
+    if after is not None:
+        position, cursor_list_id, card_id = after
+
+        # The session is ordered by (position, list_id, card_id): the rest of this list
+        # starts at the cursor's position, after it, or at its card, depending on the list
+        if list_id > cursor_list_id:
+            condition, params = " AND position >= (?)", [position]
+        elif list_id < cursor_list_id:
+            condition, params = " AND position > (?)", [position]
+        else:
+            condition, params = " AND (position, card_id) > (?, ?)", [position, card_id]
+
+    if due_before is not None:
+        condition += " AND due_at <= (?)"
+        params.append(due_before)
+
+    cursor = db.execute(f"""
+        SELECT list_id, card_id, term, definition, level, position FROM cards
+        WHERE list_id = (?){condition}
+        ORDER BY position, card_id
+    """, (list_id, *params))
+
+    # Start with one card and double up to FETCH_SIZE, so a list that only
+    # sends a few cards of the page doesn't read FETCH_SIZE of them
+    size = 1
+
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield from rows
+        size = min(size * 2, FETCH_SIZE)
+
+
+def interleave(db, list_ids, after=None, due_before=None):
+    """
+    Yield the cards of several lists as one session: the first card of every list, then the second...
+
+    Each list is read through its own cursor on the (list_id, position)
+    index and merged as the cards are consumed. A list reads at most twice
+    the cards it sends, plus one to know where it stands, so a page reads
+    about twice its size plus one card per list, whatever the size of the lists.
+    """
+
+    return heapq.merge(
+        *(_list_cards(db, list_id, after, due_before) for list_id in list_ids),
+        key=lambda row: (row["position"], row["list_id"], row["card_id"])
+    )
+
+
+def page(db, list_ids, after, limit, due_before=None):
+    """Up to limit cards of the session after the cursor, and the cursor of the next page (None on the last one)"""
+
+    cards = [dict(row) for row in itertools.islice(interleave(db, list_ids, after, due_before), limit + 1)]
+
+    if len(cards) > limit:
+        return cards[:limit], format_cursor(cards[limit - 1])
+
+    return cards, None
@@ -0,0 +1,198 @@
+import datetime
+import itertools
+
+from retention import get_model
+from scheduler import LEVELS, schedule
+from stats import record
+
+# Most review events accepted in one batch
+MAX_EVENTS = 1000
+
+# Offline reviews older than this are refused, their schedule would be meaningless
+MAX_AGE = datetime.timedelta(days=30)
+
+MAX_KEY_LENGTH = 100
+
+
+class SyncError(ValueError):
+    """A batch of reviews, or one of its reviews, can't be applied"""
+
+
+def parse_utc_suffix(date):
+    """Date.toISOString() ends with "Z", which fromisoformat only accepts from Python 3.11"""
+
+    if isinstance(date, str) and date.endswith("Z"):
+        return date[:-1] + "+00:00"
+
+    return date
+
+
+def parse_event(event, now):
+    """Check one review event and normalize it, raises SyncError"""
+
+    try:
+        key = event.get("key")
+        list_id = int(event["list_id"])
+        card_id = int(event["card_id"])
+        level = event["level"]
+        reviewed_at = event.get("reviewed_at")
+    except (AttributeError, KeyError, TypeError, ValueError):
+        raise SyncError("The review is malformed")
+
+    if key is not None and (not isinstance(key, str) or not key or len(key) > MAX_KEY_LENGTH):
+        raise SyncError("The review has an invalid key")
+
+    if level not in LEVELS:
+        raise SyncError("The review has an unknown level")
+
+    if reviewed_at is None:
+        reviewed_at = now
+    else:
+        try:
+            reviewed_at = datetime.datetime.fromisoformat(parse_utc_suffix(reviewed_at))
+        except (TypeError, ValueError):
+            raise SyncError("The review has an invalid date")
+
+        # Dates sent with a timezone are stored in the server's local time, like the others
+        if reviewed_at.tzinfo is not None:
+            reviewed_at = reviewed_at.astimezone().replace(tzinfo=None)
+
+        if reviewed_at < now - MAX_AGE:
+            raise SyncError("The review is too old")
+
+        reviewed_at = min(reviewed_at, now)
+
+    return {"key": key, "list_id": list_id, "card_id": card_id, "level": level, "reviewed_at": reviewed_at}
+
+
+def parse_events(events, now):
+    """
+    Check the review events sent by a client and normalize them.
+
+    Each event is {"key", "list_id", "card_id", "level", "reviewed_at"}, the
+    key being generated by the client so that a batch can be sent again safely.
+    A bad event doesn't stop the others: returns (events, rejected), rejected
+    being {"index", "key", "error"} for every event refused. Raises SyncError
+    when the batch itself is invalid.
+    """
+
+    if not isinstance(events, list):
+        raise SyncError("reviews must be a list")
+
+    if len(events) > MAX_EVENTS:
+        raise SyncError(f"A batch can't have more than {MAX_EVENTS} reviews")
+
+    parsed, rejected = [], []
+
+    for index, event in enumerate(events):
+        try:
+            parsed.append(parse_event(event, now))
+        except SyncError as error:
+            key = event.get("key") if isinstance(event, dict) else None
+            rejected.append({"index": index, "key": key if isinstance(key, str) else None, "error": str(error)})
+
+    return parsed, rejected
+
+
+def apply_reviews(db, user_id, events, now):
+    """
+    Apply review events to the cards of the user, in the caller's transaction.
+
+    Events whose key was already applied are skipped. The others are applied
+    oldest first: the cards are scheduled, one review is logged per event and
+    the daily statistics are updated.
+
+    Returns (applied keys, duplicate keys, missing keys, rejected): missing
+    are the events of cards deleted since, which are dropped, and rejected
+    are {"key", "error"} for the events of lists the user doesn't have.
+    """
+
+    list_ids = {event["list_id"] for event in events}
+
+    owned = {row["id"] for row in db.execute(
+        "SELECT id FROM lists WHERE user_id = (?) AND id IN (%s)" % ", ".join("?" * len(list_ids)),
+        (user_id, *list_ids)
+    )} if list_ids else set()
+
+    rejected = [{"key": event["key"], "error": "This list doesn't exist"} for event in events if event["list_id"] not in owned]
+    events = [event for event in events if event["list_id"] in owned]
+
+    # Keys seen before, in the database or earlier in the batch
+    keys = [event["key"] for event in events if event["key"] is not None]
+
+    seen = {row["client_key"] for row in db.execute(
+        "SELECT client_key FROM reviews WHERE user_id = (?) AND client_key IN (%s)" % ", ".join("?" * len(keys)),
+        (user_id, *keys)
+    )} if keys else set()
+
+    applied, duplicates, missing, fresh = [], [], [], []
+
+    for event in events:
+        if event["key"] is not None and event["key"] in seen:
+            duplicates.append(event["key"])
+            continue
+
+        if event["key"] is not None:
+            seen.add(event["key"])
+
+        fresh.append(event)
+
+    fresh.sort(key=lambda event: event["reviewed_at"])
+
+    # Current state of every card answered, looked up by (list_id, card_id)
+    cards = {}
+
+    for list_id in {event["list_id"] for event in fresh}:
+        card_ids = {event["card_id"] for event in fresh if event["list_id"] == list_id}
+
+        for row in db.execute(
+            "SELECT card_id, ease, interval, repetitions FROM cards WHERE list_id = (?) AND card_id IN (%s)" % ", ".join("?" * len(card_ids)),
+            (list_id, *card_ids)
+        ):
+            cards[(list_id, row["card_id"])] = {"ease": row["ease"], "interval": row["interval"], "repetitions": row["repetitions"]}
+
+    # Cards are scheduled with the user's own forgetting curve once it has been fitted
+    model = get_model(db, user_id)
+
+    reviews = []
+
+    for event in fresh:
+        card = cards.get((event["list_id"], event["card_id"]))
+
+        # Cards deleted since the review was made are skipped
+        if card is None:
+            if event["key"] is not None:
+                missing.append(event["key"])
+            continue
+
+        if event["key"] is not None:
+            applied.append(event["key"])
+
+        mastered = LEVELS[event["level"]] == 1
+
+        card["ease"], card["interval"], card["repetitions"], card["due_at"] = schedule(
+            card["ease"], card["interval"], card["repetitions"], mastered, event["reviewed_at"], model
+        )
+        card["level"] = event["level"]
+
+        reviews.append((event["card_id"], event["list_id"], user_id, LEVELS[event["level"]], event["reviewed_at"], event["key"]))
+
+    db.executemany(
+        "UPDATE cards SET level = (?), ease = (?), interval = (?), repetitions = (?), due_at = (?) WHERE list_id = (?) AND card_id = (?)",
+        [(card["level"], card["ease"], card["interval"], card["repetitions"], card["due_at"], list_id, card_id)
+         for (list_id, card_id), card in cards.items() if "level" in card]
+    )
+
+    db.executemany(
+        "INSERT INTO reviews (card_id, list_id, user_id, outcome, review_date, client_key) VALUES (?, ?, ?, ?, ?, ?)",
+        reviews
+    )
+
+    # Daily statistics, by list and by day of the review
+    for (list_id, day), day_reviews in itertools.groupby(
+        sorted(reviews, key=lambda review: (review[1], review[4])),
+        key=lambda review: (review[1], review[4].date())
+    ):
+        record(db, list_id, user_id, [review[3] for review in day_reviews], datetime.datetime.combine(day, datetime.time()))
+
+    return applied, duplicates, missing, rejected
@@ -0,0 +1,124 @@
+import re
+
+# Tag queries combine keywords with AND, OR, NOT and parentheses, e.g.
+#   verbs AND (irregular OR "past tense") AND NOT done
+# Two keywords next to each other are joined with AND.
+
+TOKEN = re.compile(r'\s*(?:(\()|(\))|"([^"]*)"|([^\s()"]+))')
+
+OPERATORS = {"AND", "OR", "NOT"}
+
+MAX_TAGS = 20
+
+
+class TagQueryError(ValueError):
+    """The tag query can't be parsed"""
+
+
+def tokenize(text):
+    """Split a query into parentheses, operators and keywords"""
+
+    tokens = []
+    position = 0
+    text = text.strip()
+
+    while position < len(text):
+        match = TOKEN.match(text, position)
+
+        if not match or match.end() == position:
+            raise TagQueryError(f"Unexpected character at position {position}")
+
+        opening, closing, quoted, word = match.groups()
+
+        if opening:
+            tokens.append(("(", None))
+        elif closing:
+            tokens.append((")", None))
+        elif quoted is not None:
+            tokens.append(("TAG", quoted))
+        elif word.upper() in OPERATORS:
+            tokens.append((word.upper(), None))
+        else:
+            tokens.append(("TAG", word))
+
+        position = match.end()
+
+    return tokens
+
+
+def build_filter(text, folder_id=None):
+    """
+    Turn a tag query into a SQL condition on lists.id and its parameters.
+
+    Every keyword becomes an EXISTS lookup on the list_keywords primary key,
+    only active keywords count. With a folder, keywords are those of the folder.
+    """
+
+    tokens = tokenize(text)
+
+    if not tokens:
+        raise TagQueryError("The query is empty")
+
+    if sum(1 for kind, _ in tokens if kind == "TAG") > MAX_TAGS:
+        raise TagQueryError(f"A query can't use more than {MAX_TAGS} keywords")
+
+    params = []
+    position = 0
+
+    def peek():
+        return tokens[position][0] if position < len(tokens) else None
+
+    def take(kind):
+        nonlocal position
+        if peek() != kind:
+            raise TagQueryError(f"Expected {kind}" if kind != "TAG" else "Expected a keyword")
+        position += 1
+        return tokens[position - 1][1]
+
+    def expression():
+        terms = [term()]
+        while peek() == "OR":
+            take("OR")
+            terms.append(term())
+        return terms[0] if len(terms) == 1 else "(" + " OR ".join(terms) + ")"
+
+    def term():
+        factors = [factor()]
+        while peek() in ("AND", "NOT", "TAG", "("):
+            if peek() == "AND":
+                take("AND")
+            factors.append(factor())
+        return factors[0] if len(factors) == 1 else "(" + " AND ".join(factors) + ")"
+
+    def factor():
+        if peek() == "NOT":
+            take("NOT")
+            return "NOT " + factor()
+
+        if peek() == "(":
+            take("(")
+            condition = expression()
+            take(")")
+            return condition
+
+        keyword = take("TAG")
+        params.append(keyword)
+
+        if folder_id is None:
+            folder_condition = ""
+        else:
+            folder_condition = " AND keywords.folder_id = ?"
+            params.append(folder_id)
+
+        return (
+            "EXISTS (SELECT 1 FROM list_keywords JOIN keywords ON keywords.id = list_keywords.keyword_id"
+            " WHERE list_keywords.list_id = lists.id AND list_keywords.active = 1"
+            " AND keywords.user_id = lists.user_id AND keywords.keyword = ?" + folder_condition + ")"
+        )
+
+    condition = expression()
+
+    if position != len(tokens):
+        raise TagQueryError("Unexpected " + (tokens[position][1] or tokens[position][0]))
+
+    return condition, params
@@ -0,0 +1,86 @@
+import datetime
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Each test migrates a database of its own, none is made when app.py is imported
+os.environ.setdefault("FLASK_MIGRATE_ON_STARTUP", "false")
+
+import cache
+from database import ConnectionPool
+from migrations import migrate
+from repositories import ListRepository, UserRepository
+
+NOW = datetime.datetime(2026, 1, 15, 12, 0)
+
+
+@pytest.fixture
+def db(tmp_path):
+    """A migrated database of its own for every test"""
+
+    db = ConnectionPool(str(tmp_path / "flashcards.db")).connect()
+    migrate(db)
+
+    yield db
+
+    db.close()
+
+
+@pytest.fixture
+def make_user(db):
+    def make(username="user"):
+        with db:
+            return UserRepository(db).create(username, "hash")
+
+    return make
+
+
+@pytest.fixture
+def make_list(db):
+    """Create a list of count cards "term 1"... for a user, returns its id"""
+
+    def make(user_id, count, title="list"):
+        cards = [{"id": index, "term": f"term {index}", "definition": f"definition {index}", "level": ""}
+                 for index in range(1, count + 1)]
+
+        with db:
+            return ListRepository(db, user_id).create(title, "", cards, NOW)
+
+    return make
+
+
+@pytest.fixture
+def app(tmp_path):
+    """The application on a migrated database of its own"""
+
+    from app import app
+
+    database = str(tmp_path / "flashcards.db")
+
+    app.config.update(
+        TESTING=True, DATABASE=database, STORAGE_BACKEND="shared", JOBS_FOLDER=str(tmp_path / "jobs"),
+        WTF_CSRF_ENABLED=False, PASSWORD_WORKERS=0, PASSWORD_ITERATIONS=1000, METRICS_TOKEN=None,
+    )
+
+    # The storage backend and the cache are made again for the new database
+    app.extensions.pop("storage", None)
+    cache.init_app(app)
+
+    db = ConnectionPool(database).connect()
+    migrate(db)
+    db.close()
+
+    return app
+
+
+@pytest.fixture
+def client(app):
+    """A client logged in as a new user"""
+
+    client = app.test_client()
+    client.post("/register", data={"username": "user", "password": "password", "confirmation": "password"})
+
+    return client
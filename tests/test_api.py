@@ -0,0 +1,98 @@
+import pytest
+
+
+@pytest.fixture
+def lists(client):
+    """Three lists of two cards, tagged fruits"""
+
+    client.post("/create_folder", data={"name": "folder"})
+
+    for list_id, title in enumerate(("first", "second", "third"), start=1):
+        client.post("/create_list", data={
+            "id": "/", "title": title, "description": "", "cards-number": "2",
+            "term_card_1": "apple", "definition_card_1": "pomme", "term_card_2": "pear", "definition_card_2": "poire",
+        })
+        client.post("/create_keyword", data={"keyword": "fruits", "folder_id": 1, "folder_path": "folder_1", "list_id": list_id})
+
+
+def test_query_lists(client, lists):
+    response = client.get("/api/lists/query?tags=fruits&limit=2")
+
+    assert [row["title"] for row in response.json["lists"]] == ["first", "second"]
+
+    response = client.get(f"/api/lists/query?tags=fruits&limit=2&after={response.json['next']}")
+
+    assert [row["title"] for row in response.json["lists"]] == ["third"]
+    assert response.json["next"] is None
+
+
+@pytest.mark.parametrize("limit", [0, -1])
+def test_query_lists_limit_is_at_least_one(client, lists, limit):
+    response = client.get(f"/api/lists/query?tags=fruits&limit={limit}")
+
+    assert response.status_code == 200
+    assert len(response.json["lists"]) == 1
+    assert response.json["next"] == response.json["lists"][0]["id"]
+
+
+@pytest.mark.parametrize("limit, count", [(4, 4), (0, 1), (-1, 1), (1000, 6)])
+def test_due_limit(client, lists, limit, count):
+    response = client.get(f"/due?limit={limit}")
+
+    assert response.status_code == 200
+    assert len(response.json["cards"]) == count
+
+
+@pytest.mark.parametrize("limit", [0, -1])
+def test_search_limit_is_at_least_one(client, lists, limit):
+    response = client.get(f"/api/search?q=apple&limit={limit}")
+
+    assert response.status_code == 200
+    assert len(response.json["cards"]) == 1
+    assert response.json["next"] == 1
+
+
+def test_pages_answer_304_to_their_etag(app, client, lists):
+    import app as application
+
+    # The first visit shows the messages flashed by the fixture, it isn't cached
+    client.get("/")
+    response = client.get("/")
+    etag = response.headers["ETag"].strip('"')
+
+    assert etag.startswith(application.RELEASE_VERSION + "-")
+    assert client.get("/", headers={"If-None-Match": f'"{etag}"'}).status_code == 304
+
+
+def test_edit_folder(client, lists):
+    response = client.post("/edit_folder", data={"folder_id": 1, "folder_path": "folder_1", "folder_name": "fruits"})
+
+    assert response.location == "/user/folders/fruits_1"
+
+
+@pytest.mark.parametrize("folder_id", [99, 2])
+def test_edit_folder_of_no_one_or_another_user(app, client, lists, folder_id):
+    other = app.test_client()
+    other.post("/register", data={"username": "other", "password": "password", "confirmation": "password"})
+    other.post("/create_folder", data={"name": "theirs"})
+
+    response = client.post("/edit_folder", data={"folder_id": folder_id, "folder_path": "folder_1", "folder_name": "mine"})
+
+    with client.session_transaction() as session:
+        flashes = session.get("_flashes", [])
+
+    assert response.location == "/"
+    assert flashes[-1] == ("danger", "This folder doesn't exist")
+    assert other.get("/user/folders/theirs_1").status_code == 200
+
+
+@pytest.mark.parametrize("url", ["/metrics", "/db_stats"])
+def test_operator_routes(app, client, url):
+    assert client.get(url).status_code == 404
+
+    app.config["METRICS_TOKEN"] = "secret"
+
+    assert client.get(url).status_code == 401
+    assert client.get(url, headers={"Authorization": "Bearer wrong"}).status_code == 401
+    assert client.get(url, headers={"Authorization": "Bearer secret"}).status_code == 200
+    assert app.test_client().get(url, headers={"Authorization": "Bearer secret"}).status_code == 200
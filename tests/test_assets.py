@@ -0,0 +1,18 @@
+from assets import folder_version
+
+
+def test_folder_version_follows_every_folder(tmp_path):
+    templates, static = tmp_path / "templates", tmp_path / "static"
+    (static / "js").mkdir(parents=True)
+    templates.mkdir()
+    (templates / "page.html").write_text("<script src='app.js'></script>")
+    (static / "js" / "app.js").write_text("console.log(1)")
+
+    version = folder_version(str(templates), str(static))
+
+    assert folder_version(str(templates), str(static)) == version
+
+    # A release changing only a script changes the version of the pages
+    (static / "js" / "app.js").write_text("console.log(2)")
+
+    assert folder_version(str(templates), str(static)) != version
@@ -0,0 +1,116 @@
+import datetime
+
+import pytest
+
+import study
+from study import StudyCursorError, format_cursor, interleave, page, parse_cursor
+
+from conftest import NOW
+
+
+class CountingDb:
+    """A connection counting the rows its cursors hand out"""
+
+    def __init__(self, db):
+        self.db = db
+        self.rows = 0
+
+    def execute(self, sql, parameters=()):
+        return CountingCursor(self, self.db.execute(sql, parameters))
+
+
+class CountingCursor:
+    def __init__(self, counter, cursor):
+        self.counter = counter
+        self.cursor = cursor
+
+    def fetchmany(self, size):
+        rows = self.cursor.fetchmany(size)
+        self.counter.rows += len(rows)
+        return rows
+
+
+@pytest.fixture
+def lists(make_user, make_list):
+    """Three lists of different sizes, and an empty one"""
+
+    user_id = make_user()
+    return [make_list(user_id, count) for count in (7, 3, 12, 0)]
+
+
+def session_order(db, list_ids):
+    return [(row["position"], row["list_id"], row["card_id"]) for row in db.execute(
+        "SELECT position, list_id, card_id FROM cards WHERE list_id IN (%s) ORDER BY position, list_id, card_id"
+        % ", ".join("?" * len(list_ids)), list_ids
+    )]
+
+
+def test_interleave(db, lists):
+    cards = [(row["position"], row["list_id"], row["card_id"]) for row in interleave(db, lists)]
+
+    assert cards == session_order(db, lists)
+    assert [list_id for _, list_id, _ in cards[:4]] == lists[:3] + [lists[0]]
+
+
+@pytest.mark.parametrize("limit", [1, 2, 5, 22, 50])
+def test_pages_cover_the_session_once(db, lists, limit):
+    cards, cursor = [], None
+
+    while True:
+        batch, cursor = page(db, lists, parse_cursor(cursor), limit)
+        assert len(batch) <= limit
+        cards += [(card["position"], card["list_id"], card["card_id"]) for card in batch]
+
+        if cursor is None:
+            break
+
+    assert cards == session_order(db, lists)
+
+
+def test_last_page_has_no_cursor(db, lists):
+    cards, cursor = page(db, lists, None, 22)
+
+    assert len(cards) == 22
+    assert cursor is None
+
+
+def test_due_before(db, lists):
+    with db:
+        db.execute("UPDATE cards SET due_at = (?) WHERE list_id = (?) AND card_id > 2", (NOW + datetime.timedelta(days=1), lists[0]))
+
+    cards, cursor = page(db, lists, None, 100, due_before=NOW)
+
+    assert len(cards) == 22 - 5
+    assert all(card["list_id"] != lists[0] or card["card_id"] <= 2 for card in cards)
+
+
+def test_pages_read_about_what_they_send(db, make_user, make_list):
+    user_id = make_user()
+    list_ids = [make_list(user_id, 200) for _ in range(10)]
+
+    counting = CountingDb(db)
+    cards, cursor = page(counting, list_ids, None, 20)
+
+    # Twice the cards sent, plus the one each list reads ahead
+    assert len(cards) == 20
+    assert counting.rows <= 2 * (len(cards) + 1) + len(list_ids)
+
+    counting.rows = 0
+    page(counting, list_ids, parse_cursor(cursor), 20)
+
+    assert counting.rows <= 2 * (len(cards) + 1) + len(list_ids)
+    assert study.FETCH_SIZE * len(list_ids) > 2 * (len(cards) + 1) + len(list_ids)
+
+
+def test_cursor_round_trip():
+    card = {"position": 3, "list_id": 12, "card_id": 4}
+
+    assert parse_cursor(format_cursor(card)) == (3, 12, 4)
+    assert parse_cursor(None) is None
+    assert parse_cursor("") is None
+
+
+@pytest.mark.parametrize("cursor", ["3.12", "3.12.4.5", "a.b.c", "3..4"])
+def test_invalid_cursors(cursor):
+    with pytest.raises(StudyCursorError):
+        parse_cursor(cursor)
@@ -0,0 +1,147 @@
+import datetime
+
+import pytest
+
+from stats import current_streak
+from sync import MAX_AGE, MAX_EVENTS, SyncError, apply_reviews, parse_events
+
+from conftest import NOW
+
+
+def event(list_id, card_id, key, level="Mastered", reviewed_at=None):
+    return {"key": key, "list_id": list_id, "card_id": card_id, "level": level,
+            "reviewed_at": reviewed_at or (NOW - datetime.timedelta(minutes=5)).isoformat()}
+
+
+def apply(db, user_id, events):
+    with db:
+        return apply_reviews(db, user_id, events, NOW)
+
+
+def reviews(db):
+    return [row["client_key"] for row in db.execute("SELECT client_key FROM reviews ORDER BY id")]
+
+
+def test_parse_events_rejects_bad_events_alone():
+    events, rejected = parse_events([
+        event(1, 1, "a", reviewed_at="2026-01-15T11:00:00.000Z"),
+        event(1, 2, "b", level="Forgotten"),
+        {"key": "c", "list_id": "one", "card_id": 1, "level": "Mastered"},
+        event(1, 3, "d", reviewed_at="yesterday"),
+        event(1, 4, "e", reviewed_at=(NOW - MAX_AGE - datetime.timedelta(days=1)).isoformat()),
+        event(1, 5, ""),
+        "not an event",
+        event(1, 6, None),
+    ], NOW)
+
+    assert [parsed["key"] for parsed in events] == ["a", None]
+    assert events[0]["reviewed_at"] == datetime.datetime(2026, 1, 15, 11, tzinfo=datetime.timezone.utc).astimezone().replace(tzinfo=None)
+    assert events[1]["reviewed_at"] == NOW - datetime.timedelta(minutes=5)
+    assert [(entry["index"], entry["key"]) for entry in rejected] == [(1, "b"), (2, "c"), (3, "d"), (4, "e"), (5, ""), (6, None)]
+
+
+@pytest.mark.parametrize("events", [{"key": "a"}, None, [event(1, 1, str(index)) for index in range(MAX_EVENTS + 1)]])
+def test_parse_events_rejects_bad_batches(events):
+    with pytest.raises(SyncError):
+        parse_events(events, NOW)
+
+
+def test_apply_reviews(db, make_user, make_list):
+    user_id = make_user()
+    list_id = make_list(user_id, 3)
+
+    events, _ = parse_events([event(list_id, 1, "a"), event(list_id, 2, "b", level="Still learning")], NOW)
+
+    assert apply(db, user_id, events) == (["a", "b"], [], [], [])
+    assert reviews(db) == ["a", "b"]
+
+    cards = {row["card_id"]: row for row in db.execute("SELECT * FROM cards WHERE list_id = (?)", (list_id,))}
+    assert cards[1]["level"] == "Mastered"
+    assert cards[2]["level"] == "Still learning"
+    assert cards[3]["level"] == ""
+
+
+def test_apply_reviews_skips_duplicates(db, make_user, make_list):
+    user_id = make_user()
+    list_id = make_list(user_id, 3)
+
+    events, _ = parse_events([event(list_id, 1, "a"), event(list_id, 2, "b")], NOW)
+    apply(db, user_id, events)
+
+    # Sent again with a new review, and a key repeated in the batch
+    events, _ = parse_events([event(list_id, 1, "a"), event(list_id, 3, "c"), event(list_id, 3, "c"), event(list_id, 2, "b")], NOW)
+
+    assert apply(db, user_id, events) == (["c"], ["a", "c", "b"], [], [])
+    assert reviews(db) == ["a", "b", "c"]
+
+
+def test_apply_reviews_without_keys_are_never_duplicates(db, make_user, make_list):
+    user_id = make_user()
+    list_id = make_list(user_id, 1)
+
+    events, _ = parse_events([event(list_id, 1, None), event(list_id, 1, None)], NOW)
+
+    assert apply(db, user_id, events) == ([], [], [], [])
+    assert reviews(db) == [None, None]
+
+
+def test_apply_reviews_keys_are_per_user(db, make_user, make_list):
+    user_id, other_id = make_user("user"), make_user("other")
+    list_id, other_list_id = make_list(user_id, 1), make_list(other_id, 1)
+
+    apply(db, user_id, parse_events([event(list_id, 1, "a")], NOW)[0])
+
+    assert apply(db, other_id, parse_events([event(other_list_id, 1, "a")], NOW)[0]) == (["a"], [], [], [])
+
+
+def test_apply_reviews_rejects_other_users_lists(db, make_user, make_list):
+    user_id, other_id = make_user("user"), make_user("other")
+    list_id, other_list_id = make_list(user_id, 1), make_list(other_id, 1)
+
+    events, _ = parse_events([event(list_id, 1, "a"), event(other_list_id, 1, "b"), event(9999, 1, "c")], NOW)
+
+    applied, duplicates, missing, rejected = apply(db, user_id, events)
+
+    assert (applied, duplicates, missing) == (["a"], [], [])
+    assert [entry["key"] for entry in rejected] == ["b", "c"]
+    assert reviews(db) == ["a"]
+    assert db.execute("SELECT level FROM cards WHERE list_id = (?)", (other_list_id,)).fetchone()["level"] == ""
+
+
+def test_apply_reviews_reports_missing_cards(db, make_user, make_list):
+    user_id = make_user()
+    list_id = make_list(user_id, 2)
+
+    events, _ = parse_events([event(list_id, 1, "a"), event(list_id, 5, "b")], NOW)
+
+    assert apply(db, user_id, events) == (["a"], [], ["b"], [])
+    assert reviews(db) == ["a"]
+
+
+def test_backdated_reviews_join_the_streaks(db, make_user, make_list):
+    user_id = make_user()
+    list_id = make_list(user_id, 1)
+
+    def review(key, days_ago):
+        reviewed_at = (NOW - datetime.timedelta(days=days_ago)).isoformat()
+        apply(db, user_id, parse_events([event(list_id, 1, key, reviewed_at=reviewed_at)], NOW)[0])
+
+    def streaks():
+        return [row["streak"] for row in db.execute("SELECT streak FROM daily_stats WHERE list_id = (?) ORDER BY day", (list_id,))]
+
+    # Studied 4 days ago, then from 2 days ago to today
+    review("a", 4)
+    review("b", 2)
+    review("c", 1)
+    review("d", 1 / 24)
+    review("e", 0)
+
+    assert streaks() == [1, 1, 2, 3]
+    assert current_streak(db, user_id, NOW.date(), list_id) == 3
+
+    # The review made offline 3 days ago is synced now
+    review("f", 3)
+
+    assert streaks() == [1, 2, 3, 4, 5]
+    assert current_streak(db, user_id, NOW.date(), list_id) == 5
+    assert current_streak(db, user_id, NOW.date()) == 5
@@ -0,0 +1,96 @@
+import pytest
+
+from repositories import FolderRepository, KeywordRepository
+from tags import MAX_TAGS, TagQueryError, build_filter, tokenize
+
+from conftest import NOW
+
+
+@pytest.fixture
+def tagged(db, make_user, make_list):
+    """Lists tagged verbs, nouns, verbs + irregular and "past tense" in one folder"""
+
+    user_id = make_user()
+    lists = {name: make_list(user_id, 2, name) for name in ("verbs", "nouns", "irregular", "past")}
+
+    with db:
+        FolderRepository(db, user_id).create("folder", NOW)
+        keywords = KeywordRepository(db, user_id)
+        keywords.create(1, "verbs", lists["verbs"])
+        keywords.create(1, "nouns", lists["nouns"])
+        keywords.create(1, "verbs", lists["irregular"])
+        keywords.create(1, "irregular", lists["irregular"])
+        keywords.create(1, "past tense", lists["past"])
+
+    return user_id, lists
+
+
+def matching(db, user_id, query, folder_id=None):
+    condition, params = build_filter(query, folder_id)
+
+    return {row["title"] for row in db.execute(
+        f"SELECT title FROM lists WHERE user_id = ? AND {condition}", (user_id, *params)
+    )}
+
+
+def test_tokenize():
+    assert tokenize('verbs and (NOT "past tense")') == [
+        ("TAG", "verbs"), ("AND", None), ("(", None), ("NOT", None), ("TAG", "past tense"), (")", None)
+    ]
+
+
+@pytest.mark.parametrize("query, titles", [
+    ("verbs", {"verbs", "irregular"}),
+    ("verbs AND irregular", {"irregular"}),
+    ("verbs irregular", {"irregular"}),
+    ("verbs AND NOT irregular", {"verbs"}),
+    ("nouns OR irregular", {"nouns", "irregular"}),
+    ('(nouns OR verbs) AND NOT irregular', {"nouns", "verbs"}),
+    ('"past tense"', {"past"}),
+    ("unknown", set()),
+])
+def test_build_filter(db, tagged, query, titles):
+    user_id, lists = tagged
+
+    assert matching(db, user_id, query) == titles
+    assert matching(db, user_id, query, folder_id=1) == titles
+
+
+def test_keywords_of_another_folder_dont_match(db, tagged):
+    user_id, lists = tagged
+
+    assert matching(db, user_id, "verbs", folder_id=2) == set()
+    assert matching(db, user_id, "NOT verbs", folder_id=2) == {"verbs", "nouns", "irregular", "past"}
+
+
+def test_inactive_keywords_dont_match(db, tagged):
+    user_id, lists = tagged
+
+    keyword_id = db.execute("SELECT id FROM keywords WHERE keyword = 'irregular'").fetchone()["id"]
+
+    with db:
+        KeywordRepository(db, user_id).set_active(lists["irregular"], keyword_id, False)
+
+    assert matching(db, user_id, "irregular") == set()
+    assert matching(db, user_id, "verbs") == {"verbs", "irregular"}
+
+
+def test_keywords_are_the_users_own(db, tagged, make_user):
+    other_id = make_user("other")
+
+    assert matching(db, other_id, "verbs") == set()
+
+
+@pytest.mark.parametrize("query", [
+    "",
+    "   ",
+    "verbs AND",
+    "(verbs",
+    "verbs)",
+    "OR verbs",
+    'verbs "unclosed',
+    " ".join(f"tag{index}" for index in range(MAX_TAGS + 1)),
+])
+def test_invalid_queries(query):
+    with pytest.raises(TagQueryError):
+        build_filter(query)
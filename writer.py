@@ -0,0 +1,224 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+from flask import current_app
+
+from database import ConnectionPool, get_backend, get_db
+
+# Jobs waiting for the writer before submit() refuses more
+QUEUE_SIZE = 1000
+
+# Most jobs committed together in one transaction
+BATCH_SIZE = 100
+
+# Seconds submit() waits for room in a full queue
+SUBMIT_TIMEOUT = 5
+
+# Seconds write() waits for the result of a job
+RESULT_TIMEOUT = 30
+
+
+class WriterBusy(RuntimeError):
+    """The write queue is full or the writer is too slow, the request should be tried again later"""
+
+
+class Writer:
+    """
+    One thread doing all the writes of a database, in group commits.
+
+    Request threads submit functions of a connection and get a Future of their
+    result. The writer takes the jobs waiting in the queue (up to batch_size),
+    runs each of them in its own savepoint of one IMMEDIATE transaction and
+    commits them together: a job that fails is rolled back alone and its Future
+    gets the exception, the results are only given once the commit is done.
+    """
+
+    def __init__(self, database, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, submit_timeout=SUBMIT_TIMEOUT):
+        self.database = database
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.submit_timeout = submit_timeout
+        self.lock = threading.Lock()
+        self.thread = None
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.batches = 0
+        self.max_depth = 0
+        self.wait_seconds = 0
+        self.commit_seconds = 0
+
+    def start(self):
+        """Start the writer thread, or start it again if it died (e.g. it couldn't open the database)"""
+
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="sqlite-writer", daemon=True)
+                self.thread.start()
+
+    def submit(self, function, *args):
+        """Queue function(db, *args) and get a Future of its result, raises WriterBusy if the queue stays full"""
+
+        self.start()
+
+        future = Future()
+
+        try:
+            self.jobs.put((function, args, future, time.perf_counter()), timeout=self.submit_timeout)
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            raise WriterBusy("Too many writes are waiting, try again in a moment")
+
+        with self.lock:
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, self.jobs.qsize())
+
+        return future
+
+    def run(self):
+        db = ConnectionPool(self.database).connect()
+
+        while True:
+            # Wait for one job, then take the ones that arrived meanwhile
+            batch = [self.jobs.get()]
+
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+
+            self.run_batch(db, batch)
+
+    def run_batch(self, db, batch):
+        start = time.perf_counter()
+        results = []
+
+        try:
+            db.execute("BEGIN IMMEDIATE")
+
+            for function, args, future, queued in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                db.execute("SAVEPOINT job")
+
+                try:
+                    results.append((future, True, function(db, *args)))
+                    db.execute("RELEASE job")
+                except Exception as error:
+                    db.execute("ROLLBACK TO job")
+                    db.execute("RELEASE job")
+                    results.append((future, False, error))
+
+            db.execute("COMMIT")
+        except Exception as error:
+            # The whole batch is lost, every job gets the error
+            if db.in_transaction:
+                db.rollback()
+
+            results = []
+
+            for function, args, future, queued in batch:
+                if future.running() or future.set_running_or_notify_cancel():
+                    results.append((future, False, error))
+
+        end = time.perf_counter()
+
+        with self.lock:
+            self.batches += 1
+            self.commit_seconds += end - start
+            self.wait_seconds += sum(start - queued for function, args, future, queued in batch)
+
+            for future, succeeded, value in results:
+                if succeeded:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+
+        for future, succeeded, value in results:
+            if succeeded:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def stats(self):
+        """Counters of the writer"""
+
+        with self.lock:
+            return {
+                "queue_depth": self.jobs.qsize(),
+                "queue_size": self.jobs.maxsize,
+                "max_depth": self.max_depth,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "batches": self.batches,
+                "wait_seconds": round(self.wait_seconds, 6),
+                "commit_seconds": round(self.commit_seconds, 6),
+            }
+
+
+writers = {}
+writers_lock = threading.Lock()
+
+
+def get_writer(database=None):
+    """Get the writer of the configured database"""
+
+    config = current_app.config
+
+    if database is None:
+        database = config["DATABASE"]
+
+    with writers_lock:
+        if database not in writers:
+            writers[database] = Writer(
+                database,
+                queue_size=config.get("WRITER_QUEUE_SIZE", QUEUE_SIZE),
+                batch_size=config.get("WRITER_BATCH_SIZE", BATCH_SIZE),
+                submit_timeout=config.get("WRITER_SUBMIT_TIMEOUT", SUBMIT_TIMEOUT),
+            )
+        return writers[database]
+
+
+def write(function, *args):
+    """
+    Run function(db, *args) on the writer thread and wait for its result (or its exception).
+
+    Every write to the lists, cards, folders, keywords, reviews and
+    retention models goes through here. The other tables are still written
+    on the connection of the request or job, SQLite's busy timeout
+    serializing them with the writer: the accounts and sessions on the
+    directory database (an account deleted there takes its data with it
+    when every user shares one database), and the jobs on the user's
+    database, like their results.
+
+    Raises WriterBusy when the result doesn't come in WRITER_RESULT_TIMEOUT
+    seconds. A job still waiting in the queue is cancelled; one the writer
+    already started is waited for once more before giving up.
+    """
+
+    # A user's own database has no other users' writes to queue behind
+    if get_backend().sharded:
+        with get_db() as db:
+            return function(db, *args)
+
+    timeout = current_app.config.get("WRITER_RESULT_TIMEOUT", RESULT_TIMEOUT)
+    future = get_writer().submit(function, *args)
+
+    try:
+        return future.result(timeout)
+    except TimeoutError:
+        if future.cancel():
+            raise WriterBusy("The writes are taking too long, try again in a moment")
+
+    try:
+        return future.result(timeout)
+    except TimeoutError:
+        raise WriterBusy("The writes are taking too long, try again in a moment")